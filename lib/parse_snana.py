@@ -4,16 +4,30 @@ import io
 import pathlib
 import re
 import gzip
+import hashlib
 import yaml
 import json
 import subprocess
 import logging
+import time
 import pickle
 import argparse
 import traceback
+import copy
+import concurrent.futures
 import numpy
 import pandas
 
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    from astropy.io import fits
+except ImportError:
+    fits = None
+
 _logger = logging.getLogger("main")
 _logout = logging.StreamHandler( sys.stderr )
 _logger.addHandler( _logout )
@@ -23,6 +37,9 @@ _logout.setFormatter( _formatter )
 _logger.setLevel( logging.INFO )
 # _logger.setLevel( logging.DEBUG )
 
+# Stands in for a NaN FIELD as a dict key (NaN != NaN)
+_nan_field = object()
+
 class NumpyEncoder(json.JSONEncoder ):
     def default( self, obj ):
         if isinstance( obj, numpy.int64 ):
@@ -34,9 +51,20 @@ class NumpyEncoder(json.JSONEncoder ):
 class RomanSurveySummary:
     known_filters = ['R', 'Z', 'Y', 'J', 'H', 'F', 'K']
     surveynameparse = re.compile( '^(.*)\.SIMLIB(\.gz)?' )
+    # Keys of a survey that are left out of {collection}_surveyindex.json
+    heavy_survey_keys = [ 'zhist', 'snrmaxzhist', 'snrmax2zhist', 'snrmax3zhist', 'spechists' ]
 
-    def __init__( self, outdir, searchdir=None, snana_simdir=None, snrmaxcut=5. ):
+    def __init__( self, outdir, searchdir=None, snana_simdir=None, snrmaxcut=5., poolsize=0, poolzbin=0.1,
+                  poolseed=42, jobs=1, regen=False, hashinputs=False, chunkrows=0, zhistbins=( 0., 3.1, 0.1 ) ):
         self.outdir = pathlib.Path( outdir )
+        self.zhistbins = zhistbins
+        self.jobs = jobs if jobs > 0 else os.cpu_count()
+        self.chunkrows = chunkrows
+        self.regen = regen
+        self.hashinputs = hashinputs
+        self.poolsize = poolsize
+        self.poolzbin = poolzbin
+        self.poolseed = poolseed
         self.collections = {}
         self.snana_scratchdir = {}
         self.snrmaxcut = snrmaxcut
@@ -279,55 +307,128 @@ class RomanSurveySummary:
 
         # TODO : scaling CC by 10 (or whatever)
 
-        dumpfilepath = pathlib.Path( dumpfilepath )
-        if dumpfilepath.is_file():
-            # dumpdf = pandas.read_csv( dumpfilepath, delim_whitespace=True, comment='#', skip_blank_lines=True )
-            dumpdf = pandas.read_csv( dumpfilepath, sep='\s+', comment='#', skip_blank_lines=True )
+        found = self._find_table( dumpfilepath )
+        if found is None:
+            raise FileNotFoundError( f"Can't find {dumpfilepath} or {dumpfilepath}.gz" )
+        dumpfilepath = found
+
+        # Add up the counts of each chunk of the file, keeping the fields
+        #   in order of first appearance (as dumpdf['FIELD'].unique() would)
+        gentypes = list( gentypemap.keys() )
+        fields = []
+        fieldindex = {}
+        counts = []
+        for dumpdf in self._read_table( dumpfilepath ):
+            chunkfields, chunkcounts = self._bin_zhists( dumpdf, gentypes )
+            for field, n in zip( chunkfields, chunkcounts ):
+                key = _nan_field if pandas.isna( field ) else field
+                if key in fieldindex:
+                    counts[ fieldindex[key] ] += n
+                else:
+                    fieldindex[ key ] = len( fields )
+                    fields.append( field )
+                    counts.append( n )
+
+        return self._zhist_lists( fields, counts, gentypemap, prescales )
+
+    def _find_table( self, path ):
+        """Returns path if it exists, path.gz if that does instead, or None if neither does."""
+        path = pathlib.Path( path )
+        for candidate in ( path, path.parent / f"{path.name}.gz" ):
+            if candidate.is_file():
+                return candidate
+        return None
+
+    def _read_table( self, path ):
+        """Read a whitespace-separated SNANA text table (e.g. .DUMP, .SPEC), which may be gzipped.
+
+        Yields pandas DataFrames: the whole table, or, if self.chunkrows
+        is set, successive chunks of that many rows, so that only one
+        chunk has to be in memory at a time.
+
+        """
+        if self.chunkrows:
+            with pandas.read_csv( path, sep='\s+', comment='#', skip_blank_lines=True, compression='infer',
+                                  chunksize=self.chunkrows ) as reader:
+                yield from reader
         else:
-            dumpgzfilepath = dumpfilepath.parent / f"{dumpfilepath.name}.gz"
-            if dumpgzfilepath.is_file():
-                # dumpdf = pandas.read_csv( dumpgzfilepath, delim_whitespace=True, compression='gzip',
-                #                           comment='#', skip_blank_lines=True )
-                dumpdf = pandas.read_csv( dumpgzfilepath, sep='\s+', compression='gzip',
-                                          comment='#', skip_blank_lines=True )
-            else:
-                raise FileNotFoundError( f"Can't find {dumpfilepath} or {dumpgzfilepath}" )
-
-
-        fields = dumpdf['FIELD'].unique()
-        types = dumpdf['GENTYPE'].unique()
-
-        hist = { 'tier': [], 'gentype': [], 'zCMB': [], 'n': [] }
-        snrmaxhist = { 'tier': [], 'gentype': [], 'zCMB': [], 'n': [] }
-        snrmax2hist = { 'tier': [], 'gentype': [], 'zCMB': [], 'n': [] }
-        snrmax3hist = { 'tier': [], 'gentype': [], 'zCMB': [], 'n': [] }
-        for field in fields:
-            fielddf = dumpdf[ dumpdf['FIELD'] == field ]
-            for zlow in numpy.arange( 0., 3.1, 0.1 ):
-                sne_at_z = fielddf[ ( fielddf['ZCMB'] >= zlow ) & ( fielddf['ZCMB'] < zlow + 0.1 ) ]
-                for gentype, gentypestr in gentypemap.items():
-                    prescale = 1.
-                    if gentypestr in prescales.keys():
-                        prescale = float( prescales[gentypestr] )
-                    gentypesne = sne_at_z[ sne_at_z['GENTYPE'] == gentype ]
-                    hist['tier'].append( field )
-                    snrmaxhist['tier'].append( field )
-                    snrmax2hist['tier'].append( field )
-                    snrmax3hist['tier'].append( field )
-                    hist['gentype'].append( gentype )
-                    snrmaxhist['gentype'].append( gentype )
-                    snrmax2hist['gentype'].append( gentype )
-                    snrmax3hist['gentype'].append( gentype )
-                    hist['zCMB'].append( zlow )
-                    snrmaxhist['zCMB'].append( zlow )
-                    snrmax2hist['zCMB'].append( zlow )
-                    snrmax3hist['zCMB'].append( zlow )
-                    hist['n'].append( prescale * len(gentypesne) )
-                    snrmaxhist['n'].append( prescale * len( gentypesne[ gentypesne['SNRMAX'] > self.snrmaxcut ] ) )
-                    snrmax2hist['n'].append( prescale * len( gentypesne[ gentypesne['SNRMAX2'] > self.snrmaxcut ] ) )
-                    snrmax3hist['n'].append( prescale * len( gentypesne[ gentypesne['SNRMAX3'] > self.snrmaxcut ] ) )
-
-        return hist, snrmaxhist, snrmax2hist, snrmax3hist
+            yield pandas.read_csv( path, sep='\s+', comment='#', skip_blank_lines=True, compression='infer' )
+
+    def _bin_zhists( self, dumpdf, gentypes ):
+        """Count the objects in dumpdf by ( FIELD, z bin, GENTYPE ), for _gen_zhists.
+
+        The z bins are self.zhistbins = ( zmin, zmax, dz ): bin i is
+        zlow_i <= ZCMB < zlow_i + dz, where zlow = numpy.arange( zmin,
+        zmax, dz ).  (Because of floating-point roundoff in arange,
+        zlow_i + dz isn't always exactly zlow_(i+1), so an object right on
+        an edge may be in two bins or in none; that's kept as it is so
+        that the histograms don't change.)
+
+        All four histograms are made in one pass: each object adds +1 at
+        the first bin it's in and -1 after the last one, in an array with
+        one row per ( field, gentype ), and a cumulative sum along z turns
+        that into counts.  The objects above the SNRMAX cuts are done the
+        same way with weights.
+
+        Returns fields, counts.  fields are dumpdf's FIELDs in order of
+        appearance; counts is an integer array of shape ( len(fields), 4,
+        len(gentypes), number of z bins ), with the counts of all objects,
+        and of objects with SNRMAX, SNRMAX2, SNRMAX3 > self.snrmaxcut.
+
+        """
+        # Fields in order of appearance, like dumpdf['FIELD'].unique()
+        fieldi, fields = pandas.factorize( dumpdf['FIELD'], use_na_sentinel=False )
+        zmin, zmax, dz = self.zhistbins
+        zlow = numpy.arange( zmin, zmax, dz )
+        nz = len( zlow )
+
+        # Rows with a NaN FIELD (which still gets histograms, all 0) or a
+        #   GENTYPE that's not in gentypemap aren't counted anywhere
+        gentypei = pandas.Index( gentypes ).get_indexer( dumpdf['GENTYPE'] )
+        keep = dumpdf['FIELD'].notna().to_numpy() & ( gentypei >= 0 )
+        group = fieldi[keep] * len( gentypes ) + gentypei[keep]
+        zcmb = dumpdf['ZCMB'].to_numpy( dtype=numpy.float64 )[keep]
+
+        # Object is in bins first <= i < last (NaN z: first = last = nz)
+        first = numpy.searchsorted( zlow + dz, zcmb, side='right' )
+        last = numpy.searchsorted( zlow, zcmb, side='right' )
+        nbins = len( fields ) * len( gentypes ) * ( nz + 1 )
+        starts = group * ( nz + 1 ) + first
+        ends = group * ( nz + 1 ) + last
+
+        counts = numpy.empty( ( len( fields ), 4, len( gentypes ), nz ), dtype=numpy.int64 )
+        for i, weights in enumerate( ( None,
+                                       *[ ( dumpdf[col].to_numpy()[keep] > self.snrmaxcut )
+                                          for col in ( 'SNRMAX', 'SNRMAX2', 'SNRMAX3' ) ] ) ):
+            edges = ( numpy.bincount( starts, weights=weights, minlength=nbins )
+                      - numpy.bincount( ends, weights=weights, minlength=nbins ) )
+            n = numpy.cumsum( edges.reshape( len( fields ), len( gentypes ), nz + 1 ), axis=2 )[ :, :, :nz ]
+            counts[ :, i ] = numpy.rint( n ).astype( numpy.int64 )
+
+        return fields, counts
+
+    def _zhist_lists( self, fields, counts, gentypemap, prescales ):
+        """Turn the fields, counts from _bin_zhists into the four histograms _gen_zhists returns."""
+        gentypes = list( gentypemap.keys() )
+        prescale = numpy.array( [ float( prescales[ gentypemap[g] ] ) if gentypemap[g] in prescales.keys() else 1.
+                                  for g in gentypes ] )
+        zmin, zmax, dz = self.zhistbins
+        zlow = numpy.arange( zmin, zmax, dz )
+        nz = len( zlow )
+        ngentype = len( gentypes )
+        counts = numpy.array( counts, dtype=numpy.int64 ).reshape( len( fields ), 4, ngentype, nz )
+
+        tier = [ field for field in fields for i in range( nz * ngentype ) ]
+        gentype = gentypes * ( len( fields ) * nz )
+        zcol = [ z for i in range( len( fields ) ) for z in zlow for j in range( ngentype ) ]
+        hists = []
+        for i in range( 4 ):
+            # Same order as the lists: field, then z, then gentype
+            n = ( counts[ :, i ] * prescale[ None, :, None ] ).transpose( 0, 2, 1 ).ravel()
+            hists.append( { 'tier': list( tier ), 'gentype': list( gentype ), 'zCMB': list( zcol ),
+                            'n': n.tolist() } )
+
+        return tuple( hists )
 
     def _get_snana_scratchdir( self, collection ):
         # Find the SNANA output scratch directory
@@ -460,8 +561,6 @@ class RomanSurveySummary:
                 return {}
 
         _logger.debug( f"Parsing {specfile}" )
-        # specdf = pandas.read_csv( specfile, delim_whitespace=True, comment='#', skip_blank_lines=True, compression='infer' )
-        specdf = pandas.read_csv( specfile, sep='\s+', comment='#', skip_blank_lines=True, compression='infer' )
 
         zmin = 0.
         zmax = 3.
@@ -490,9 +589,6 @@ class RomanSurveySummary:
                  'deltasnr': deltasnr
                 }
 
-        spectiers = specdf['FIELD'].unique()
-        if set( spectiers ) != set( [ t['name'] for t in tiers ] ):
-            _logger.error( f"Spectroscopic tiers {spectiers} don't match photometric {tiers.keys()}" )
         ntexpose = -99
         for info in tiers:
             tier = info['name']
@@ -507,91 +603,443 @@ class RomanSurveySummary:
 
         hist[ 'nspecstrategies' ] = ntexpose
 
-        specstrat = []
-        for strati in range(ntexpose):
-            stratdict = {}
+        # Everything below is done in one pass over the spectra (or one
+        #   pass over each chunk of them, see _read_table).  Each spectrum
+        #   is in the histograms of every ( strategy, tier ) whose tier is
+        #   the spectrum's FIELD and whose texpose is the spectrum's
+        #   TEXPOSE.
+        #
+        # I'm going to be doing a float comparison for texpose, which is scary.
+        #   However, I expect these floating point numbers to all be integers,
+        #   and 32-bit floats can perfectly represent integers up to 2^23-1,
+        #   or 8388607, and no exposure time will ever be that long.
+        #
+        # Tiers are numbered by where they are in tiers (the first one, if
+        #   a name is there twice), so the numbers are the same for every
+        #   chunk.  The output is in order of first appearance in the file.
+
+        tierindex = {}
+        for ti, ent in enumerate( tiers ):
+            tierindex.setdefault( ent['name'], ti )
+        ntier = len( tiers )
+        nstrat = max( ntexpose, 0 )
+
+        texposes = pandas.Index( numpy.unique( numpy.array( [ tiers[ti]['texpose_prism'][i]
+                                                               for ti in tierindex.values()
+                                                               for i in range( nstrat ) ], dtype=numpy.float64 ) ) )
+        # pairstrats[ tier index * len(texposes) + texpose index ] : the strategies for that tier and texpose
+        pairstrats = [ [] for i in range( ntier * len( texposes ) ) ]
+        for ti in tierindex.values():
+            for strati in range( nstrat ):
+                texi = texposes.get_loc( float( tiers[ti]['texpose_prism'][strati] ) )
+                pairstrats[ ti * len( texposes ) + texi ].append( strati )
+        npairstrats = numpy.array( [ len(p) for p in pairstrats ] + [ 0 ], dtype=numpy.int64 )
+        pairoffset = numpy.concatenate( [ [ 0 ], numpy.cumsum( npairstrats ) ] )
+        pairstratflat = numpy.array( [ strati for p in pairstrats for strati in p ], dtype=numpy.int64 )
+
+        binning = { 'tierindex': tierindex,
+                    'texposes': texposes,
+                    'npairstrats': npairstrats,
+                    'pairoffset': pairoffset,
+                    'pairstratflat': pairstratflat,
+                    'nstrat': nstrat,
+                    'z': ( zmin, deltaz ),
+                    't': ( tobsmin, deltat ),
+                    'm': ( mmin, deltam ),
+                    'snr': ( snrmin, deltasnr ) }
+
+        # Accumulators: the tiers in order of appearance, the histogram
+        #   counts (Series indexed by ( strat, tier, band, frame, GENTYPE,
+        #   zbin, tbin, magbin, snrbin ), to be added up), and the
+        #   ( tier * nstrat + strat, CID ) (DataFrames, to be deduplicated
+        #   keeping the order of appearance).  The chunks' counts and cids
+        #   are folded into the first ones whenever they add up to more
+        #   than it, so there are never more than about twice as many
+        #   as there will be in the end, and each one isn't re-added
+        #   more than a few times.
+        spectiers = []
+        counts = []
+        cids = []
+        for specdf in self._read_table( specfile ):
+            chunktiers, chunkcounts, chunkcids = self._bin_spec( specdf, binning )
+            spectiers.extend( t for t in chunktiers if t not in spectiers )
+            counts.append( chunkcounts )
+            cids.append( chunkcids )
+            if sum( len(c) for c in counts[1:] ) >= len( counts[0] ):
+                counts = [ self._sum_spec_counts( counts ) ]
+            if sum( len(c) for c in cids[1:] ) >= len( cids[0] ):
+                cids = [ pandas.concat( cids, ignore_index=True ).drop_duplicates() ]
+        counts = self._sum_spec_counts( counts ) if len( counts ) > 0 else None
+        cids = pandas.concat( cids, ignore_index=True ).drop_duplicates() if len( cids ) > 0 else None
 
-            for tier in specdf['FIELD'].unique():
-                _logger.debug( f"Spectrum strategy {strati}, tier {tier}" )
-                tiersentry = None
-                for ent in tiers:
-                    if ent['name'] == tier:
-                        tiersentry = ent
-                        break
-                else:
-                    raise RuntimeError( f"Tier {tier} in specdf is not in tiers." )
+        if set( spectiers ) != set( [ t['name'] for t in tiers ] ):
+            _logger.error( f"Spectroscopic tiers {spectiers} don't match photometric {[ t['name'] for t in tiers ]}" )
+
+        # counts is sorted by ( strat, tier, band, frame ), so each histogram is one slice of it
+        bands = [ 'Z', 'Y', 'J', 'H' ]
+        levelnames = [ 'strat', 'tier', 'band', 'frame', 'GENTYPE', 'zbin', 'tbin', 'magbin', 'snrbin' ]
+        if counts is None:
+            levels = { k: numpy.array( [], dtype=numpy.int64 ) for k in levelnames }
+            n = numpy.array( [], dtype=numpy.int64 )
+        else:
+            levels = { k: counts.index.get_level_values( k ).to_numpy() for k in levelnames }
+            n = counts.to_numpy()
+        histid = ( ( levels['strat'] * ntier + levels['tier'] ) * len( bands ) + levels['band'] ) * 2 + levels['frame']
+        bounds = numpy.searchsorted( histid, numpy.arange( nstrat * ntier * len( bands ) * 2 + 1 ) )
 
+        specstrat = []
+        for strati in range( nstrat ):
+            stratdict = {}
+            for tier in spectiers:
+                ti = tierindex[ tier ]
                 stratdict[tier] = {}
-                stratdict[tier]['texpose'] = tiersentry['texpose_prism'][strati]
+                stratdict[tier]['texpose'] = tiers[ti]['texpose_prism'][strati]
+                for bandi, band in enumerate( bands ):
+                    for frame, ( key, tcol ) in enumerate( ( ( band, 'tbin' ), ( f'{band}_restframe', 'trestbin' ) ) ):
+                        i = ( ( strati * ntier + ti ) * len( bands ) + bandi ) * 2 + frame
+                        sl = slice( bounds[i], bounds[i+1] )
+                        stratdict[tier][key] = { 'GENTYPE': levels['GENTYPE'][sl].tolist(),
+                                                 'zbin': levels['zbin'][sl].tolist(),
+                                                 tcol: levels['tbin'][sl].tolist(),
+                                                 'magbin': levels['magbin'][sl].tolist(),
+                                                 'snrbin': levels['snrbin'][sl].tolist(),
+                                                 'n': n[sl].tolist() }
+            specstrat.append( stratdict )
 
-                tierdf = specdf[ ( specdf['FIELD'] == tier )
-                                 & ( specdf['TEXPOSE'] == tiersentry['texpose_prism'][strati] )
-                                ].copy()
+        hist[ 'spectrumhists' ] = specstrat
 
-                tierdf['zbin'] = ( ( tierdf['zHEL'] - zmin ) / deltaz ).apply( int )
-                tierdf['tbin'] = ( ( tierdf['TOBS'] - tobsmin ) / deltat ).apply( int )
-                tierdf['trestbin'] = ( ( tierdf['TOBS'] / ( 1 + tierdf['zHEL'] ) - tobsmin ) / deltat ).apply( int )
+        # The cids of each ( tier, strategy ), in order of first appearance
+        if cids is None:
+            cids = pandas.DataFrame( { 'g': numpy.array( [], dtype=numpy.int64 ), 'CID': [] } )
+        order = numpy.argsort( cids['g'].to_numpy(), kind='stable' )
+        cidbounds = numpy.searchsorted( cids['g'].to_numpy()[ order ], numpy.arange( ntier * nstrat + 1 ) )
+        cidvals = cids['CID'].to_numpy()[ order ]
 
-                for band in [ 'Z', 'Y', 'J', 'H' ]:
-                    magstr = f'{band}_mag_syn'
-                    errstr = f'{band}_magerr_syn'
+        spectiercids = {}
+        for tier in spectiers:
+            spectiercids[ tier ] = []
+            for strati in range( nstrat ):
+                i = tierindex[ tier ] * nstrat + strati
+                # Explicitly convert to int just in case it's a string,
+                #   which I've seen for ids in SNANA sometimes
+                thesecids = []
+                for j in cidvals[ cidbounds[i] : cidbounds[i+1] ]:
+                    try:
+                        thesecids.append( int(j) )
+                    except ( TypeError, ValueError ) as ex:
+                        raise RuntimeError( f"Can't convert CID {j!r} (tier {tier}, spectrum strategy {strati}) "
+                                            f"in {specfile} to an int" ) from ex
+                spectiercids[ tier ].append( thesecids )
 
-                    banddf = tierdf[ [ 'GENTYPE', 'zbin', 'tbin', 'trestbin', magstr, errstr ] ].copy()
-                    banddf['magbin'] = ( ( banddf[magstr] - mmin ) / deltam ).apply(int)
-                    banddf['snr'] = 2.5 / ( banddf[errstr] * 2.30258509299405 )
-                    banddf.loc[ banddf[errstr] <= 0., 'snr' ] = 0.
-                    banddf.loc[ banddf['snr'] > 20., 'snr' ] = 20.
-                    banddf['snrbin'] = ( ( banddf['snr'] - snrmin ) / deltasnr ).apply(int)
+        return hist, spectiercids
 
-                    obsdf = banddf.sort_values( [ 'GENTYPE', 'zbin', 'tbin', 'magbin', 'snrbin' ] )
-                    obsdf = obsdf.groupby( [ 'GENTYPE', 'zbin', 'tbin', 'magbin', 'snrbin' ] ).count()['snr']
-                    obsdf = obsdf.to_frame().reset_index()
-                    obsdf.rename( { 'snr': 'n' }, axis='columns', inplace=True )
+    def _sum_spec_counts( self, counts ):
+        """Add up a list of _bin_spec counts Series, returning one sorted Series."""
+        if len( counts ) == 1:
+            return counts[0]
+        counts = pandas.concat( counts )
+        return counts.groupby( level=list( range( counts.index.nlevels ) ), sort=True ).sum()
 
-                    restdf = banddf.sort_values( [ 'GENTYPE', 'zbin', 'trestbin', 'magbin', 'snrbin' ] )
-                    restdf = restdf.groupby( [ 'GENTYPE', 'zbin', 'trestbin', 'magbin', 'snrbin' ] ).count()['snr']
-                    restdf = restdf.to_frame().reset_index()
-                    restdf.rename( { 'snr': 'n' }, axis='columns', inplace=True )
+    def _bin_spec( self, specdf, binning ):
+        """Histogram one chunk of a .SPEC file, for _read_spec.
 
-                    stratdict[tier][band] = obsdf.to_dict( 'list' )
-                    stratdict[tier][f'{band}_restframe'] = restdf.to_dict( 'list' )
+        binning is the dict of tier numbers, texposes, strategies, and
+        bin edges that _read_spec sets up.
 
-            specstrat.append( stratdict )
+        Returns tiers, counts, cids.  tiers are the FIELDs of specdf in
+        order of appearance.  counts is a Series of the number of rows in
+        each ( strat, tier, band, frame, GENTYPE, zbin, tbin, magbin,
+        snrbin ) bin, sorted by that index.  cids is a DataFrame of the
+        distinct ( g = tier * nstrat + strat, CID ), in order of
+        appearance.
 
-        hist[ 'spectrumhists' ] = specstrat
+        """
+        tierindex = binning['tierindex']
+        texposes = binning['texposes']
+        npairstrats = binning['npairstrats']
+        pairoffset = binning['pairoffset']
+        pairstratflat = binning['pairstratflat']
+        nstrat = binning['nstrat']
 
-        spectiercids = {}
-        for tier in specdf['FIELD'].unique():
-            tiersentry = None
-            for ent in tiers:
-                if ent['name'] == tier:
-                    tiersentry = ent
-                    break
-            else:
-                # This should never happen; exception would have been raised before.
+        spectiers = specdf['FIELD'].unique()
+        for tier in spectiers:
+            if tier not in tierindex:
                 raise RuntimeError( f"Tier {tier} in specdf is not in tiers." )
 
-            spectiercids[ tier ] = []
-            for i, specstrat in enumerate( range(ntexpose) ):
-                # I'm going to be doing a float comparison for texpose, which is scary.
-                #   However, I expect these floating point numbers to all be integers,
-                #   and 32-bit floats can perfectly represent integers up to 2^23-1,
-                #   or 8388607, and no exposure time will ever be that long.
-                texpose = tiersentry['texpose_prism'][i]
-                # Explicitly convert to int just in case it's a string,
-                #   which I've seen for ids in SNANA sometimes
-                try:
-                    spectiercids[ tier ].append( [ int(j) for j in
-                                                   list( specdf[ ( specdf['FIELD'] == tier ) &
-                                                                 ( specdf['TEXPOSE'] == texpose ) ]['CID']
-                                                         .unique() ) ] )
-                except Exception as ex:
-                    import pdb; pdb.set_trace()
-                    pass
+        # Expand specdf to one row per ( spectrum, strategy ) it's in, in the order of specdf
+        rowtier = numpy.array( [ tierindex[ tier ] for tier in spectiers ],
+                               dtype=numpy.int64 )[ pandas.Index( spectiers ).get_indexer( specdf['FIELD'] ) ]
+        rowtexpose = texposes.get_indexer( specdf['TEXPOSE'].to_numpy( dtype=numpy.float64 ) )
+        rowpair = numpy.where( rowtexpose >= 0, rowtier * len( texposes ) + rowtexpose, -1 )
+        nrep = npairstrats[ rowpair ]
+        rows = numpy.repeat( numpy.arange( len( specdf ) ), nrep )
+        within = numpy.arange( len( rows ) ) - numpy.repeat( numpy.cumsum( nrep ) - nrep, nrep )
+        strat = pairstratflat[ pairoffset[ rowpair[ rows ] ] + within ]
+        tieri = rowtier[ rows ]
+
+        def tobin( x, lo, delta ):
+            # Same as .apply( int ), which truncates, and fails on NaN or infinity
+            x = ( x - lo ) / delta
+            if not numpy.all( numpy.isfinite( x ) ):
+                raise ValueError( "Non-finite value in spectrum histogram bin" )
+            return numpy.trunc( x ).astype( numpy.int64 )
+
+        zhel = specdf['zHEL'].to_numpy( dtype=numpy.float64 )[ rows ]
+        tobs = specdf['TOBS'].to_numpy( dtype=numpy.float64 )[ rows ]
+        gentype = specdf['GENTYPE'].to_numpy()[ rows ]
+        zbin = tobin( zhel, *binning['z'] )
+        tbin = tobin( tobs, *binning['t'] )
+        trestbin = tobin( tobs / ( 1 + zhel ), *binning['t'] )
+
+        # Long form: one row per ( spectrum, strategy, band, frame )
+        bands = [ 'Z', 'Y', 'J', 'H' ]
+        longcols = { 'strat': [], 'tier': [], 'band': [], 'frame': [], 'GENTYPE': [], 'zbin': [], 'tbin': [],
+                     'magbin': [], 'snrbin': [] }
+        for bandi, band in enumerate( bands ):
+            mag = specdf[ f'{band}_mag_syn' ].to_numpy( dtype=numpy.float64 )[ rows ]
+            err = specdf[ f'{band}_magerr_syn' ].to_numpy( dtype=numpy.float64 )[ rows ]
+            with numpy.errstate( divide='ignore' ):
+                snr = 2.5 / ( err * 2.30258509299405 )
+            snr[ err <= 0. ] = 0.
+            snr[ snr > 20. ] = 20.
+            magbin = tobin( mag, *binning['m'] )
+            snrbin = tobin( snr, *binning['snr'] )
+            for frame, t in enumerate( ( tbin, trestbin ) ):
+                longcols['strat'].append( strat )
+                longcols['tier'].append( tieri )
+                longcols['band'].append( numpy.full( len( rows ), bandi ) )
+                longcols['frame'].append( numpy.full( len( rows ), frame ) )
+                longcols['GENTYPE'].append( gentype )
+                longcols['zbin'].append( zbin )
+                longcols['tbin'].append( t )
+                longcols['magbin'].append( magbin )
+                longcols['snrbin'].append( snrbin )
+        longdf = pandas.DataFrame( { k: numpy.concatenate( v ) for k, v in longcols.items() } )
+        counts = longdf.groupby( list( longcols.keys() ), sort=True ).size()
+
+        cids = pandas.DataFrame( { 'g': tieri * nstrat + strat, 'CID': specdf['CID'].to_numpy()[ rows ] } )
+        cids = cids.drop_duplicates()
+
+        return spectiers, counts, cids
+
+
+    def _write_pool( self, collection, survey_version ):
+        """Write a pool of pre-drawn random objects for one sim.
+
+        For each ( gentype, z_CMB bin, tier ), up to self.poolsize objects
+        are drawn and their light curves stored; for each ( gentype, z_CMB
+        bin, tier, spectrum exposure time ), up to self.poolsize objects
+        that have spectra with that exposure time are drawn, and all of
+        those spectra stored.  The z bins are self.poolzbin wide.  The
+        webserver's /randomltcv and /randomspectrum answer from the pool
+        when they can, so they don't have to read the sim's FITS files.
+
+        Writes {outdir}/{collection}_pools/{survey_version}.npz, with arrays:
+
+          version, zbinwidth, tiers (names; tier codes below index this,
+          -1 means not in the DUMP file), headfiles (names of the sim's
+          HEAD files; fileid indexes this)
+
+          lc_* : one entry per pooled light curve; lc_snid, lc_gentype,
+            lc_zcmb, lc_mwebv, lc_av, lc_rv, lc_tier, lc_zbin, lc_fileid,
+            lc_weight (the number of objects in the sim each pooled
+            object stands for), lc_complete (True if the object's bin
+            was small enough that all of its objects are in the pool),
+            lc_start (len+1; the object's observations are
+            obs_*[ lc_start[i] : lc_start[i+1] ])
+
+          obs_* : obs_mjd, obs_band, obs_flux, obs_dflux (FLUXCAL, FLUXCALERR)
+
+          sp_* : one entry per pooled spectrum, grouped by object;
+            sp_obj (same value for spectra of the same pooled object),
+            sp_snid, sp_gentype, sp_zcmb, sp_mwebv, sp_av, sp_rv,
+            sp_tier, sp_zbin, sp_fileid, sp_ptrobs_min, sp_ptrobs_max,
+            sp_weight, sp_complete (per object, as for lc_*),
+            sp_texpose, sp_dt_obs, sp_dt_rest, sp_nbin_lam,
+            sp_host_contam, sp_ptrspec_min, sp_ptrspec_max, sp_start
+            (len+1; the spectrum is lam_*[ sp_start[i] : sp_start[i+1] ])
+
+          lam_* : lam_min, lam_max, lam_flam, lam_flamerr, lam_sim_flam
+            (F_λ and its uncertainties are ×10²⁰)
+
+        The pool is drawn with a random number generator seeded with
+        self.poolseed, so re-running the ingest on the same sim gives
+        the same pool.
 
+        """
+        if fits is None:
+            raise RuntimeError( "Writing object pools requires astropy" )
 
-        return hist, spectiercids
+        self._get_snana_scratchdir( collection )
+        sndatadir = self.snana_scratchdir[collection] / survey_version
+        rng = numpy.random.default_rng( self.poolseed )
+
+        # Every object in the sim
+
+        headcols = { 'snid': 'SNID', 'gentype': 'SIM_GENTYPE', 'zcmb': 'SIM_REDSHIFT_CMB',
+                     'zhel': 'SIM_REDSHIFT_HELIO', 'peakmjd': 'SIM_PEAKMJD', 'ptrobs_min': 'PTROBS_MIN',
+                     'ptrobs_max': 'PTROBS_MAX', 'mwebv': 'SIM_MWEBV', 'av': 'SIM_AV', 'rv': 'SIM_RV' }
+        headfiles = sorted( sndatadir.glob( "*_HEAD.FITS.gz" ) )
+        objs = { k: [] for k in headcols.keys() }
+        objs['fileid'] = []
+        for fileid, headfile in enumerate( headfiles ):
+            with fits.open( headfile ) as f:
+                for k, col in headcols.items():
+                    objs[k].append( numpy.asarray( f[1].data[col] ) )
+                objs['fileid'].append( numpy.full( len( f[1].data ), fileid, dtype=numpy.int32 ) )
+        objs = { k: numpy.concatenate( v ) for k, v in objs.items() }
+        objs['zbin'] = numpy.floor( objs['zcmb'] / self.poolzbin ).astype( numpy.int32 )
 
+        tiers = []
+        objs['tier'] = numpy.full( len( objs['snid'] ), -1, dtype=numpy.int16 )
+        dumpfile = self._find_table( sndatadir / f'{survey_version}.DUMP' )
+        if dumpfile is not None:
+            dump = pandas.concat( [ chunk[ [ 'FIELD', 'CID' ] ] for chunk in self._read_table( dumpfile ) ],
+                                  ignore_index=True )
+            tiers = sorted( dump['FIELD'].unique() )
+            tiercode = pandas.Series( numpy.searchsorted( tiers, dump['FIELD'].values ).astype( numpy.int16 ),
+                                      index=dump['CID'].values.astype( numpy.int64 ) )
+            tiercode = tiercode[ ~tiercode.index.duplicated() ]
+            objs['tier'] = tiercode.reindex( objs['snid'].astype( numpy.int64 ) ).fillna( -1 ).values.astype( numpy.int16 )
+
+        pool = { 'version': numpy.int32( 1 ),
+                 'zbinwidth': numpy.float64( self.poolzbin ),
+                 'tiers': numpy.array( [ str(t) for t in tiers ], dtype=str ),
+                 'headfiles': numpy.array( [ h.name for h in headfiles ] ) }
+
+        # Light curves
+
+        rows, weight, complete = self._draw_pool( rng, objs['gentype'], objs['zbin'], objs['tier'] )
+        rows, weight, complete = self._sort_by_file( objs['fileid'], rows, weight, complete )
+        for k in [ 'snid', 'gentype', 'zcmb', 'mwebv', 'av', 'rv', 'tier', 'zbin', 'fileid' ]:
+            pool[ f'lc_{k}' ] = objs[k][rows]
+        pool['lc_weight'] = weight
+        pool['lc_complete'] = complete
+
+        obs = { 'mjd': [], 'band': [], 'flux': [], 'dflux': [] }
+        nobs = []
+        for fileid in numpy.unique( objs['fileid'][rows] ):
+            photfile = sndatadir / headfiles[fileid].name.replace( '_HEAD.FITS.gz', '_PHOT.FITS.gz' )
+            with fits.open( photfile ) as f:
+                phot = f[1].data
+                for row in rows[ objs['fileid'][rows] == fileid ]:
+                    ltcv = phot[ objs['ptrobs_min'][row] - 1 : objs['ptrobs_max'][row] ]
+                    obs['mjd'].append( numpy.asarray( ltcv['MJD'], dtype=numpy.float64 ) )
+                    obs['band'].append( numpy.asarray( ltcv['BAND'] ).astype( str ) )
+                    obs['flux'].append( numpy.asarray( ltcv['FLUXCAL'], dtype=numpy.float32 ) )
+                    obs['dflux'].append( numpy.asarray( ltcv['FLUXCALERR'], dtype=numpy.float32 ) )
+                    nobs.append( len( ltcv ) )
+        for k, v in obs.items():
+            pool[ f'obs_{k}' ] = numpy.concatenate( v ) if len(v) > 0 else numpy.array( [] )
+        pool['lc_start'] = numpy.concatenate( [ [ 0 ], numpy.cumsum( nobs, dtype=numpy.int64 ) ] )
+
+        # Spectra
+
+        speccols = { 'snid': 'SNID', 'mjd': 'MJD', 'texpose': 'Texpose', 'nbin_lam': 'NBIN_LAM',
+                     'host_contam': 'SCALE_HOST_CONTAM', 'ptrspec_min': 'PTRSPEC_MIN',
+                     'ptrspec_max': 'PTRSPEC_MAX' }
+        specs = { k: [] for k in speccols.keys() }
+        specs['objrow'] = []
+        for fileid, headfile in enumerate( headfiles ):
+            specfile = sndatadir / headfile.name.replace( '_HEAD.FITS.gz', '_SPEC.FITS' )
+            if not specfile.is_file():
+                continue
+            with fits.open( specfile ) as f:
+                for k, col in speccols.items():
+                    specs[k].append( numpy.asarray( f[1].data[col] ) )
+            filerows = numpy.nonzero( objs['fileid'] == fileid )[0]
+            order = numpy.argsort( objs['snid'][filerows], kind='stable' )
+            pos = numpy.searchsorted( objs['snid'][filerows][order], specs['snid'][-1] )
+            pos[ pos >= len(order) ] = 0
+            objrow = filerows[ order[ pos ] ] if len(order) > 0 else numpy.zeros( len(pos), dtype=numpy.int64 )
+            if ( ( len(order) == 0 ) and ( len(pos) > 0 ) ) or numpy.any( objs['snid'][objrow] != specs['snid'][-1] ):
+                raise RuntimeError( f"{specfile.name} has spectra of objects that aren't in {headfile.name}" )
+            specs['objrow'].append( objrow )
+        if len( specs['snid'] ) > 0:
+            specs = { k: numpy.concatenate( v ) for k, v in specs.items() }
+        else:
+            specs = { k: numpy.array( [], dtype=numpy.int64 ) for k in specs.keys() }
+
+        # Draw objects within each ( gentype, zbin, tier, texpose ), then keep all of their spectra there
+        texposes, texcode = numpy.unique( specs['texpose'].astype( numpy.float32 ), return_inverse=True )
+        strata, stratum = numpy.unique( numpy.stack( [ specs['objrow'].astype( numpy.int64 ), texcode ] ),
+                                        axis=1, return_inverse=True )
+        stratum = stratum.ravel()
+        objrows = strata[0]
+        drawn, weight, complete = self._draw_pool( rng, objs['gentype'][objrows], objs['zbin'][objrows],
+                                                   objs['tier'][objrows], strata[1] )
+        poolobj = numpy.full( strata.shape[1], -1, dtype=numpy.int64 )
+        poolobj[ drawn ] = numpy.arange( len( drawn ) )
+        specpoolobj = poolobj[ stratum ]
+        dexes = numpy.nonzero( specpoolobj >= 0 )[0]
+        dexes = dexes[ numpy.argsort( specpoolobj[dexes], kind='stable' ) ]
+        rows = specs['objrow'][dexes]
+
+        pool['sp_obj'] = specpoolobj[dexes]
+        for k in [ 'snid', 'gentype', 'zcmb', 'mwebv', 'av', 'rv', 'tier', 'zbin', 'fileid',
+                   'ptrobs_min', 'ptrobs_max' ]:
+            pool[ f'sp_{k}' ] = objs[k][rows]
+        pool['sp_weight'] = weight[ pool['sp_obj'] ]
+        pool['sp_complete'] = complete[ pool['sp_obj'] ]
+        for k in [ 'texpose', 'nbin_lam', 'host_contam', 'ptrspec_min', 'ptrspec_max' ]:
+            pool[ f'sp_{k}' ] = specs[k][dexes]
+        pool['sp_dt_obs'] = specs['mjd'][dexes] - objs['peakmjd'][rows]
+        pool['sp_dt_rest'] = pool['sp_dt_obs'] / ( 1. + objs['zhel'][rows] )
+
+        lamcols = { 'min': 'LAMMIN', 'max': 'LAMMAX', 'flam': 'FLAM', 'flamerr': 'FLAMERR', 'sim_flam': 'SIM_FLAM' }
+        lam = { k: [ None ] * len( dexes ) for k in lamcols.keys() }
+        for fileid in numpy.unique( pool['sp_fileid'] ):
+            specfile = sndatadir / headfiles[fileid].name.replace( '_HEAD.FITS.gz', '_SPEC.FITS' )
+            with fits.open( specfile ) as f:
+                for i in numpy.nonzero( pool['sp_fileid'] == fileid )[0]:
+                    spec = f[2].data[ pool['sp_ptrspec_min'][i] - 1 : pool['sp_ptrspec_max'][i] ]
+                    for k, col in lamcols.items():
+                        scale = 1. if k in ( 'min', 'max' ) else 1e20
+                        lam[k][i] = ( spec[col] * scale ).astype( numpy.float32 )
+        for k, v in lam.items():
+            pool[ f'lam_{k}' ] = numpy.concatenate( v ) if len(v) > 0 else numpy.array( [], dtype=numpy.float32 )
+        pool['sp_start'] = numpy.concatenate( [ [ 0 ], numpy.cumsum( [ len(x) for x in lam['min'] ],
+                                                                     dtype=numpy.int64 ) ] )
+
+        pooldir = self.outdir / f'{collection}_pools'
+        pooldir.mkdir( exist_ok=True )
+        path = pooldir / f'{survey_version}.npz'
+        tmppath = pooldir / f'.{survey_version}.npz.tmp'
+        with open( tmppath, 'wb' ) as ofp:
+            numpy.savez( ofp, **pool )
+        os.replace( tmppath, path )
+        _logger.debug( f"Wrote {path} ({len(pool['lc_snid'])} light curves, {len(pool['sp_snid'])} spectra)" )
+
+    def _draw_pool( self, rng, *keys ):
+        """Draw up to self.poolsize items from each group of items with the same keys.
+
+        keys are arrays with one element per item.  Returns drawn, weight,
+        complete: the indexes of the drawn items, the number of items
+        each one stands for (the group size over the number drawn), and
+        whether all of the group was drawn.
+
+        """
+        if len( keys[0] ) == 0:
+            return numpy.array( [], dtype=numpy.int64 ), numpy.array( [] ), numpy.array( [], dtype=bool )
+        order = numpy.lexsort( keys[::-1] )
+        groupkeys = numpy.stack( [ numpy.asarray( k )[order] for k in keys ] )
+        starts = numpy.nonzero( numpy.any( groupkeys[:, 1:] != groupkeys[:, :-1], axis=0 ) )[0] + 1
+        starts = numpy.concatenate( [ [ 0 ], starts, [ len(order) ] ] )
+        drawn = []
+        weight = []
+        complete = []
+        for lo, hi in zip( starts[:-1], starts[1:] ):
+            ndraw = min( self.poolsize, hi - lo )
+            drawn.append( order[ lo + rng.choice( hi - lo, size=ndraw, replace=False ) ] )
+            weight.append( numpy.full( ndraw, ( hi - lo ) / ndraw ) )
+            complete.append( numpy.full( ndraw, ndraw == hi - lo ) )
+        return numpy.concatenate( drawn ), numpy.concatenate( weight ), numpy.concatenate( complete )
+
+    @staticmethod
+    def _sort_by_file( fileid, rows, *arrs ):
+        """Sort rows (and arrays that go with them) by fileid[rows], so files are read in order."""
+        order = numpy.argsort( fileid[rows], kind='stable' )
+        return ( rows[order], ) + tuple( a[order] for a in arrs )
 
     def read_files( self, collection, snana_outdir, regen=False, savecache=True, clobber=False ):
         """Load information from a single survey collection.
@@ -664,6 +1112,8 @@ class RomanSurveySummary:
                                    'spechists': { <see _read_spec> },
                                    'gentypemap' : { gentype: name, ... },
                                    'long_survey_version' : <str>,
+                                   'gridindex' : [ ai, ti, zi ],  # indexes into the tiers'
+                                                                  #   relarea, dt_visit, z_snrmatch
                                    'muopt': [ { 'name': str,
                                                 'idsurvey_select': int,
                                                  (bunch of cosmology keys, including 'FoM_stat') }
@@ -673,14 +1123,46 @@ class RomanSurveySummary:
              'spectiercids': { survey_name: { see _read_spec} },
            }
 
+        If savecache is True, in addition to the {collection}_{structure}.json
+        files, writes {collection}_surveyindex.json and a shard file for
+        each sim; see _write_shards.  If also self.poolsize > 0, writes
+        a pool of random objects for each sim; see _write_pool.
+
+        The sims are independent of each other; if self.jobs > 1, they're
+        read in a pool of that many processes.  Either way, a sim that
+        fails is logged and left out of surveys.
+
         The zhist thingies are set up to be easy to convert to a Pandas dataframe.
 
+        """
+        prep = self._prepare_collection( collection, snana_outdir, clobber=clobber, regen=regen )
+        if self.jobs == 1:
+            for i, sim in enumerate( prep['sims'] ):
+                if prep['results'][i] is None:
+                    prep['results'][i] = self._try_read_sim( collection, *sim, prep['tiers'],
+                                                             prep['analysisinfo']['prescales'], savecache )
+        elif any( r is None for r in prep['results'] ):
+            with self._ingest_pool() as pool:
+                self._collect_sims( pool, prep, self._submit_sims( pool, prep, savecache ) )
+        self._finish_collection( prep, savecache=savecache )
+
+    def _prepare_collection( self, collection, snana_outdir, clobber=False, regen=False ):
+        """First part of read_files: read the collection-wide files and list the sims.
+
+        Returns a dict with collection, snana_outdir, surveyinfo,
+        instrinfo, analysisinfo, tiers, sims, results, and manifest.  sims
+        is a list of ( short_survey_version, survey_version, simlib_file,
+        gridindex ), one for each sim, in the order the sims go into the
+        surveys dict.  results has, for each sim, what _try_read_sim
+        returns; it's filled in here for sims that can be reused from the
+        last ingest (see _reuse_sim), and is None for the others.
+        manifest is the new {collection}_manifest.json (see
+        _write_manifest), with entries for all of the sims.
+
         """
         if ( not clobber ) and ( collection in self.collections.keys() ):
             raise RuntimeError( f"Not clobbering collection {collection}" )
 
-        # TODO read cache
-
         snana_outdir = pathlib.Path( snana_outdir ).resolve()
 
         # Read the INP, ANALYSIS_INSTRUCTIONS.README, and OUTPUT1 files
@@ -701,10 +1183,9 @@ class RomanSurveySummary:
                 elif surveyparamlens[var] != len( tier[var] ):
                     raise ValueError( f"The number of {var} is not the same for all tiers." )
 
-        # Start building the individual surveys
+        # Figure out the individual surveys
 
-        surveys = {}
-        spectiercids = {}
+        sims = []
         for ai, relarea in enumerate( tiers[0]['relarea'] ):
             for ti, dt_visit in enumerate( tiers[0]['dt_visit'] ):
                 for zi, z_snrmatch in enumerate( tiers[0]['z_snrmatch'] ):
@@ -721,30 +1202,289 @@ class RomanSurveySummary:
                     else:
                         short_survey_version = survey_version
                     simlib_file = snana_outdir / subdf.iloc[0].SIMLIB_FILE
+                    sims.append( ( short_survey_version, survey_version, simlib_file, [ ai, ti, zi ] ) )
+
+        # See what can be reused from the last ingest
+
+        oldmanifest = None if regen else self._read_manifest( collection )
+        oldspectiercids = ( None if oldmanifest is None
+                            else self._read_json( self.outdir / f'{collection}_spectiercids.json' ) )
+        manifest = { 'version': self.manifest_version,
+                     'settings': self._ingest_settings(),
+                     'collection': { 'inputs': self._stat_inputs( self._collection_inputs( snana_outdir ),
+                                                                  None if oldmanifest is None
+                                                                  else oldmanifest['collection']['inputs'] ) },
+                     'sims': {} }
+        if ( oldmanifest is not None ) and ( manifest['collection'] != oldmanifest['collection'] ):
+            _logger.info( f"Collection-wide inputs of {collection} have changed" )
+        reusable = oldmanifest is not None
+        if reusable and ( oldmanifest.get( 'settings' ) != manifest['settings'] ):
+            oldsettings = oldmanifest.get( 'settings' ) or {}
+            changed = [ k for k in manifest['settings'] if oldsettings.get( k ) != manifest['settings'][k] ]
+            _logger.info( f"Ingest settings ({', '.join(changed)}) have changed since the last ingest of "
+                          f"{collection}, reading every sim again" )
+            reusable = False
+        results = []
+        for sim in sims:
+            oldentry = oldmanifest['sims'].get( sim[0] ) if reusable else None
+            entry = self._sim_manifest_entry( collection, *sim, tiers, analysisinfo['prescales'],
+                                              None if oldentry is None else oldentry['inputs'] )
+            manifest['sims'][ sim[0] ] = entry
+            results.append( None if oldentry is None
+                            else self._reuse_sim( collection, sim, entry, oldentry, oldspectiercids ) )
+        nreused = sum( r is not None for r in results )
+        if nreused > 0:
+            _logger.info( f"Reusing {nreused} of {len(sims)} sims of {collection} from the last ingest" )
+
+        return { 'collection': collection,
+                 'snana_outdir': snana_outdir,
+                 'surveyinfo': surveyinfo,
+                 'instrinfo': instrinfo,
+                 'analysisinfo': analysisinfo,
+                 'tiers': tiers,
+                 'sims': sims,
+                 'results': results,
+                 'manifest': manifest }
+
+    # ----------------------------------------------------------------------
+    # The manifest.
+    #
+    # {outdir}/{collection}_manifest.json records, for each sim that was
+    #   ingested successfully, the files that went into it (the SIMLIB,
+    #   README, DUMP and SPEC files, plus the sim's FITS files if pools
+    #   are written) and a digest of everything else its results depend
+    #   on (tiers, prescales, pool parameters, ...).  The next ingest
+    #   reuses the sim's shard instead of reading the sim again if all of
+    #   those are the same, so re-running on a campaign that has had a
+    #   few sims added only reads the new sims.  It also records the
+    #   collection-wide inputs (INP, ANALYSIS_INSTRUCTIONS.README, BBC
+    #   FITRES); those are re-read on every ingest anyway, which is cheap.
+    #
+    # A file counts as unchanged if its size and mtime are the same, or,
+    #   if self.hashinputs is set, if its size and sha1 are the same.
+    #
+    # The manifest also records the ingest settings (see _ingest_settings)
+    #   that every sim's results depend on, along with ingest_version.
+    #   If any of those differ from the last ingest, no sim is reused.
+    #   Bump ingest_version whenever a change to this code changes what
+    #   it writes for a sim (histogram binning, tier selection, pool
+    #   contents, ...); manifest_version is only for the layout of the
+    #   manifest itself.
+
+    manifest_version = 1
+    ingest_version = 1
+
+    def _read_json( self, path ):
+        try:
+            with open( path ) as ifp:
+                return json.load( ifp )
+        except FileNotFoundError:
+            return None
+
+    def _read_manifest( self, collection ):
+        manifest = self._read_json( self.outdir / f'{collection}_manifest.json' )
+        if ( manifest is not None ) and ( manifest.get( 'version' ) != self.manifest_version ):
+            _logger.info( f"Ignoring {collection}_manifest.json, it's from a different version of this code" )
+            return None
+        return manifest
+
+    def _ingest_settings( self ):
+        """Return the settings the results of every sim depend on, as they'd come back out of the manifest."""
+        settings = { 'ingest_version': self.ingest_version,
+                     'snrmaxcut': self.snrmaxcut,
+                     'zhistbins': self.zhistbins,
+                     'poolsize': self.poolsize,
+                     'poolzbin': self.poolzbin if self.poolsize > 0 else None,
+                     'poolseed': self.poolseed if self.poolsize > 0 else None }
+        return json.loads( json.dumps( settings, cls=NumpyEncoder ) )
+
+    def _write_manifest( self, collection, manifest ):
+        path = self.outdir / f'{collection}_manifest.json'
+        tmppath = self.outdir / f'.{collection}_manifest.json.tmp'
+        with open( tmppath, 'w' ) as ofp:
+            json.dump( manifest, ofp, indent=1, cls=NumpyEncoder )
+        os.replace( tmppath, path )
+
+    @staticmethod
+    def _sha1( path ):
+        sha1 = hashlib.sha1()
+        with open( path, 'rb' ) as ifp:
+            for chunk in iter( lambda: ifp.read( 16 * 1024 * 1024 ), b'' ):
+                sha1.update( chunk )
+        return sha1.hexdigest()
+
+    def _stat_inputs( self, paths, old=None ):
+        """Return { path: { 'size', 'mtime_ns', ['sha1'] } or None (if the file doesn't exist) } for paths.
+
+        If self.hashinputs, the sha1 of each file is included; it's
+        copied from old (a previous return value) if the file's size and
+        mtime haven't changed, rather than recomputed.
 
-                    _logger.debug( f"Processing {survey_version} ({simlib_file})" )
+        """
+        old = {} if old is None else old
+        inputs = {}
+        for path in paths:
+            path = str( path )
+            try:
+                st = os.stat( path )
+            except FileNotFoundError:
+                inputs[ path ] = None
+                continue
+            ent = { 'size': st.st_size, 'mtime_ns': st.st_mtime_ns }
+            if self.hashinputs:
+                prev = old.get( path )
+                if ( prev is not None ) and ( 'sha1' in prev ) and ( prev['size'] == ent['size'] ) and \
+                   ( prev['mtime_ns'] == ent['mtime_ns'] ):
+                    ent['sha1'] = prev['sha1']
+                else:
+                    ent['sha1'] = self._sha1( path )
+            inputs[ path ] = ent
+        return inputs
+
+    @staticmethod
+    def _same_inputs( new, old ):
+        if set( new.keys() ) != set( old.keys() ):
+            return False
+        for path, ent in new.items():
+            prev = old[ path ]
+            if ( ent is None ) or ( prev is None ):
+                if ( ent is not None ) or ( prev is not None ):
+                    return False
+            elif ent['size'] != prev['size']:
+                return False
+            elif ( 'sha1' in ent ) and ( 'sha1' in prev ):
+                if ent['sha1'] != prev['sha1']:
+                    return False
+            elif ent['mtime_ns'] != prev['mtime_ns']:
+                return False
+        return True
+
+    def _collection_inputs( self, snana_outdir ):
+        return ( sorted( snana_outdir.glob( "INP*" ) ) + [ snana_outdir / "ANALYSIS_INSTRUCTIONS.README" ]
+                 + sorted( f / 'BBC_SUMMARY_wfit0.FITRES' for f in snana_outdir.glob( "OUTPUT3*" ) ) )
+
+    def _sim_inputs( self, collection, survey_version, simlib_file ):
+        """The files that _read_sim reads for one sim (both with and without .gz, where either may be used)."""
+        self._get_snana_scratchdir( collection )
+        sndatadir = self.snana_scratchdir[collection] / survey_version
+        simlib_file = pathlib.Path( simlib_file )
+        paths = [ simlib_file, simlib_file.parent / f'{simlib_file.name}.gz' ]
+        for suffix in ( 'README', 'DUMP', 'DUMP.gz', 'SPEC', 'SPEC.gz' ):
+            paths.append( sndatadir / f'{survey_version}.{suffix}' )
+        if self.poolsize > 0:
+            paths.extend( sorted( sndatadir.glob( '*.FITS*' ) ) )
+        return paths
+
+    def _sim_manifest_entry( self, collection, short_survey_version, survey_version, simlib_file, gridindex,
+                             tiers, prescales, oldinputs=None ):
+        params = [ collection, short_survey_version, survey_version, str( simlib_file ), gridindex,
+                   tiers, prescales, self.snrmaxcut, self.zhistbins,
+                   [ self.poolsize, self.poolzbin, self.poolseed ] if self.poolsize > 0 else None ]
+        digest = hashlib.sha1( json.dumps( params, sort_keys=True, cls=NumpyEncoder ).encode( 'utf-8' ) )
+        try:
+            inputs = self._stat_inputs( self._sim_inputs( collection, survey_version, simlib_file ), oldinputs )
+        except Exception as ex:
+            # _read_sim will fail too, and log why
+            inputs = { 'error': str(ex) }
+        return { 'params': digest.hexdigest(), 'inputs': inputs }
+
+    def _reuse_sim( self, collection, sim, entry, oldentry, oldspectiercids ):
+        """Return the last ingest's survey, spectiercids for sim if nothing it depends on has changed, else None."""
+        short_survey_version, survey_version = sim[0], sim[1]
+        if ( entry['params'] != oldentry['params'] ) or ( 'error' in entry['inputs'] ) \
+           or ( not self._same_inputs( entry['inputs'], oldentry['inputs'] ) ):
+            return None
+        if ( oldspectiercids is None ) or ( short_survey_version not in oldspectiercids ):
+            return None
+        if ( self.poolsize > 0 ) and \
+           ( not ( self.outdir / f'{collection}_pools' / f'{survey_version}.npz' ).is_file() ):
+            return None
+        survey = self._read_json( self.outdir / f'{collection}_sims' / f'{survey_version}.json' )
+        if survey is None:
+            return None
+        return survey, oldspectiercids[ short_survey_version ]
+
+    def _read_sim( self, collection, short_survey_version, survey_version, simlib_file, gridindex,
+                   tiers, prescales, savecache ):
+        """Read everything for one sim.  Returns survey, spectiercids (see read_files)."""
+        _logger.debug( f"Processing {survey_version} ({simlib_file})" )
+
+        survey = self._read_simlib_doc( simlib_file, tiers )
+        ( gentypemap, zhist, snrmaxzhist,
+          snrmax2zhist, snrmax3zhist ) = self._read_dump( collection, survey_version, prescales )
+        survey['gentypemap'] = gentypemap
+        survey['zhist'] = zhist
+        survey['snrmaxzhist'] = snrmaxzhist
+        survey['snrmax2zhist'] = snrmax2zhist
+        survey['snrmax3zhist'] = snrmax3zhist
+        survey['long_survey_version'] = survey_version
+        survey['gridindex'] = gridindex
+        spechists, spectiercids = self._read_spec( collection, survey_version, tiers )
+        survey['spechists'] = spechists
+        if savecache and ( self.poolsize > 0 ):
+            # The pool only saves the webserver a search of the sim, so a
+            #   failure to write it doesn't lose the sim.  Don't leave an
+            #   old pool behind for the server to answer from, though.
+            try:
+                self._write_pool( collection, survey_version )
+            except Exception as ex:
+                _logger.warning( f"Failed to write the object pool for {survey_version}, "
+                                 f"the webserver will search the sim instead: {ex}" )
+                try:
+                    ( self.outdir / f'{collection}_pools' / f'{survey_version}.npz' ).unlink()
+                except FileNotFoundError:
+                    pass
+        return survey, spectiercids
+
+    def _try_read_sim( self, collection, short_survey_version, *args ):
+        """_read_sim, but logs the exception and returns None if anything goes wrong."""
+        try:
+            return self._read_sim( collection, short_survey_version, *args )
+        except Exception as ex:
+            strio = io.StringIO()
+            strio.write( f"Failed to get survey info for {short_survey_version}; Exception: " )
+            traceback.print_exc( file=strio )
+            _logger.error( strio.getvalue() )
+            return None
+
+    def _ingest_pool( self ):
+        """An _IngestPool of self.jobs workers, each with its own copy of this object (minus collections)."""
+        worker = copy.copy( self )
+        worker.collections = {}
+        return _IngestPool( self.jobs, worker )
+
+    def _submit_sims( self, pool, prep, savecache ):
+        """Submit the sims of a collection from _prepare_collection that weren't reused to pool.
+
+        Returns { index into prep['sims']: task } (see _IngestPool.submit)
 
-                    try:
-                        surveys[short_survey_version] = self._read_simlib_doc( simlib_file, tiers )
-                        ( gentypemap, zhist, snrmaxzhist,
-                          snrmax2zhist, snrmax3zhist ) = self._read_dump( collection, survey_version,
-                                                                          analysisinfo['prescales'] )
-                        surveys[short_survey_version]['gentypemap'] = gentypemap
-                        surveys[short_survey_version]['zhist'] = zhist
-                        surveys[short_survey_version]['snrmaxzhist'] = snrmaxzhist
-                        surveys[short_survey_version]['snrmax2zhist'] = snrmax2zhist
-                        surveys[short_survey_version]['snrmax3zhist'] = snrmax3zhist
-                        surveys[short_survey_version]['long_survey_version'] = survey_version
-                        spechists, this_spectiercids = self._read_spec( collection, survey_version, tiers )
-                        surveys[short_survey_version]['spechists'] = spechists
-                        spectiercids[short_survey_version] = this_spectiercids
-                    except Exception as ex:
-                        strio = io.StringIO()
-                        strio.write( f"Failed to get survey info for {short_survey_version}; Exception: " )
-                        traceback.print_exc( file=strio )
-                        _logger.error( strio.getvalue() )
-                        if short_survey_version in surveys.keys():
-                            del surveys[ short_survey_version ]
+        """
+        return { i: pool.submit( prep['collection'], *sim, prep['tiers'],
+                                 prep['analysisinfo']['prescales'], savecache )
+                 for i, sim in enumerate( prep['sims'] ) if prep['results'][i] is None }
+
+    def _collect_sims( self, pool, prep, tasks ):
+        """Put the results of the tasks from _submit_sims into prep['results'] (None for sims that failed)."""
+        for i, task in tasks.items():
+            prep['results'][i] = pool.result( task )
+
+    def _finish_collection( self, prep, savecache=True ):
+        """Last part of read_files: put together the sims, add the cosmology, and save.
+
+        prep['results'] has, for each sim in prep['sims'] (in the same
+        order), what _try_read_sim returned (or what was reused from the
+        last ingest).  Sims that failed (None) are left out.
+
+        """
+        collection = prep['collection']
+        snana_outdir = prep['snana_outdir']
+        analysisinfo = prep['analysisinfo']
+
+        surveys = {}
+        spectiercids = {}
+        for sim, result in zip( prep['sims'], prep['results'] ):
+            if result is not None:
+                surveys[ sim[0] ], spectiercids[ sim[0] ] = result
 
         # Get the cosmology and figure of merit from the BBC files
 
@@ -780,9 +1520,9 @@ class RomanSurveySummary:
         # Done
 
         self.collections[ collection ] = {
-            'surveyinfo': surveyinfo,
-            'tiers': tiers,
-            'instrinfo': instrinfo,
+            'surveyinfo': prep['surveyinfo'],
+            'tiers': prep['tiers'],
+            'instrinfo': prep['instrinfo'],
             'analysisinfo': analysisinfo,
             'surveys': surveys,
             'spectiercids': spectiercids
@@ -791,9 +1531,90 @@ class RomanSurveySummary:
         # Save to cache dir
 
         if savecache:
+            changed = False
             for attr in ( 'surveyinfo', 'tiers', 'instrinfo', 'analysisinfo', 'surveys', 'spectiercids' ):
-                with open( self.outdir / f'{collection}_{attr}.json', 'w' ) as ofp:
-                    json.dump( self.collections[collection][attr], ofp, cls=NumpyEncoder )
+                changed |= self._write_json( self.outdir / f'{collection}_{attr}.json',
+                                             self.collections[collection][attr] )
+            changed |= self._write_shards( collection )
+            if changed:
+                self._write_version_marker()
+            else:
+                _logger.info( f"Nothing in {collection} has changed since the last ingest" )
+            # Failed sims are left out, so the next ingest tries them again
+            manifest = dict( prep['manifest'] )
+            manifest['sims'] = { sim[0]: manifest['sims'][ sim[0] ]
+                                 for sim, result in zip( prep['sims'], prep['results'] ) if result is not None }
+            self._write_manifest( collection, manifest )
+
+    def _write_shards( self, collection ):
+        """Write the per-sim index and per-sim shards for a collection.
+
+        {collection}_surveyindex.json has, for each sim, everything in
+        that sim's entry of {collection}_surveys.json except for the
+        (big) histograms, plus a key 'shard' with the path (relative to
+        outdir) of the sim's shard file.
+
+        {collection}_sims/{long_survey_version}.json (the shard) has the
+        full entry of {collection}_surveys.json for a single sim.
+
+        Returns True if any file was (re)written.
+
+        """
+        sharddir = self.outdir / f'{collection}_sims'
+        sharddir.mkdir( exist_ok=True )
+        index = {}
+        changed = False
+        for sim, survey in self.collections[collection]['surveys'].items():
+            shard = sharddir / f"{survey['long_survey_version']}.json"
+            changed |= self._write_json( shard, survey )
+            index[ sim ] = { k: v for k, v in survey.items() if k not in self.heavy_survey_keys }
+            index[ sim ][ 'shard' ] = str( shard.relative_to( self.outdir ) )
+        changed |= self._write_json( self.outdir / f'{collection}_surveyindex.json', index )
+        return changed
+
+    def _write_version_marker( self ):
+        """Write {outdir}/DATA_VERSION, which tells running webservers that there's new data.
+
+        The webserver only notices new or changed collections when this
+        file changes, so it's written after everything else for a
+        collection.  It's replaced atomically.
+
+        """
+        marker = { 'written': time.strftime( '%Y-%m-%dT%H:%M:%SZ', time.gmtime() ),
+                   'collections': sorted( f.name[ :-len('_surveys.json') ]
+                                          for f in self.outdir.glob( '*_surveys.json' ) ) }
+        path = self.outdir / 'DATA_VERSION'
+        tmppath = self.outdir / '.DATA_VERSION.tmp'
+        with open( tmppath, 'w' ) as ofp:
+            json.dump( marker, ofp, indent=2 )
+        os.replace( tmppath, path )
+
+    def _write_json( self, path, obj ):
+        """Write obj to json file path, along with path.gz (and path.br, if brotli is installed) next to it.
+
+        The webserver serves the compressed files directly to clients that
+        accept those encodings.  They're written after the json file, so
+        they're never older than it.
+
+        If the files are already there with the same contents, they're
+        left alone (so the webserver's caches of things built from them
+        stay valid).  Returns True if the files were written.
+
+        """
+        body = json.dumps( obj, cls=NumpyEncoder ).encode( 'utf-8' )
+        variants = [ path.parent / f'{path.name}.gz' ] + ( [ path.parent / f'{path.name}.br' ]
+                                                            if brotli is not None else [] )
+        if path.is_file() and all( v.is_file() for v in variants ) and ( path.stat().st_size == len(body) ):
+            if path.read_bytes() == body:
+                return False
+        with open( path, 'wb' ) as ofp:
+            ofp.write( body )
+        with open( path.parent / f'{path.name}.gz', 'wb' ) as ofp:
+            ofp.write( gzip.compress( body, compresslevel=9 ) )
+        if brotli is not None:
+            with open( path.parent / f'{path.name}.br', 'wb' ) as ofp:
+                ofp.write( brotli.compress( body, mode=brotli.MODE_TEXT ) )
+        return True
 
     def process_searchdir( self ):
         if self.searchdir is None:
@@ -802,18 +1623,137 @@ class RomanSurveySummary:
         outputparse = re.compile( "^output_?(.*)$" )
 
         _logger.info( f"Looking for collections in {self.searchdir}" )
-        for direc in self.searchdir.glob( "output*" ):
-            match = outputparse.search( direc.name )
-            if match is None:
-                raise RuntimeError( f"Failed to parse {direc.name} for output_?(.*)" )
-            surveyname = match.group(1)
+        if self.jobs == 1:
+            for direc in self.searchdir.glob( "output*" ):
+                match = outputparse.search( direc.name )
+                if match is None:
+                    raise RuntimeError( f"Failed to parse {direc.name} for output_?(.*)" )
+                surveyname = match.group(1)
+
+                _logger.info( f"Working on collection {surveyname}" )
+                self.read_files( surveyname, direc, regen=self.regen )
 
-            _logger.info( f"Working on collection {surveyname}" )
-            self.read_files( surveyname, direc )
+        else:
+            # Put the sims of all the collections into one process pool, so
+            #   that the workers stay busy across collection boundaries.
+            #   Collections are finished (and written) in the same order as
+            #   the serial loop above, each as soon as all of its sims are done.
+            with self._ingest_pool() as pool:
+                pending = []
+                for direc in self.searchdir.glob( "output*" ):
+                    match = outputparse.search( direc.name )
+                    if match is None:
+                        raise RuntimeError( f"Failed to parse {direc.name} for output_?(.*)" )
+                    surveyname = match.group(1)
+
+                    _logger.info( f"Submitting the sims of collection {surveyname} ({self.jobs} processes)" )
+                    prep = self._prepare_collection( surveyname, direc, regen=self.regen )
+                    pending.append( ( prep, self._submit_sims( pool, prep, True ) ) )
+
+                for prep, tasks in pending:
+                    self._collect_sims( pool, prep, tasks )
+                    _logger.info( f"Finishing collection {prep['collection']}" )
+                    self._finish_collection( prep )
 
         _logger.info( f"All done with collecitons in {self.searchdir}" )
 
 
+# ======================================================================
+# Process pool workers for RomanSurveySummary ingest.  Each worker
+#   process gets its own copy of the RomanSurveySummary once, when it
+#   starts, rather than one pickled with every sim.
+
+_ingest_summary = None
+
+def _init_ingest_worker( summary, loglevel ):
+    global _ingest_summary
+    _ingest_summary = summary
+    # Not inherited under the spawn or forkserver start methods
+    _logger.setLevel( loglevel )
+
+def _ingest_sim( *args ):
+    return _ingest_summary._try_read_sim( *args )
+
+
+class _IngestPool:
+    """A process pool that runs RomanSurveySummary._try_read_sim, and survives its workers dying.
+
+    If a worker process dies (killed for running out of memory, or a
+    crash in native code), every unfinished future of the pool raises
+    BrokenProcessPool, and there's no telling which sim killed it.  The
+    executor hands out work in order, so only the first few unfinished
+    sims (nprocs, plus the ones it queues ahead) can have been running;
+    those are each tried again alone, in a one-process pool, and a sim
+    that kills that one too counts as failed.  The rest are submitted
+    to a new pool.
+
+    """
+
+    def __init__( self, nprocs, summary ):
+        self.nprocs = nprocs
+        self.summary = summary
+        self.tasks = []
+        self.executor = self._executor( nprocs )
+
+    def _executor( self, nprocs ):
+        return concurrent.futures.ProcessPoolExecutor( max_workers=nprocs, initializer=_init_ingest_worker,
+                                                       initargs=( self.summary, _logger.level ) )
+
+    def __enter__( self ):
+        return self
+
+    def __exit__( self, *exc ):
+        self.executor.shutdown( wait=True, cancel_futures=True )
+
+    def _submit( self, task, executor ):
+        task['executor'] = executor
+        task['future'] = executor.submit( _ingest_sim, *task['args'] )
+
+    def submit( self, *args ):
+        """Submit _try_read_sim( *args ); returns a task to pass to result."""
+        task = { 'args': args }
+        self._submit( task, self.executor )
+        self.tasks.append( task )
+        return task
+
+    @staticmethod
+    def _unfinished( task ):
+        future = task['future']
+        return ( ( not future.done() ) or future.cancelled()
+                 or isinstance( future.exception(), concurrent.futures.process.BrokenProcessPool ) )
+
+    def _replace( self ):
+        broken = self.executor
+        broken.shutdown( wait=False, cancel_futures=True )
+        unfinished = [ t for t in self.tasks if ( t['executor'] is broken ) and self._unfinished( t ) ]
+        nsuspects = self.nprocs + concurrent.futures.process.EXTRA_QUEUED_CALLS
+        _logger.error( f"An ingest worker process died; trying {min( nsuspects, len(unfinished) )} sims "
+                       f"that may have been running again one at a time, then resubmitting the rest" )
+        self.executor = self._executor( self.nprocs )
+        for task in unfinished[ :nsuspects ]:
+            with self._executor( 1 ) as alone:
+                self._submit( task, alone )
+                concurrent.futures.wait( [ task['future'] ] )
+            if not self._unfinished( task ):
+                task['executor'] = self.executor
+        for task in unfinished[ nsuspects: ]:
+            self._submit( task, self.executor )
+
+    def result( self, task ):
+        """What _try_read_sim returned for task, or None if it couldn't be run."""
+        while True:
+            try:
+                return task['future'].result()
+            except concurrent.futures.process.BrokenProcessPool:
+                if task['executor'] is self.executor:
+                    self._replace()
+                if task['executor'] is not self.executor:
+                    _logger.error( f"Giving up on {task['args'][1]}; the ingest worker reading it died" )
+                    return None
+            except Exception as ex:
+                _logger.error( f"Failed to get survey info for {task['args'][1]}: {ex}" )
+                return None
+
 # ======================================================================
 
 def main():
@@ -831,12 +1771,36 @@ def main():
                                 "campaign in --campaign-pipeline-dir.  In this directory are "
                                 "subdirectories corresponding to all of the versions found in all of the"
                                 ".../OUTPUT2*/MERGE.LOG files under campaign-pipeline-dir." ) )
+    parser.add_argument( "--pool-size", type=int, default=0,
+                         help=( "Also write, for each sim, a pool of this many random objects (and "
+                                "objects with spectra) per gentype, z bin, tier, and spectrum exposure "
+                                "time, for the webserver's /randomltcv and /randomspectrum to serve "
+                                "from.  0 means don't write pools.  Needs astropy." ) )
+    parser.add_argument( "--pool-zbin", type=float, default=0.1, help="Width of the z_CMB bins of the pools" )
+    parser.add_argument( "--pool-seed", type=int, default=42, help="Random seed for drawing the pools" )
+    parser.add_argument( "-j", "--jobs", type=int, default=1,
+                         help=( "Read this many sims at once, in separate processes.  0 means one per CPU." ) )
+    parser.add_argument( "--regen", action='store_true', default=False,
+                         help=( "Read every sim again, even if its inputs haven't changed since the "
+                                "last ingest into outdir (see {collection}_manifest.json)" ) )
+    parser.add_argument( "--hash-inputs", action='store_true', default=False,
+                         help=( "Decide whether a sim's input files have changed by their sha1 rather "
+                                "than their mtime (slower, but survives copies that don't keep mtimes)" ) )
+    parser.add_argument( "--zhist-bins", type=float, nargs=3, default=[ 0., 3.1, 0.1 ], metavar=( 'ZMIN', 'ZMAX', 'DZ' ),
+                         help=( "Bins of the z_CMB histograms: lower edges numpy.arange( ZMIN, ZMAX, DZ ), each DZ "
+                                "wide.  (The webserver's /snzhist plots assume DZ is 0.1.)" ) )
+    parser.add_argument( "--chunk-rows", type=int, default=0,
+                         help=( "Read the .DUMP and .SPEC tables this many rows at a time, so that a whole "
+                                "table never has to be in memory.  0 means read each table all at once." ) )
     args = parser.parse_args()
 
     if args.verbose:
         _logger.setLevel( logging.DEBUG )
 
-    ss = RomanSurveySummary( args.outdir, searchdir=args.campaign_pipeline_dir, snana_simdir=args.snana_simdir )
+    ss = RomanSurveySummary( args.outdir, searchdir=args.campaign_pipeline_dir, snana_simdir=args.snana_simdir,
+                             poolsize=args.pool_size, poolzbin=args.pool_zbin, poolseed=args.pool_seed,
+                             jobs=args.jobs, regen=args.regen, hashinputs=args.hash_inputs,
+                             chunkrows=args.chunk_rows, zhistbins=tuple( args.zhist_bins ) )
     ss.process_searchdir()
 
     # for snanadir in args.snana_outdirs:
@@ -0,0 +1,390 @@
+# Plot rendering for the SNANA summary webserver.
+#
+# The webserver views figure out what to plot and put it into a "plot
+#   spec", a dict of plain python and numpy data; the functions here
+#   turn a plot spec into SVG (or PNG) bytes.  They don't know anything
+#   about flask or the survey data, so they can run in other processes;
+#   RenderPool runs them in a pool of worker processes so that a slow
+#   matplotlib render doesn't tie up a webserver worker.
+#
+# Plot specs:
+#
+#   { 'kind': 'bars',
+#     'width': int, 'height': int,          # pixels
+#     'series': [ { 'x': array,             # left edges of the bars (already offset)
+#                   'y': array,             # heights
+#                   'label': str }, ... ],
+#     'barwidth': float,
+#     'xlim': ( float, float ) or None,
+#     'xlabel': str, 'ylabel': str, 'title': str,
+#     'gtonmaxxtick': float or None,        # label this x tick "≥<tick>"
+#     'renderer': 'fast' or 'mpl' }         # optional, default mpl; see render_bars_fast
+#
+#   { 'kind': 'heatmap',
+#     'width': int, 'height': int,
+#     'grid': 2d array,                     # grid[y][x]
+#     'extent': ( xlo, xhi, ylo, yhi ),
+#     'xlabel': str, 'ylabel': str, 'title': str }
+
+import io
+import os
+import math
+from xml.sax.saxutils import escape, quoteattr
+import threading
+import multiprocessing
+import concurrent.futures
+
+import numpy
+
+dpi = 72
+
+# ======================================================================
+# The renderers
+
+def _pyplot():
+    import matplotlib
+    matplotlib.use( 'Agg' )
+    from matplotlib import pyplot
+    return pyplot
+
+
+def _save( fig, fmt ):
+    pyplot = _pyplot()
+    bio = io.BytesIO()
+    fig.savefig( bio, format=fmt )
+    pyplot.close( fig )
+    return bio.getvalue()
+
+
+def render_bars( spec, fmt='svg' ):
+    pyplot = _pyplot()
+    fig = pyplot.figure( figsize=(spec['width']/dpi, spec['height']/dpi), dpi=dpi, tight_layout=True )
+    ax = fig.add_subplot( 1, 1, 1 )
+    for series in spec['series']:
+        ax.bar( series['x'], height=series['y'], width=spec['barwidth'], align='edge', label=series['label'] )
+
+    ax.legend( fontsize=12 )
+    ax.tick_params( "both", labelsize=12 )
+    if spec.get( 'xlim' ) is not None:
+        ax.set_xlim( *spec['xlim'] )
+    ax.set_xlabel( spec['xlabel'], fontsize=16 )
+    ax.set_ylabel( spec['ylabel'], fontsize=16 )
+    ax.set_title( spec['title'], fontsize=16 )
+
+    if spec.get( 'gtonmaxxtick' ) is not None:
+        xticklabels = [ item.get_text() for item in ax.get_xticklabels() ]
+        for i in range(len(xticklabels)):
+            if float( xticklabels[i] ) == spec['gtonmaxxtick']:
+                xticklabels[i] = f"≥{xticklabels[i]}"
+        ax.set_xticklabels( xticklabels )
+
+    return _save( fig, fmt )
+
+
+def render_heatmap( spec, fmt='svg' ):
+    pyplot = _pyplot()
+    fig = pyplot.figure( figsize=(spec['width']/dpi, spec['height']/dpi), dpi=dpi, tight_layout=True )
+    ax = fig.add_subplot( 1, 1, 1 )
+    img = ax.imshow( spec['grid'],
+                     aspect='auto',
+                     origin='lower',
+                     extent=spec['extent'] )
+    ax.figure.colorbar( img, ax=ax )
+
+    ax.tick_params( "both", labelsize=12 )
+    ax.set_ylabel( spec['ylabel'], fontsize=16 )
+    ax.set_xlabel( spec['xlabel'], fontsize=16 )
+    ax.set_title( spec['title'], fontsize=16 )
+
+    return _save( fig, fmt )
+
+
+# ======================================================================
+# A matplotlib-free renderer for bar plots
+#
+# The bar histograms are simple enough that building a whole matplotlib
+#   figure for them is mostly overhead.  This writes the SVG directly,
+#   laid out to look like what render_bars makes (same colors, fonts,
+#   tick choices, legend, ≥ relabeling), in a small fraction of the time
+#   and size.  Only does SVG.
+
+bar_renderers = [ 'fast', 'mpl' ]
+
+colorcycle = [ '#1f77b4', '#ff7f0e', '#2ca02c', '#d62728', '#9467bd',
+               '#8c564b', '#e377c2', '#7f7f7f', '#bcbd22', '#17becf' ]
+fontfamily = "DejaVu Sans, Bitstream Vera Sans, Arial, sans-serif"
+
+
+def _textwidth( text, size ):
+    # Rough, but good enough for layout (DejaVu Sans averages ~0.6 em)
+    return 0.6 * size * len( text )
+
+
+def _niceticks( lo, hi, maxticks=9 ):
+    """Tick positions in [lo, hi] at a 1, 2, 2.5, 5 × 10ⁿ spacing, like matplotlib's default locator."""
+    if hi <= lo:
+        hi = lo + 1.
+    raw = ( hi - lo ) / ( maxticks - 1 )
+    scale = 10. ** math.floor( math.log10( raw ) )
+    for step in [ 1., 2., 2.5, 5., 10. ]:
+        if step * scale >= raw * ( 1. - 1e-9 ):
+            break
+    step *= scale
+    first = math.ceil( lo / step - 1e-9 )
+    last = math.floor( hi / step + 1e-9 )
+    ticks = [ i * step for i in range( first, last+1 ) ]
+    return ticks, step
+
+
+def _ticklabel( val, step ):
+    ndec = max( 0, -int( math.floor( math.log10( step ) + 1e-9 ) ) )
+    if abs( step * 10**ndec - round( step * 10**ndec ) ) > 1e-9:
+        ndec += 1
+    label = f"{val:.{ndec}f}"
+    if float( label ) == 0.:
+        label = label.lstrip( '-' )
+    return label
+
+
+def render_bars_fast( spec, fmt='svg' ):
+    if fmt != 'svg':
+        raise ValueError( "render_bars_fast only does svg" )
+
+    width = spec['width']
+    height = spec['height']
+    series = spec['series']
+
+    # Data ranges
+    xs = [ numpy.asarray( s['x'], dtype=float ) for s in series ]
+    ys = [ numpy.asarray( s['y'], dtype=float ) for s in series ]
+    if spec.get( 'xlim' ) is not None:
+        xlo, xhi = spec['xlim']
+    else:
+        allx = numpy.concatenate( [ x for x in xs ] + [ x + spec['barwidth'] for x in xs ] ) if len(xs) > 0 else []
+        if len( allx ) == 0:
+            xlo, xhi = 0., 1.
+        else:
+            xlo, xhi = float( allx.min() ), float( allx.max() )
+            pad = 0.05 * ( xhi - xlo ) if xhi > xlo else 0.5
+            xlo -= pad
+            xhi += pad
+    ymax = max( [ float( y.max() ) for y in ys if len(y) > 0 ] + [ 0. ] )
+    ymax = 1. if ymax <= 0 else ymax * 1.05
+    xticks, xstep = _niceticks( xlo, xhi )
+    yticks, ystep = _niceticks( 0., ymax )
+
+    xticklabels = [ _ticklabel( t, xstep ) for t in xticks ]
+    if spec.get( 'gtonmaxxtick' ) is not None:
+        xticklabels = [ f"≥{l}" if float( l ) == spec['gtonmaxxtick'] else l for l in xticklabels ]
+    yticklabels = [ _ticklabel( t, ystep ) for t in yticks ]
+
+    # Layout
+    ticksize = 12
+    labelsize = 16
+    titlelines = spec['title'].split( '\n' )
+    pad = 6
+    ticklen = 3.5
+    top = pad + len( titlelines ) * labelsize * 1.2 + pad
+    left = ( pad + labelsize * 1.2 + pad + max( [ _textwidth( l, ticksize ) for l in yticklabels ] + [ 0 ] )
+             + ticklen + 3.5 )
+    bottom = pad + labelsize * 1.2 + pad + ticksize * 1.2 + ticklen + 3.5
+    right = pad + _textwidth( xticklabels[-1], ticksize ) / 2. if len( xticklabels ) > 0 else pad
+    axw = max( width - left - right, 10. )
+    axh = max( height - top - bottom, 10. )
+
+    def px( x ):
+        return left + ( x - xlo ) / ( xhi - xlo ) * axw
+
+    def py( y ):
+        return top + axh - y / ymax * axh
+
+    out = [ f'<?xml version="1.0" encoding="utf-8" standalone="no"?>\n'
+            f'<svg xmlns="http://www.w3.org/2000/svg" width="{width}pt" height="{height}pt" '
+            f'viewBox="0 0 {width} {height}" version="1.1">\n'
+            f'<rect x="0" y="0" width="{width}" height="{height}" fill="#ffffff"/>\n'
+            f'<g font-family={quoteattr(fontfamily)}>\n'
+            f'<clipPath id="axes"><rect x="{left:.2f}" y="{top:.2f}" width="{axw:.2f}" height="{axh:.2f}"/></clipPath>\n' ]
+
+    # Bars
+    out.append( '<g clip-path="url(#axes)">\n' )
+    for i, ( s, x, y ) in enumerate( zip( series, xs, ys ) ):
+        color = colorcycle[ i % len(colorcycle) ]
+        out.append( f'<g fill="{color}">' )
+        for xv, yv in zip( x, y ):
+            x0 = px( xv )
+            x1 = px( xv + spec['barwidth'] )
+            y0 = py( max( yv, 0. ) )
+            y1 = py( min( yv, 0. ) )
+            out.append( f'<rect x="{x0:.2f}" y="{y0:.2f}" width="{x1-x0:.2f}" height="{y1-y0:.2f}"/>' )
+        out.append( '</g>\n' )
+    out.append( '</g>\n' )
+
+    # Axes frame and ticks
+    out.append( f'<rect x="{left:.2f}" y="{top:.2f}" width="{axw:.2f}" height="{axh:.2f}" '
+                f'fill="none" stroke="#000000" stroke-width="0.8"/>\n' )
+    out.append( f'<g font-size="{ticksize}" fill="#000000" text-anchor="middle">\n' )
+    for t, l in zip( xticks, xticklabels ):
+        x = px( t )
+        out.append( f'<line x1="{x:.2f}" y1="{top+axh:.2f}" x2="{x:.2f}" y2="{top+axh+ticklen:.2f}" '
+                    f'stroke="#000000" stroke-width="0.8"/>'
+                    f'<text x="{x:.2f}" y="{top+axh+ticklen+3.5+ticksize:.2f}">{escape(l)}</text>\n' )
+    out.append( '</g>\n' )
+    out.append( f'<g font-size="{ticksize}" fill="#000000" text-anchor="end">\n' )
+    for t, l in zip( yticks, yticklabels ):
+        y = py( t )
+        out.append( f'<line x1="{left-ticklen:.2f}" y1="{y:.2f}" x2="{left:.2f}" y2="{y:.2f}" '
+                    f'stroke="#000000" stroke-width="0.8"/>'
+                    f'<text x="{left-ticklen-3.5:.2f}" y="{y+ticksize*0.36:.2f}">{escape(l)}</text>\n' )
+    out.append( '</g>\n' )
+
+    # Axis labels and title
+    out.append( f'<text x="{left+axw/2:.2f}" y="{height-pad:.2f}" font-size="{labelsize}" '
+                f'text-anchor="middle">{escape(spec["xlabel"])}</text>\n' )
+    ylx = pad + labelsize
+    out.append( f'<text x="{ylx:.2f}" y="{top+axh/2:.2f}" font-size="{labelsize}" text-anchor="middle" '
+                f'transform="rotate(-90 {ylx:.2f} {top+axh/2:.2f})">{escape(spec["ylabel"])}</text>\n' )
+    for i, line in enumerate( titlelines ):
+        out.append( f'<text x="{left+axw/2:.2f}" y="{pad+(i+1)*labelsize*1.2-0.2*labelsize:.2f}" '
+                    f'font-size="{labelsize}" text-anchor="middle">{escape(line)}</text>\n' )
+
+    # Legend, upper right
+    if len( series ) > 0:
+        legsize = 12
+        rowh = legsize * 1.4
+        patchw = 2 * legsize
+        legw = patchw + 0.8 * legsize + max( _textwidth( s['label'], legsize ) for s in series ) + 0.8 * legsize
+        legh = len( series ) * rowh + 0.6 * legsize
+        lx = left + axw - legw - 0.5 * legsize
+        ly = top + 0.5 * legsize
+        out.append( f'<g font-size="{legsize}">\n'
+                    f'<rect x="{lx:.2f}" y="{ly:.2f}" width="{legw:.2f}" height="{legh:.2f}" rx="2" '
+                    f'fill="#ffffff" fill-opacity="0.8" stroke="#cccccc" stroke-width="0.8"/>\n' )
+        for i, s in enumerate( series ):
+            rowy = ly + 0.3 * legsize + i * rowh
+            color = colorcycle[ i % len(colorcycle) ]
+            out.append( f'<rect x="{lx+0.4*legsize:.2f}" y="{rowy+0.3*legsize:.2f}" width="{patchw:.2f}" '
+                        f'height="{0.7*legsize:.2f}" fill="{color}"/>'
+                        f'<text x="{lx+0.4*legsize+patchw+0.8*legsize:.2f}" y="{rowy+legsize:.2f}">'
+                        f'{escape(s["label"])}</text>\n' )
+        out.append( '</g>\n' )
+
+    out.append( '</g>\n</svg>\n' )
+    return ''.join( out ).encode( 'utf-8' )
+
+# ======================================================================
+
+renderers = { 'bars': render_bars,
+              'heatmap': render_heatmap }
+
+def is_fast( spec, fmt='svg' ):
+    """True if spec can (and asked to) be rendered without matplotlib."""
+    return ( spec.get( 'renderer' ) == 'fast' ) and ( spec['kind'] == 'bars' ) and ( fmt == 'svg' )
+
+def render( spec, fmt='svg' ):
+    """Return the bytes of the plot described by spec, as fmt ('svg' or 'png')."""
+    if is_fast( spec, fmt ):
+        return render_bars_fast( spec, fmt )
+    if spec['kind'] not in renderers:
+        raise ValueError( f"Unknown plot kind {spec['kind']}" )
+    return renderers[ spec['kind'] ]( spec, fmt )
+
+
+def warmup():
+    """Import matplotlib and render a throwaway plot, so fonts etc. are loaded before the first real one."""
+    render( { 'kind': 'bars', 'width': 100, 'height': 100,
+              'series': [ { 'x': numpy.array( [ 0., 1. ] ), 'y': numpy.array( [ 1, 2 ] ), 'label': 'warmup' } ],
+              'barwidth': 0.5, 'xlim': None, 'xlabel': 'x', 'ylabel': 'y', 'title': 'warmup≥' } )
+
+# ======================================================================
+# The pool
+
+class RenderBusy( RuntimeError ):
+    pass
+
+
+class RenderPool:
+    """Renders plot specs in a pool of worker processes.
+
+    nprocs : int
+      Number of worker processes.  If 0, render in the calling thread
+      (one matplotlib render at a time per process, since pyplot isn't
+      thread safe).
+
+    timeout : float
+      Seconds to wait for a render before giving up.
+
+    maxqueue : int
+      At most this many renders may be waiting or running at once;
+      beyond that, render raises RenderBusy rather than queueing
+      forever.
+
+    The worker processes are started the first time they're needed,
+    so that a pool created at import time isn't inherited across a
+    fork (e.g. by gunicorn workers).
+
+    """
+
+    def __init__( self, nprocs=0, timeout=60., maxqueue=None ):
+        self.nprocs = nprocs
+        self.timeout = timeout
+        self.maxqueue = maxqueue if maxqueue is not None else 4 * max( nprocs, 1 )
+        self._slots = threading.BoundedSemaphore( self.maxqueue )
+        self._lock = threading.Lock()
+        self._inprocess = threading.Lock()
+        self._executor = None
+        self._pid = None
+
+    def _get_executor( self ):
+        with self._lock:
+            if ( self._executor is None ) or ( self._pid != os.getpid() ):
+                methods = multiprocessing.get_all_start_methods()
+                ctx = multiprocessing.get_context( 'forkserver' if 'forkserver' in methods else 'spawn' )
+                self._executor = concurrent.futures.ProcessPoolExecutor( max_workers=self.nprocs, mp_context=ctx,
+                                                                         initializer=warmup )
+                self._pid = os.getpid()
+            return self._executor
+
+    def _reset( self ):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown( wait=False, cancel_futures=True )
+            self._executor = None
+
+    def render( self, spec, fmt='svg' ):
+        # Not worth shipping to another process
+        if is_fast( spec, fmt ):
+            return render( spec, fmt )
+
+        if not self._slots.acquire( timeout=self.timeout ):
+            raise RenderBusy( f"More than {self.maxqueue} plots waiting to be rendered" )
+        if self.nprocs == 0:
+            try:
+                if not self._inprocess.acquire( timeout=self.timeout ):
+                    raise RenderBusy( f"Waited more than {self.timeout} s to render a plot" )
+                try:
+                    return render( spec, fmt )
+                finally:
+                    self._inprocess.release()
+            finally:
+                self._slots.release()
+
+        try:
+            future = self._get_executor().submit( render, spec, fmt )
+        except Exception:
+            self._slots.release()
+            raise
+        # A render that we gave up waiting for still occupies a worker
+        #   until it's done, so only free its slot then.
+        future.add_done_callback( lambda f: self._slots.release() )
+        try:
+            return future.result( timeout=self.timeout )
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            raise RenderBusy( f"Plot took more than {self.timeout} s to render" )
+        except concurrent.futures.process.BrokenProcessPool:
+            # A worker died; start a new pool next time
+            self._reset()
+            raise
+
+    def shutdown( self ):
+        self._reset()
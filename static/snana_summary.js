@@ -589,17 +589,13 @@ snanasum.PhotSummary = class extends snanasum.InfoWindow
         let gentype = this.gentype_dropdown.value;
         let sncut = this.sncut_dropdown.value;
 
-        let imgurl = "/snzhist/" + this.collection.collection + "/" + sim
+        let histurl = "/snzhist/" + this.collection.collection + "/" + sim
             + "/whichhist=" + sncut
             + "/gentype=" + gentype
             + "/tier=" + whichtier;
-        console.log( "Asking for image " + imgurl );
-        let img = rkWebUtil.elemaker( "img", div,
-                                      { "classes": [ "zhist" ],
-                                        "attributes": { "src": imgurl,
-                                                        "width": 600,
-                                                        "height": 500,
-                                                        "alt": "[z Histogram]" } } );
+        console.log( "Asking for histogram " + histurl );
+        let plotdiv = rkWebUtil.elemaker( "div", div, { "classes": [ "zhist" ] } );
+        snanasum.plot_hist( plotdiv, histurl );
 
         hbox = rkWebUtil.elemaker( "div", this.infodiv, { "classes": [ "hbox2emgap" ] } )
 
@@ -821,13 +817,13 @@ snanasum.LtcvPlot = class extends snanasum.InfoWindow
 
         // TODO : reafactor all this code so that it all makes more snese
         let sim = this.shown_sim;
-        let connector = new rkWebUtil.Connector( "/randomltcv" )
         let gentype = this.gentype_dropdown.value;
         let z = this.ltcv_z_wid.value;
         let tier = this.tier_dropdown.value;
         let url = "/" + this.collection.collection + "/" + sim + "/" + gentype + "/" + z + "/0.1";
         if ( tier != "__ALL__" ) url += "/" + tier;
-        connector.sendHttpRequest( url, {}, (data) => { self.actually_plot_random_ltcv( data ) } );
+        url += "/maxpoints=" + snanasum.plot_maxpoints;
+        snanasum.fetch_arrays( "/randomltcv" + url, (data) => { self.actually_plot_random_ltcv( data ) } );
     }
 
 
@@ -1198,12 +1194,19 @@ snanasum.SpecSummary = class extends snanasum.InfoWindow
                        + "/magbin=" + mbin + "/snrbin=" + snrbin + "/band=" + curband
                        + "/gentype=" + gentype + "/tframe=" + tframe );
 
-        let img = rkWebUtil.elemaker( "img", this.infodiv,
-                                      { "classes": [ "zhist" ],
-                                        "attributes": { "src": imgurl,
-                                                        "width": 600,
-                                                        "height": 500,
-                                                        "alt": "[Histogram]" } } );
+        if ( which == "rest_phase_z" ) {
+            // Heatmap; SVGPlot doesn't do those, so let the server draw it
+            let img = rkWebUtil.elemaker( "img", this.infodiv,
+                                          { "classes": [ "zhist" ],
+                                            "attributes": { "src": imgurl,
+                                                            "width": 600,
+                                                            "height": 500,
+                                                            "alt": "[Histogram]" } } );
+        }
+        else {
+            let plotdiv = rkWebUtil.elemaker( "div", this.infodiv, { "classes": [ "zhist" ] } );
+            snanasum.plot_hist( plotdiv, imgurl );
+        }
     }
 
 }
@@ -1288,7 +1291,6 @@ snanasum.SpecPlot = class extends snanasum.InfoWindow
                                                         "classes": [ "bold", "italic", "warning" ] } );
 
         let sim = this.shown_sim;
-        let connector = new rkWebUtil.Connector( "/randomspectrum" )
         let gentype = this.gentype_dropdown.value;
         let z = this.z_wid.value;
         let t = this.t_wid.value;
@@ -1300,8 +1302,9 @@ snanasum.SpecPlot = class extends snanasum.InfoWindow
             "/" + t + "/5/tframe=" + tframe;
         if ( tier != "__ALL__" ) url += "/tier=" + tier;
         if ( specstrat != "__ALL__" ) url += "/specstrat=" + specstrat;
+        url += "/maxpoints=" + snanasum.plot_maxpoints;
 
-        connector.sendHttpRequest( url, {}, (data) => { self.actually_plot_random_spectrum( data ) } );
+        snanasum.fetch_arrays( "/randomspectrum" + url, (data) => { self.actually_plot_random_spectrum( data ) } );
     }
 
     actually_plot_random_spectrum( data )
@@ -1345,6 +1348,117 @@ snanasum.SpecPlot = class extends snanasum.InfoWindow
 }
 
 
+// **********************************************************************
+// Histograms from /snzhist and /spechist are drawn here from the
+// plot spec the server sends back with format=json (see plotrender.py),
+// with each bar drawn as a step line.
+
+snanasum.hist_colors = [ '#1f77b4', '#ff7f0e', '#2ca02c', '#d62728', '#9467bd',
+                         '#8c564b', '#e377c2', '#7f7f7f', '#bcbd22', '#17becf' ];
+
+snanasum.plot_hist = function( div, url )
+{
+    rkWebUtil.wipeDiv( div );
+    rkWebUtil.elemaker( "p", div, { "text": "Loading...", "classes": [ "bold", "italic", "warning" ] } );
+    let connector = new rkWebUtil.Connector( url + "/format=json" );
+    connector.sendHttpRequest( "", {}, (spec) => { snanasum.draw_hist( div, spec ) } );
+}
+
+snanasum.draw_hist = function( div, spec )
+{
+    rkWebUtil.wipeDiv( div );
+
+    for ( let line of spec.title.split( "\n" ) )
+        rkWebUtil.elemaker( "p", div, { "text": line, "classes": [ "bold" ] } );
+
+    let xtitle = spec.xlabel;
+    if ( spec.gtonmaxxtick != null )
+        xtitle += " (last bin is ≥" + spec.gtonmaxxtick + ")";
+    let plot = new SVGPlot.Plot( { "xtitle": xtitle, "ytitle": spec.ylabel } );
+    div.appendChild( plot.topdiv );
+
+    let legend = rkWebUtil.elemaker( "p", div );
+    for ( let i in spec.series ) {
+        let series = spec.series[i];
+        let color = snanasum.hist_colors[ i % snanasum.hist_colors.length ];
+        let x = [];
+        let y = [];
+        for ( let j in series.x ) {
+            x.push( series.x[j], series.x[j], series.x[j] + spec.barwidth, series.x[j] + spec.barwidth );
+            y.push( 0, series.y[j], series.y[j], 0 );
+        }
+        plot.addDataset( new SVGPlot.Dataset( { 'x': x, 'y': y, 'dy': [],
+                                                'color': color, 'highlight_color': '#333333',
+                                                'linewid': 2, 'marker': null } ) );
+        rkWebUtil.elemaker( "span", legend, { "text": "■ ", "attributes": { "style": "color: " + color } } );
+        rkWebUtil.elemaker( "span", legend, { "text": series.label } );
+        rkWebUtil.elemaker( "br", legend );
+    }
+    plot.redraw();
+}
+
+
+// **********************************************************************
+// /randomltcv and /randomspectrum send their numbers as raw typed
+// arrays if asked to (see ArrayEncoder in webservice.py): "SNAR", a
+// little-endian uint32 header length, a json header, then the arrays.
+// Each array in the header's "object" is { "__array__": i }, and is
+// replaced with a Float32Array or Float64Array view of the data.
+
+snanasum.arrays_mimetype = "application/x-snana-arrays";
+
+// Light curves and spectra are downsampled by the server to about this
+// many points, which is about the width of a plot in pixels.
+snanasum.plot_maxpoints = 600;
+
+snanasum.fetch_arrays = function( url, callback )
+{
+    fetch( url, { "method": "POST", "headers": { "Accept": snanasum.arrays_mimetype } } )
+        .then( (res) => {
+            if ( !res.ok )
+                throw new Error( "Got status " + res.status + " from " + url );
+            if ( res.headers.get( "Content-Type" ) == snanasum.arrays_mimetype )
+                return res.arrayBuffer().then( (buf) => snanasum.decode_arrays( buf ) );
+            return res.json();
+        } )
+        .then( (data) => {
+            if ( data.status == "error" )
+                throw new Error( data.error );
+            callback( data );
+        } )
+        .catch( (err) => { console.log( err ); window.alert( "Error: " + err.message ); } );
+}
+
+snanasum.decode_arrays = function( buf )
+{
+    let magic = new TextDecoder().decode( new Uint8Array( buf, 0, 4 ) );
+    if ( magic != "SNAR" )
+        throw new Error( "Not an array payload" );
+    let hdrlen = new DataView( buf ).getUint32( 4, true );
+    let header = JSON.parse( new TextDecoder().decode( new Uint8Array( buf, 8, hdrlen ) ) );
+    let base = 8 + hdrlen;
+    let arrays = header.arrays.map( (a) => {
+        if ( a.dtype == "f4" ) return new Float32Array( buf, base + a.offset, a.length );
+        if ( a.dtype == "f8" ) return new Float64Array( buf, base + a.offset, a.length );
+        throw new Error( "Unknown array dtype " + a.dtype );
+    } );
+
+    let fill = function( thing ) {
+        if ( Array.isArray( thing ) )
+            return thing.map( fill );
+        if ( ( thing !== null ) && ( typeof thing == "object" ) ) {
+            if ( thing.hasOwnProperty( "__array__" ) )
+                return arrays[ thing.__array__ ];
+            let obj = {};
+            for ( let k in thing ) obj[k] = fill( thing[k] );
+            return obj;
+        }
+        return thing;
+    }
+    return fill( header.object );
+}
+
+
 // **********************************************************************
 // **********************************************************************
 // **********************************************************************
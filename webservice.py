@@ -1,31 +1,810 @@
 # Put this first so we can be sure that there are no calls that subvert
-#  this in other includes.
+#  this in other includes.  (Plots themselves are made in plotrender.)
 import matplotlib
 matplotlib.use( "Agg" )
 # matplotlib.rc('font', **{'family': 'serif', 'serif': ['Computer Modern']})
 # matplotlib.rc('text', usetex=True)  #  Need LaTeX in Dockerfile
-from matplotlib import pyplot
 
 import sys
+import os
 import traceback
 import io
 import re
-import math
 import json
+import gzip
+import hashlib
+import tempfile
+import fcntl
+import argparse
 import yaml
 import pathlib
 import logging
-import random
+import time
+import warnings
+import shutil
+import threading
+import collections
+import contextlib
+import contextvars
+import concurrent.futures
 import numpy
 import pandas
 
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
 import flask
 import flask.views
 
 from astropy.io import fits
-import astropy.table
+
+import plotrender
 
 workdir = pathlib.Path( __name__ ).resolve().parent
+# Scratch space this process may write to (/data is mounted read-only)
+cachedir = pathlib.Path( os.getenv( "SNANA_SUMMARY_CACHE_DIR", "/tmp/snana_summary_cache" ) )
+
+# ======================================================================
+# Which version of the data is being served.
+#
+# The json files made by lib/parse_snana.py live in the data directory
+#   (SNANA_SUMMARY_DATA_DIR, default /data).  A new campaign is
+#   published by pointing a symlink (e.g.
+#   .../snana_summary_webserver_data/current) at a new directory, so the
+#   data directory is resolved to a real path, and that real path is
+#   what everything reads from.  A version is the resolved directory
+#   plus the stamp of the DATA_VERSION marker that the ingest writes
+#   when it's done (or, for data ingested before there was a marker,
+#   the stamp of the directory itself).  The version is checked at most
+#   every SNANA_SUMMARY_DATA_POLL seconds; when it changes, a new
+#   DataSnapshot (with a fresh list of collections) replaces the old one
+#   in a single assignment, and the onswap callbacks drop in-process
+#   cache entries that can only belong to the old version.
+#
+# Each request pins the snapshot that was current when it first asked
+#   for one (see datasnapshot()), so a request that was in flight when
+#   the symlink moved keeps reading the old directory until it's done.
+#   Caches of things built from the data (plots, cubes, payloads) are
+#   keyed on the stamps of the files they were built from, so entries
+#   for files the new version didn't change stay warm.
+
+DataSnapshot = collections.namedtuple( 'DataSnapshot', [ 'root', 'token', 'collections' ] )
+
+class DataVersion:
+    marker = 'DATA_VERSION'
+
+    def __init__( self, datadir, poll=5. ):
+        self.datadir = pathlib.Path( datadir )
+        self.poll = poll
+        self._snapshot = None
+        self._stamp = None
+        self._checked = None
+        self._onswap = []
+        self._lock = threading.Lock()
+
+    def onswap( self, func ):
+        """Call func( old, new ) (the DataSnapshots) whenever the data version changes."""
+        self._onswap.append( func )
+        return func
+
+    def stamp( self, root ):
+        """A string that changes whenever the data in (resolved) directory root is republished."""
+        for path in ( root / self.marker, root ):
+            try:
+                st = path.stat()
+                return f'{root}:{path.name}:{st.st_ino}:{st.st_mtime_ns}:{st.st_size}'
+            except FileNotFoundError:
+                pass
+        return f'{root}:missing'
+
+    def current( self ):
+        """Return the DataSnapshot for the newest version of the data."""
+        snapshot = self._snapshot
+        if ( snapshot is not None ) and ( time.monotonic() - self._checked < self.poll ):
+            return snapshot
+
+        with self._lock:
+            if ( self._snapshot is not None ) and ( time.monotonic() - self._checked < self.poll ):
+                return self._snapshot
+            root = self.datadir.resolve()
+            stamp = self.stamp( root )
+            self._checked = time.monotonic()
+            if stamp == self._stamp:
+                return self._snapshot
+
+            colls = sorted( f.name[ :-len('_surveys.json') ] for f in root.glob( '*_surveys.json' ) )
+            new = DataSnapshot( root, hashlib.sha1( stamp.encode( 'utf-8' ) ).hexdigest()[0:16], colls )
+            old = self._snapshot
+            self._snapshot = new
+            self._stamp = stamp
+
+        if old is not None:
+            app.logger.info( f"Data version changed from {old.token} ({old.root}) to {new.token} ({new.root})" )
+            for func in self._onswap:
+                try:
+                    func( old, new )
+                except Exception as ex:
+                    app.logger.exception( ex )
+        return new
+
+
+dataversion = DataVersion( os.getenv( "SNANA_SUMMARY_DATA_DIR", "/data" ),
+                           poll=float( os.getenv( "SNANA_SUMMARY_DATA_POLL", 5 ) ) )
+
+def datasnapshot():
+    """The DataSnapshot the current request is using.
+
+    The first call during a request takes the current snapshot, and later
+    calls during the same request return that one, even if the data
+    version has changed in the meantime.  Outside of a request, it's
+    just dataversion.current().
+
+    """
+    if not flask.has_app_context():
+        return dataversion.current()
+    if 'datasnapshot' not in flask.g:
+        flask.g.datasnapshot = dataversion.current()
+    return flask.g.datasnapshot
+
+# ======================================================================
+# Per-process cache of decoded json files.
+#
+# Each gunicorn worker keeps the decoded structures of the data directory's *.json
+#   files it has loaded, keyed by file path.  An entry is thrown away
+#   if the file's mtime or size changes.  The memory ceiling is
+#   measured in bytes of json text on disk (the decoded python objects
+#   are a few times bigger than that); once the total goes over the
+#   ceiling, the least recently used entries are evicted.
+#
+# The decoded objects are shared between requests, so callers must not
+#   modify what they get back.
+
+class ParsedJSONCache:
+    def __init__( self, maxbytes ):
+        self.maxbytes = maxbytes
+        self._cache = collections.OrderedDict()
+        self._totbytes = 0
+        self._lock = threading.Lock()
+
+    def get( self, path ):
+        path = pathlib.Path( path )
+        st = path.stat()
+        stamp = ( st.st_mtime_ns, st.st_size )
+
+        with self._lock:
+            ent = self._cache.get( path )
+            if ( ent is not None ) and ( ent['stamp'] == stamp ):
+                self._cache.move_to_end( path )
+                return ent['obj']
+
+        with open( path ) as ifp:
+            obj = json.load( ifp )
+
+        with self._lock:
+            old = self._cache.pop( path, None )
+            if old is not None:
+                self._totbytes -= old['nbytes']
+            if st.st_size <= self.maxbytes:
+                self._cache[ path ] = { 'stamp': stamp, 'obj': obj, 'nbytes': st.st_size }
+                self._totbytes += st.st_size
+                while self._totbytes > self.maxbytes:
+                    _, evicted = self._cache.popitem( last=False )
+                    self._totbytes -= evicted['nbytes']
+
+        return obj
+
+    def clear( self ):
+        with self._lock:
+            self._cache.clear()
+            self._totbytes = 0
+
+
+jsoncache = ParsedJSONCache( int( float( os.getenv( "SNANA_SUMMARY_JSON_CACHE_MB", 512 ) ) * 1024 * 1024 ) )
+# Entries are keyed by path under the resolved data directory, so after a
+#   new version is published, only requests still on the old one can use them
+dataversion.onswap( lambda old, new: jsoncache.clear() if old.root != new.root else None )
+
+# ======================================================================
+# Cache of rendered plots.
+#
+# Rendering an svg with matplotlib takes a few hundred ms, and people
+#   click through the same sims over and over, so keep what we've
+#   rendered.  Each entry holds both the raw and the gzipped bytes, so
+#   compression only happens once.  There's an in-memory LRU per
+#   process, and optionally a directory (which can be shared between
+#   processes and between replicas) that holds the gzipped bytes.
+#   Files in that directory are written to a temporary file and then
+#   renamed into place, so a reader never sees a partial file.
+#
+# Keys are built with key() from anything json-serializable; callers
+#   are responsible for putting a data version stamp into the key so
+#   that a new ingest doesn't serve stale plots.
+
+class RenderedPlotCache:
+    suffixes = { 'image/svg+xml': 'svg', 'image/png': 'png', 'application/json': 'json',
+                 'application/msgpack': 'msgpack', 'application/x-snana-arrays': 'snar' }
+
+    def __init__( self, maxbytes, cachedir=None ):
+        self.maxbytes = maxbytes
+        self.cachedir = None if cachedir is None else pathlib.Path( cachedir )
+        self._cache = collections.OrderedDict()
+        self._totbytes = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key( *parts ):
+        return hashlib.sha256( json.dumps( parts, sort_keys=True, default=str ).encode( 'utf-8' ) ).hexdigest()
+
+    def _path( self, key, content_type ):
+        return self.cachedir / key[0:2] / f'{key}.{self.suffixes[content_type]}.gz'
+
+    def _remember( self, key, ent ):
+        nbytes = len( ent['body'] ) + len( ent['gzip'] )
+        with self._lock:
+            old = self._cache.pop( key, None )
+            if old is not None:
+                self._totbytes -= old['nbytes']
+            if nbytes <= self.maxbytes:
+                ent['nbytes'] = nbytes
+                self._cache[ key ] = ent
+                self._totbytes += nbytes
+                while self._totbytes > self.maxbytes:
+                    _, evicted = self._cache.popitem( last=False )
+                    self._totbytes -= evicted['nbytes']
+
+    def get( self, key, content_type='image/svg+xml' ):
+        with self._lock:
+            ent = self._cache.get( key )
+            if ent is not None:
+                self._cache.move_to_end( key )
+                return ent
+
+        if self.cachedir is not None:
+            path = self._path( key, content_type )
+            try:
+                with open( path, 'rb' ) as ifp:
+                    gz = ifp.read()
+                ent = { 'body': gzip.decompress( gz ), 'gzip': gz, 'content_type': content_type }
+                self._remember( key, ent )
+                return ent
+            except FileNotFoundError:
+                pass
+            except Exception as ex:
+                app.logger.warning( f"Failed to read plot cache file {path}: {ex}" )
+
+        return None
+
+    def put( self, key, body, content_type='image/svg+xml' ):
+        ent = { 'body': body, 'gzip': gzip.compress( body, compresslevel=6 ), 'content_type': content_type }
+        self._remember( key, ent )
+
+        if self.cachedir is not None:
+            path = self._path( key, content_type )
+            try:
+                path.parent.mkdir( parents=True, exist_ok=True )
+                with tempfile.NamedTemporaryFile( dir=path.parent, prefix=f'.{key}.', delete=False ) as ofp:
+                    ofp.write( ent['gzip'] )
+                # NamedTemporaryFile makes it 0600; replicas running as other users need to read it
+                os.chmod( ofp.name, 0o644 )
+                os.replace( ofp.name, path )
+            except Exception as ex:
+                app.logger.warning( f"Failed to write plot cache file {path}: {ex}" )
+                try:
+                    os.unlink( ofp.name )
+                except Exception:
+                    pass
+
+        return ent
+
+    def clear( self ):
+        with self._lock:
+            self._cache.clear()
+            self._totbytes = 0
+
+
+plotcache = RenderedPlotCache( int( float( os.getenv( "SNANA_SUMMARY_PLOT_CACHE_MB", 64 ) ) * 1024 * 1024 ),
+                               cachedir=os.getenv( "SNANA_SUMMARY_PLOT_CACHE_DIR", None ) )
+
+# ======================================================================
+# LRU cache of things derived from the data (histogram cubes, indexes).
+#   The caller says how many bytes each object is worth.
+
+class ObjectCache:
+    def __init__( self, maxbytes ):
+        self.maxbytes = maxbytes
+        self._cache = collections.OrderedDict()
+        self._totbytes = 0
+        self._lock = threading.Lock()
+
+    def get( self, key ):
+        with self._lock:
+            ent = self._cache.get( key )
+            if ent is None:
+                return None
+            self._cache.move_to_end( key )
+            return ent[0]
+
+    def put( self, key, obj, nbytes ):
+        with self._lock:
+            old = self._cache.pop( key, None )
+            if old is not None:
+                self._totbytes -= old[1]
+            if nbytes <= self.maxbytes:
+                self._cache[ key ] = ( obj, nbytes )
+                self._totbytes += nbytes
+                while self._totbytes > self.maxbytes:
+                    _, evicted = self._cache.popitem( last=False )
+                    self._totbytes -= evicted[1]
+        return obj
+
+    def clear( self ):
+        with self._lock:
+            self._cache.clear()
+            self._totbytes = 0
+
+
+cubecache = ObjectCache( int( float( os.getenv( "SNANA_SUMMARY_CUBE_CACHE_MB", 256 ) ) * 1024 * 1024 ) )
+indexcache = ObjectCache( int( float( os.getenv( "SNANA_SUMMARY_INDEX_CACHE_MB", 256 ) ) * 1024 * 1024 ) )
+
+# ======================================================================
+# Coalescing of identical in-flight work.
+#
+# When lots of people open the same sim at once, lots of identical plot
+#   (and payload) requests come in together.  Work that produces
+#   something cacheable is done inside singleflight.hold( key ); the
+#   first request with a given key does the work, and the others wait
+#   for it to finish and then find the result in the cache.  This is
+#   within a process; if SNANA_SUMMARY_LOCK_DIR is set, it's also across
+#   processes (using flock on a lockfile there), which is only useful if
+#   the processes share their results (e.g. SNANA_SUMMARY_PLOT_CACHE_DIR,
+#   or payloads in SNANA_SUMMARY_CACHE_DIR).
+
+class SingleFlight:
+    def __init__( self, lockdir=None ):
+        self.lockdir = None if lockdir is None else pathlib.Path( lockdir )
+        self._lock = threading.Lock()
+        self._inflight = {}
+
+    @contextlib.contextmanager
+    def hold( self, key ):
+        with self._lock:
+            ent = self._inflight.setdefault( key, [ threading.Lock(), 0 ] )
+            ent[1] += 1
+        try:
+            with ent[0]:
+                if self.lockdir is None:
+                    yield
+                else:
+                    with self._filelock( key ):
+                        yield
+        finally:
+            with self._lock:
+                ent[1] -= 1
+                if ent[1] == 0:
+                    del self._inflight[ key ]
+
+    @contextlib.contextmanager
+    def _filelock( self, key ):
+        self.lockdir.mkdir( parents=True, exist_ok=True )
+        path = self.lockdir / f'{hashlib.sha256( key.encode( "utf-8" ) ).hexdigest()}.lock'
+        while True:
+            fd = os.open( path, os.O_RDWR | os.O_CREAT, 0o666 )
+            fcntl.flock( fd, fcntl.LOCK_EX )
+            # Whoever held the lock before us may have removed the file;
+            #   if so, we have a lock on nothing, so start over.
+            try:
+                if os.stat( path ).st_ino == os.fstat( fd ).st_ino:
+                    break
+            except FileNotFoundError:
+                pass
+            os.close( fd )
+        try:
+            yield
+        finally:
+            try:
+                os.unlink( path )
+            except FileNotFoundError:
+                pass
+            os.close( fd )
+
+
+singleflight = SingleFlight( os.getenv( "SNANA_SUMMARY_LOCK_DIR" ) )
+
+# ======================================================================
+# Plots are rendered by plotrender, in a pool of worker processes
+#   (unless SNANA_SUMMARY_RENDER_PROCS is 0, in which case they're
+#   rendered in the request thread).  The views just build plot specs.
+
+renderpool = plotrender.RenderPool( int( os.getenv( "SNANA_SUMMARY_RENDER_PROCS", 0 ) ),
+                                    timeout=float( os.getenv( "SNANA_SUMMARY_RENDER_TIMEOUT", 60 ) ),
+                                    maxqueue=( int( os.getenv( "SNANA_SUMMARY_RENDER_QUEUE" ) )
+                                               if os.getenv( "SNANA_SUMMARY_RENDER_QUEUE" ) is not None else None ) )
+
+# ======================================================================
+# Precompressed json payloads.
+#
+# The json endpoints serve files (or, for /summarydata, a
+#   concatenation of files) that only change when there's a new ingest.
+#   Each representation (identity, gzip, br) of a payload is built once
+#   and kept as a file, so it can be handed to the wsgi server with
+#   send_file (which gunicorn turns into sendfile()).  Compressed
+#   variants written next to the source file by the ingest
+#   (lib/parse_snana.py) are used if they're at least as new as the
+#   source; otherwise, they're built into cachedir.  If cachedir isn't
+#   writable, payloads are kept in memory instead.
+
+class JSONPayloads:
+    suffixes = { 'identity': '', 'gzip': '.gz', 'br': '.br' }
+
+    def __init__( self, cachedir ):
+        self.cachedir = pathlib.Path( cachedir ) / 'payloads'
+        self._mem = {}
+        self._lock = threading.Lock()
+
+    @property
+    def encodings( self ):
+        return [ 'br', 'gzip' ] if brotli is not None else [ 'gzip' ]
+
+    @staticmethod
+    def compress( body, encoding ):
+        if encoding == 'gzip':
+            return gzip.compress( body, compresslevel=9 )
+        elif encoding == 'br':
+            return brotli.compress( body, mode=brotli.MODE_TEXT )
+        elif encoding == 'identity':
+            return body
+        raise ValueError( f"Unknown encoding {encoding}" )
+
+    def get( self, name, stamp, encoding, builder, source=None, sourcetime=None ):
+        """Return a pathlib.Path or bytes with the requested representation of a payload.
+
+        name : str
+          Identifies the payload (e.g. "TEST_summarydata")
+
+        stamp : str
+          Changes whenever the underlying data does
+
+        encoding : str
+          identity, gzip, or br
+
+        builder : callable
+          Returns the uncompressed payload as bytes
+
+        source : Path or None
+          If the payload is just a single file, the file; its identity
+          representation is the file itself, and compressed variants
+          may be sitting next to it.
+
+        sourcetime : int or None
+          st_mtime_ns of the newest file the payload is built from.
+          Cached variants of this payload (for other stamps) written
+          before then are for older data, and are deleted when this one
+          is built.  (Ones written later may be for newer data, and are
+          left alone.)
+
+        """
+        if source is not None:
+            if encoding == 'identity':
+                return source
+            beside = source.parent / f'{source.name}{self.suffixes[encoding]}'
+            if beside.is_file() and ( beside.stat().st_mtime_ns >= source.stat().st_mtime_ns ):
+                return beside
+
+        path = self.cachedir / f'{name}.{stamp}.json{self.suffixes[encoding]}'
+        if path.is_file():
+            return path
+        with self._lock:
+            if ( name, stamp, encoding ) in self._mem:
+                return self._mem[ ( name, stamp, encoding ) ]
+
+        with singleflight.hold( f'payload:{path.name}' ):
+            return self._build( name, stamp, encoding, builder, source, sourcetime, path )
+
+    def _build( self, name, stamp, encoding, builder, source, sourcetime, path ):
+        # Somebody else may have built it while we waited
+        if path.is_file():
+            return path
+        with self._lock:
+            if ( name, stamp, encoding ) in self._mem:
+                return self._mem[ ( name, stamp, encoding ) ]
+
+        if encoding == 'identity':
+            body = builder()
+        else:
+            body = self.get( name, stamp, 'identity', builder, source=source, sourcetime=sourcetime )
+            if isinstance( body, pathlib.Path ):
+                body = body.read_bytes()
+            body = self.compress( body, encoding )
+
+        try:
+            self.cachedir.mkdir( parents=True, exist_ok=True )
+            with tempfile.NamedTemporaryFile( dir=self.cachedir, prefix=f'.{path.name}.', delete=False ) as ofp:
+                try:
+                    ofp.write( body )
+                    ofp.close()
+                    os.replace( ofp.name, path )
+                except Exception:
+                    os.unlink( ofp.name )
+                    raise
+            # Clean out variants for older versions of the data
+            if sourcetime is not None:
+                for old in self.cachedir.glob( f'{name}.*.json{self.suffixes[encoding]}' ):
+                    if old.name[ len(name)+1 : ].split( '.' )[0] == stamp:
+                        continue
+                    try:
+                        if old.stat().st_mtime_ns < sourcetime:
+                            old.unlink()
+                    except FileNotFoundError:
+                        pass
+            return path
+        except OSError as ex:
+            app.logger.warning( f"Can't write {path} ({ex}), keeping payload in memory" )
+            with self._lock:
+                for key in [ k for k in self._mem.keys() if ( k[0] == name ) and ( k[2] == encoding ) ]:
+                    del self._mem[ key ]
+                self._mem[ ( name, stamp, encoding ) ] = body
+            return body
+
+
+jsonpayloads = JSONPayloads( cachedir )
+
+# ======================================================================
+# Encodings for responses that are mostly numeric arrays.
+#
+# /randomltcv and /randomspectrum keep the light curve and spectrum as
+#   numpy arrays; turning every element into a Python float and then
+#   into decimal text used to be most of the time spent on a request.
+#   The client picks the encoding with the Accept header:
+#
+#   application/json : orjson if it's installed (it writes numpy arrays
+#       itself), otherwise the standard json module with tolist().
+#
+#   application/msgpack : only if msgpack is installed.
+#
+#   application/x-snana-arrays : the b"SNAR" magic, a little-endian
+#       uint32 header length, a utf-8 json header (space-padded so the
+#       data starts on an 8-byte boundary), then the raw little-endian
+#       arrays, each starting on an 8-byte boundary.  The header is
+#       { "version": 1, "arrays": [ { "dtype", "offset", "length" } ... ],
+#         "object": ... }, where "object" is the response with each array
+#       replaced by { "__array__": i }.  offset is in bytes from the start
+#       of the data.  dtype is "f4" or "f8", so the client can wrap the
+#       data in a Float32Array or Float64Array without copying.  (MJDs
+#       are f8; float32 can't hold them to better than several minutes.)
+
+class ArrayEncoder:
+    arraymime = 'application/x-snana-arrays'
+    magic = b'SNAR'
+    version = 1
+
+    @property
+    def mimetypes( self ):
+        """The encodings this process can produce, the default first."""
+        mimes = [ 'application/json', self.arraymime ]
+        if msgpack is not None:
+            mimes.append( 'application/msgpack' )
+        return mimes
+
+    @staticmethod
+    def _default( obj ):
+        # numpy arrays and scalars
+        return obj.tolist()
+
+    def encode( self, obj, mimetype='application/json' ):
+        """Return obj (dicts, lists, scalars, numpy arrays) encoded as bytes."""
+        if mimetype == 'application/json':
+            return self.json( obj )
+        elif mimetype == 'application/msgpack':
+            return msgpack.packb( obj, default=self._default )
+        elif mimetype == self.arraymime:
+            return self.arrays( obj )
+        raise ValueError( f"Unknown mimetype {mimetype}" )
+
+    def json( self, obj ):
+        if orjson is not None:
+            return orjson.dumps( obj, default=self._default,
+                                 option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS )
+        return json.dumps( obj, default=self._default ).encode( 'utf-8' )
+
+    def arrays( self, obj ):
+        arrays = []
+
+        def pull( thing ):
+            if isinstance( thing, numpy.ndarray ):
+                dtype = '<f4' if thing.dtype == numpy.float32 else '<f8'
+                arrays.append( numpy.ascontiguousarray( thing.ravel(), dtype=dtype ) )
+                return { '__array__': len(arrays) - 1 }
+            elif isinstance( thing, dict ):
+                return { str(k): pull(v) for k, v in thing.items() }
+            elif isinstance( thing, ( list, tuple ) ):
+                return [ pull(v) for v in thing ]
+            return thing
+
+        stripped = pull( obj )
+        offset = 0
+        desc = []
+        for arr in arrays:
+            desc.append( { 'dtype': arr.dtype.str[1:], 'offset': offset, 'length': len(arr) } )
+            offset += -( -arr.nbytes // 8 ) * 8
+
+        header = json.dumps( { 'version': self.version, 'arrays': desc, 'object': stripped },
+                             default=self._default ).encode( 'utf-8' )
+        header += b' ' * ( -( len(header) + 8 ) % 8 )
+        chunks = [ self.magic, numpy.uint32( len(header) ).astype( '<u4' ).tobytes(), header ]
+        for arr in arrays:
+            chunks.append( arr.tobytes() )
+            chunks.append( b'\0' * ( -arr.nbytes % 8 ) )
+        return b''.join( chunks )
+
+
+arrayencoder = ArrayEncoder()
+
+# ======================================================================
+# Local decompressed copies of the sims' gzipped FITS files.
+#
+# /snana_sim is on a slow shared filesystem, and the HEAD and PHOT
+#   files there are gzipped, so reading one light curve meant inflating
+#   the whole PHOT file.  If SNANA_SUMMARY_FITS_CACHE_DIR is set,
+#   decompressed copies are kept there; they can be opened with
+#   memmap=True, so reading a light curve only touches the pages it
+#   needs.
+#
+# Copies are named by a hash of the source path plus the source's
+#   mtime and size, so a changed source gets a new copy (and the old
+#   one ages out).  A flock on a per-file lockfile makes sure only one
+#   process decompresses a given file at a time; the copy is written to
+#   a temporary file and renamed into place.  File mtimes are used for
+#   LRU; when the directory goes over its budget, the least recently
+#   used copies are deleted.
+
+class FITSCache:
+    touch_interval = 60
+
+    def __init__( self, cachedir=None, maxbytes=0 ):
+        self.cachedir = None if cachedir is None else pathlib.Path( cachedir )
+        self.maxbytes = maxbytes
+
+    @property
+    def enabled( self ):
+        return self.cachedir is not None
+
+    def _localpath( self, path, st ):
+        hsh = hashlib.sha1( str( path.resolve() ).encode( 'utf-8' ) ).hexdigest()[0:16]
+        name = path.name[:-3] if path.name[-3:] == '.gz' else path.name
+        return self.cachedir / f'{hsh}-{st.st_mtime_ns}-{st.st_size}-{name}'
+
+    def local( self, path ):
+        """Return the path to a decompressed local copy of path.
+
+        Returns path itself if the cache isn't enabled, if path isn't
+        gzipped, or if making the copy fails.
+
+        """
+        path = pathlib.Path( path )
+        if ( not self.enabled ) or ( path.name[-3:] != '.gz' ):
+            return path
+        try:
+            localpath = self._localpath( path, path.stat() )
+            try:
+                st = localpath.stat()
+                if time.time() - st.st_mtime > self.touch_interval:
+                    os.utime( localpath )
+                return localpath
+            except FileNotFoundError:
+                pass
+            self.fill( path, localpath )
+            self.evict( keep=localpath )
+            return localpath
+        except Exception as ex:
+            app.logger.warning( f"Failed to get local copy of {path}, reading it in place: {ex}" )
+            return path
+
+    def fill( self, path, localpath ):
+        self.cachedir.mkdir( parents=True, exist_ok=True )
+        with open( localpath.parent / f'.{localpath.name}.lock', 'w' ) as lockfp:
+            fcntl.flock( lockfp, fcntl.LOCK_EX )
+            try:
+                # Another process may have made it while we waited for the lock
+                if localpath.is_file():
+                    return
+                with tempfile.NamedTemporaryFile( dir=self.cachedir, prefix=f'.{localpath.name}.',
+                                                  delete=False ) as ofp:
+                    try:
+                        with gzip.open( path, 'rb' ) as ifp:
+                            shutil.copyfileobj( ifp, ofp, 1024 * 1024 )
+                        ofp.close()
+                        os.replace( ofp.name, localpath )
+                    except Exception:
+                        os.unlink( ofp.name )
+                        raise
+            finally:
+                fcntl.flock( lockfp, fcntl.LOCK_UN )
+                try:
+                    os.unlink( lockfp.name )
+                except FileNotFoundError:
+                    pass
+
+    def open( self, path, **kwargs ):
+        """fits.open the local copy of path (see local).
+
+        If the copy disappears (evicted by another process) between local()
+        and the open, opens path itself instead.
+
+        """
+        path = pathlib.Path( path )
+        localpath = self.local( path )
+        try:
+            return fits.open( localpath, **kwargs )
+        except FileNotFoundError:
+            if localpath == path:
+                raise
+            app.logger.warning( f"Local copy of {path} went away, reading it in place" )
+            return fits.open( path, **kwargs )
+
+    def evict( self, keep=None ):
+        """Delete the least recently used copies until the cache is within its budget.
+
+        Copies used in the last touch_interval seconds (local() touches
+        them), and keep (the copy just made), aren't deleted, even if that
+        leaves the cache over budget for a while.
+
+        """
+        with open( self.cachedir / '.evict.lock', 'w' ) as lockfp:
+            try:
+                fcntl.flock( lockfp, fcntl.LOCK_EX | fcntl.LOCK_NB )
+            except BlockingIOError:
+                # Somebody else is already doing it
+                return
+            try:
+                files = []
+                for f in self.cachedir.iterdir():
+                    if f.name[0] == '.':
+                        continue
+                    try:
+                        st = f.stat()
+                    except FileNotFoundError:
+                        continue
+                    files.append( ( st.st_mtime, st.st_size, f ) )
+                totbytes = sum( f[1] for f in files )
+                for mtime, size, f in sorted( files ):
+                    if totbytes <= self.maxbytes:
+                        break
+                    try:
+                        # Look again, it may have been used since the listing
+                        if ( f == keep ) or ( time.time() - f.stat().st_mtime < self.touch_interval ):
+                            continue
+                        app.logger.debug( f"Evicting {f.name} from FITS cache" )
+                        f.unlink()
+                    except FileNotFoundError:
+                        pass
+                    totbytes -= size
+            finally:
+                fcntl.flock( lockfp, fcntl.LOCK_UN )
+
+    def prewarm( self, simdirs ):
+        """Make local copies of all the gzipped HEAD and PHOT files in simdirs."""
+        if not self.enabled:
+            raise RuntimeError( "SNANA_SUMMARY_FITS_CACHE_DIR isn't set" )
+        for simdir in simdirs:
+            for path in sorted( pathlib.Path( simdir ).glob( "*.FITS.gz" ) ):
+                app.logger.info( f"Prewarming {path}" )
+                self.local( path )
+
+
+fitscache = FITSCache( os.getenv( "SNANA_SUMMARY_FITS_CACHE_DIR" ),
+                       int( float( os.getenv( "SNANA_SUMMARY_FITS_CACHE_GB", 20 ) ) * 1024 * 1024 * 1024 ) )
 
 # ======================================================================
 
@@ -48,20 +827,212 @@ class BaseView(flask.views.View):
             kwargs.update( flask.request.json )
         return kwargs
 
+    @property
+    def datadir( self ):
+        """The (resolved) data directory of the data version this request is using; see DataVersion."""
+        return datasnapshot().root
+
     def readjson( self, collection, which ):
-        f = pathlib.Path( f"/data/{collection}_{which}.json" )
+        f = self.datadir / f"{collection}_{which}.json"
         if not f.is_file():
             raise Exception( f'No {which} file for {collection}' )
         with open( f ) as ifp:
             jsontext = ifp.read()
         return jsontext
 
-    def returnjson( self, collection, which ):
-        jsontext = self.readjson( collection, which )
-        response = flask.make_response( jsontext )
-        response.headers['Content-Type'] = 'application/json'
+    def loadjson( self, collection, which ):
+        """Return the decoded contents of a data directory json file, through the per-process jsoncache.
+
+        Don't modify what you get back; it's shared with other requests.
+
+        """
+        f = self.datadir / f"{collection}_{which}.json"
+        if not f.is_file():
+            raise Exception( f'No {which} file for {collection}' )
+        return jsoncache.get( f )
+
+    def simfile( self, collection, sim ):
+        """Find the file that has the full information about one sim.
+
+        If the ingest wrote a {collection}_surveyindex.json, that's the
+        sim's shard; otherwise, it's the monolithic {collection}_surveys.json.
+
+        Returns path, key.  key is None if path is a shard, or the key
+        to look up in the decoded file if path is {collection}_surveys.json.
+        path is None if the sim isn't in the index.
+
+        """
+        indexfile = self.datadir / f"{collection}_surveyindex.json"
+        if indexfile.is_file():
+            index = jsoncache.get( indexfile )
+            if sim not in index:
+                return None, None
+            return self.datadir / index[sim]['shard'], None
+        f = self.datadir / f"{collection}_surveys.json"
+        if not f.is_file():
+            raise Exception( f'No surveys file for {collection}' )
+        return f, sim
+
+    def loadsim( self, collection, sim ):
+        """Return the (decoded) surveys entry for one sim, or None if it doesn't exist.
+
+        Reads just the sim's shard if there is one.  Don't modify what you
+        get back; it's shared with other requests.
+
+        """
+        path, key = self.simfile( collection, sim )
+        if path is None:
+            return None
+        obj = jsoncache.get( path )
+        return obj if key is None else obj.get( key )
+
+    def simstamp( self, collection, sim ):
+        """A string that changes whenever the file loadsim would read changes."""
+        path, key = self.simfile( collection, sim )
+        if path is None:
+            return None
+        st = path.stat()
+        return f'{st.st_mtime_ns}-{st.st_size}'
+
+    def canonical_args( self, data ):
+        """Turn a dictionary of plot parameters into something that doesn't depend on order or on types.
+
+        Parameters come in as strings from the URL, but may be numbers if
+        they came in a json body; str() them all so "600" and 600 match.
+
+        """
+        return sorted( ( str(k), str(v) ) for k, v in data.items() )
+
+    def cachedresponse( self, ent ):
+        """Build a response from a plotcache entry, gzipped if the client takes that."""
+        if flask.request.accept_encodings[ 'gzip' ]:
+            response = flask.make_response( ent['gzip'] )
+            response.headers['Content-Encoding'] = 'gzip'
+        else:
+            response = flask.make_response( ent['body'] )
+        response.headers['Content-Type'] = ent['content_type']
+        response.headers['Vary'] = 'Accept-Encoding'
+        return response
+
+    # Plot views can return format=svg (an image) or format=json (the plot spec, see plotrender)
+    plotformats = { 'svg': 'image/svg+xml', 'json': 'application/json' }
+
+    def renderspec( self, spec, data ):
+        """Turn a plot spec into the bytes to send back, according to data['format']."""
+        if data['format'] == 'json':
+            return json.dumps( spec, default=lambda x: x.tolist() ).encode( 'utf-8' )
+        return renderpool.render( spec )
+
+    def cachedplot( self, cachekey, render, content_type='image/svg+xml' ):
+        """Return the plot with cachekey from plotcache, or render and cache it.
+
+        render is a callable that returns the plot as bytes, or else
+        something to return as an (error) response.  Identical concurrent
+        requests only render once; see SingleFlight.
+
+        """
+        ent = self.cachedplotent( cachekey, render, content_type )
+        if not isinstance( ent, dict ):
+            return ent
+        return self.cachedresponse( ent )
+
+    def cachedplotent( self, cachekey, render, content_type='image/svg+xml' ):
+        """Like cachedplot, but returns the plotcache entry (a dict) rather than a response.
+
+        If rendering failed, returns the error response instead.
+
+        """
+        ent = plotcache.get( cachekey, content_type )
+        if ent is None:
+            with singleflight.hold( cachekey ):
+                ent = plotcache.get( cachekey, content_type )
+                if ent is None:
+                    try:
+                        body = render()
+                    except plotrender.RenderBusy as ex:
+                        app.logger.warning( str(ex) )
+                        return f"Server too busy to render plot: {ex}", 503
+                    if not isinstance( body, bytes ):
+                        return body
+                    ent = plotcache.put( cachekey, body, content_type )
+        return ent
+
+    def sendpayload( self, name, sources, builder=None ):
+        """Send a json payload built from files in /data, with ETag / Last-Modified and 304 handling.
+
+        name : str
+          Identifies the payload; see JSONPayloads.get
+
+        sources : list of Path
+          The files the payload is built from.  If there's only one and
+          builder is None, the payload is just that file.
+
+        builder : callable or None
+          Returns the (uncompressed) payload as bytes.
+
+        """
+        sts = [ f.stat() for f in sources ]
+        stamp = hashlib.sha1( ';'.join( f'{f.name}:{st.st_mtime_ns}:{st.st_size}:{st.st_ino}'
+                                        for f, st in zip( sources, sts ) ).encode( 'utf-8' ) ).hexdigest()[0:16]
+        lastmod = max( st.st_mtime for st in sts )
+
+        encoding = flask.request.accept_encodings.best_match( jsonpayloads.encodings, default='identity' )
+        single = sources[0] if ( builder is None ) and ( len(sources) == 1 ) else None
+        if builder is None:
+            builder = lambda: single.read_bytes()
+        payload = jsonpayloads.get( name, stamp, encoding, builder, source=single,
+                                    sourcetime=max( st.st_mtime_ns for st in sts ) )
+
+        etag = stamp if encoding == 'identity' else f'{stamp}-{encoding}'
+        if isinstance( payload, pathlib.Path ):
+            response = flask.send_file( payload, mimetype='application/json', conditional=True,
+                                        etag=etag, last_modified=lastmod )
+        else:
+            response = flask.make_response( payload )
+            response.headers['Content-Type'] = 'application/json'
+            response.set_etag( etag )
+            response.last_modified = lastmod
+            response = response.make_conditional( flask.request )
+        if encoding != 'identity':
+            response.headers['Content-Encoding'] = encoding
+        response.headers['Vary'] = 'Accept-Encoding'
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
+
+    def objectmimetype( self ):
+        """The encoding the Accept header asks for; see ArrayEncoder.  Defaults to json."""
+        return flask.request.accept_mimetypes.best_match( arrayencoder.mimetypes, default='application/json' )
+
+    def sendobject( self, obj ):
+        """Send obj (which may contain numpy arrays) in the encoding the Accept header asks for."""
+        mimetype = self.objectmimetype()
+        response = flask.make_response( arrayencoder.encode( obj, mimetype ) )
+        response.headers['Content-Type'] = mimetype
+        response.headers['Vary'] = 'Accept'
+        return response
+
+    def sendcachedobject( self, cachekey, build ):
+        """Like sendobject, but the encoded object is kept in plotcache under cachekey.
+
+        build is a callable that returns the object; it's only called if
+        the object isn't already cached in the requested encoding.
+
+        """
+        mimetype = self.objectmimetype()
+        cachekey = plotcache.key( cachekey, mimetype )
+        ent = self.cachedplotent( cachekey, lambda: arrayencoder.encode( build(), mimetype ), mimetype )
+        if not isinstance( ent, dict ):
+            return ent
+        response = self.cachedresponse( ent )
+        response.headers['Vary'] = 'Accept, Accept-Encoding'
         return response
 
+    def returnjson( self, collection, which ):
+        f = self.datadir / f"{collection}_{which}.json"
+        if not f.is_file():
+            raise Exception( f'No {which} file for {collection}' )
+        return self.sendpayload( f'{collection}_{which}', [ f ] )
+
 # ======================================================================
 
 class MainPage(BaseView):
@@ -72,12 +1043,10 @@ class MainPage(BaseView):
 
 class Collections(BaseView):
     def dispatch_request( self ):
-        d = pathlib.Path( "/data" )
-        jsonlist = list( d.glob( '*surveys.json' ) )
-        jsonlist = [ str(i.name).replace( '_surveys.json', '' ) for i in jsonlist ]
-        jsonlist.sort()
+        snapshot = datasnapshot()
         return { 'status': 'ok',
-                 'collections': jsonlist }
+                 'dataversion': snapshot.token,
+                 'collections': list( snapshot.collections ) }
 # ======================================================================
 
 class SurveyInfo(BaseView):
@@ -94,261 +1063,336 @@ class AnalysisInfo(BaseView):
 
 class Tiers(BaseView):
     def dispatch_request( self, collection ):
-        return self.returnjson( colletion, 'tiers' )
+        return self.returnjson( collection, 'tiers' )
 
 class Surveys(BaseView):
     def dispatch_request( self, collection ):
         return self.returnjson( collection, 'surveys' )
 
+class SurveyIndex(BaseView):
+    def dispatch_request( self, collection ):
+        return self.returnjson( collection, 'surveyindex' )
+
+class SimData(BaseView):
+    def dispatch_request( self, collection, sim ):
+        path, key = self.simfile( collection, sim )
+        if path is None:
+            return f"error, could not find survey {sim} in collection {collection}", 500
+        if key is None:
+            return self.sendpayload( f'{collection}_sims_{path.stem}', [ path ] )
+
+        # No shards for this collection; pull the one sim out of {collection}_surveys.json
+        survey = self.loadsim( collection, sim )
+        if survey is None:
+            return f"error, could not find survey {sim} in collection {collection}", 500
+        return self.sendpayload( f'{collection}_sims_{hashlib.sha1( sim.encode("utf-8") ).hexdigest()}', [ path ],
+                                 lambda: json.dumps( survey ).encode( 'utf-8' ) )
+
 # ======================================================================
 
 class SummaryData(BaseView):
+    parts = [ 'surveyinfo', 'instrinfo', 'analysisinfo', 'tiers', 'surveys' ]
+
     def dispatch_request( self, collection ):
         try:
-            si = self.readjson( collection, 'surveyinfo' )
-            ii = self.readjson( collection, 'instrinfo' )
-            ai = self.readjson( collection, 'analysisinfo' )
-            t = self.readjson( collection, 'tiers' )
-            s = self.readjson( collection, 'surveys' )
+            files = []
+            for which in self.parts:
+                f = self.datadir / f"{collection}_{which}.json"
+                if not f.is_file():
+                    raise Exception( f'No {which} file for {collection}' )
+                files.append( f )
         except Exception as e:
             return str(e), 500
 
-        response = flask.make_response( f'{{"status": "ok", "surveyinfo": {si}, "instrinfo": {ii}, '
-                                        f'"analysisinfo": {ai}, "tiers": {t}, "surveys": {s} }}' )
-        response.headers['Content-Type'] = 'application/json'
-        return response
+        def build():
+            body = io.BytesIO()
+            body.write( b'{"status": "ok"' )
+            for which, f in zip( self.parts, files ):
+                body.write( f', "{which}": '.encode( 'utf-8' ) )
+                body.write( f.read_bytes() )
+            body.write( b' }' )
+            return body.getvalue()
+
+        return self.sendpayload( f'{collection}_summarydata', files, build )
 
 # ======================================================================
 
 class SNZHist(BaseView):
+    def prepare( self, collection, sim, args ):
+        """Returns ( cachekey, data, error ); error is None or an error response."""
+        data = { 'width': 600,
+                 'height': 500,
+                 'whichhist': 'zhist',
+                 'gentype': 10,
+                 'tier': "__ALL__",
+                 'renderer': 'fast',
+                 'format': 'svg'
+                 }
+        data.update( args )
+        if data['renderer'] not in plotrender.bar_renderers:
+            return None, data, ( f"renderer must be one of {', '.join( plotrender.bar_renderers )}", 500 )
+        if data['format'] not in self.plotformats:
+            return None, data, ( f"format must be one of {', '.join( self.plotformats )}", 500 )
+
+        cachekey = plotcache.key( 'snzhist', collection, sim, self.canonical_args( data ),
+                                  self.simstamp( collection, sim ) )
+        return cachekey, data, None
+
     def dispatch_request( self, collection, sim, argstr=None ):
         try:
-            data = { 'width': 600,
-                     'height': 500,
-                     'whichhist': 'zhist',
-                     'gentype': 10,
-                     'tier': "__ALL__"
-                     }
-            data.update( self.argstr_to_args( argstr ) )
-
-            surveys = json.loads( self.readjson( collection, 'surveys' ) )
-            if sim not in surveys.keys():
-                app.logger.error( f"error, could not find survey {sim} in collection {collection}\n" )
-                return f'error, could not find survey {sim} in collection {collection}', 500
-
-            survey = surveys[sim]
-
-            gentypes = []
-            gentypemap = survey['gentypemap']
-            if data['gentype'] == "__ALL__":
-                gentypes = list( gentypemap.keys() )
-            elif data['gentype'] == "__ALLBUTIA__":
-                gentypes = [ t for t in list( gentypemap.keys() ) if t != '10' ]
-            else:
-                # gentypemap keys are strings, not integers, and I'm kind of boggled by that,
-                #   but this is what happens when you work in a type-loosey-goosey language
-                gentype = str( data['gentype'] )
-                # nl = '\n'
-                # sys.stderr.write( f'gentypemap.keys() = '
-                #                   f'{nl.join( [f"{i} (type {type(i)})" for i in gentypemap.keys() ] )}\n' )
-                if gentype not in gentypemap.keys():
-                    app.logger.error( f"Asked for unknown gentype {gentype}\n" )
-                    return f"Asked for unknown gentype {gentype}", 500
-                gentypes = [ gentype ]
-
-            histdata = None
-            if data['whichhist'] == 'zhist':
-                histdata = survey['zhist']
-            elif data['whichhist'] == 'snrmaxzhist':
-                histdata = survey['snrmaxzhist']
-            elif data['whichhist'] == 'snrmax2zhist':
-                histdata = survey['snrmax2zhist']
-            elif data['whichhist'] == 'snrmax3zhist':
-                histdata = survey['snrmax3zhist']
-            else:
-                app.logger.error( f'Unknown snrmax {whichhist}, must be one of '
-                                  f'(zhist,snrmaxzhist,snrmax2zhist,snrmax3zhist)\n' )
-                return f'Unknown snrmax {snrmax}', 500
-
-            tiers = []
-            if data['tier'] == '__ALL__':
-                tiers = []
-                for t in histdata['tier']:
-                    if t not in tiers:
-                        tiers.append( t )
-            else:
-                if data['tier'] not in histdata['tier']:
-                    return f'Unknown tier {data["tier"]}', 500
-                tiers = [ data['tier'] ]
-
-            if ( len(tiers) < 1 ) or ( len(gentypes) < 1 ):
-                return f'Ended up with {len(tiers)} tiers and {len(gentypes)}; must have at least 1 of both'
-
-            nbars = len( tiers ) * len( gentypes )
-            dpi = 72
-
-            # TODO : types.  gentypemap, gentype, gentypes, blah.  int or str?
-
-            fig = pyplot.figure( figsize=(data['width']/dpi, data['height']/dpi), dpi=dpi, tight_layout=True )
-            ax = fig.add_subplot( 1, 1, 1 )
-            # dz = histdata['zCMB'][1] - histdata['zCMB'][0] # this is wrong
-            dz = 0.1 # TODO NOT HARDCODE
-            totwid = 0.90
-            onewid = totwid * dz / nbars
-            offset = 0.
-            # sys.stderr.write( f"histdata.keys() = {histdata.keys()}\n" )
-            # sys.stderr.write( f"zcmb: {histdata['zCMB']}\n"
-            #                   f"n: {histdata['n']}\n"
-            #                   f"tier: {histdata['tier']}\n"
-            #                   f"gentype: {histdata['gentype']}\n" )
-            # sys.stderr.write( f"histdata['tier'][0]=='DEEP' = {histdata['tier'][0]=='DEEP'}\n" )
-            # sys.stderr.write( f"histdata['gentype'][0]==10 = {histdata['gentype'][0]==10}\n" )
-            histzcmb = numpy.array( histdata['zCMB'] )
-            histn = numpy.array( histdata['n'] )
-            histtier = numpy.array( histdata['tier'] )
-            histtype = numpy.array( histdata['gentype' ] )
-            for gentype in gentypes:
-                gentype = int(gentype)
-                for tier in tiers:
-                    x = histzcmb[ ( histtier == tier ) & ( histtype == gentype ) ]
-                    y = histn[ ( histtier == tier ) & ( histtype == gentype ) ]
-                    ax.bar( x + offset, height=y, width=onewid, align='edge',
-                            label=f'{tier} {gentypemap[str(gentype)]} ({y.sum()})' )
-                    offset += totwid * dz / nbars
-
-            ax.legend( fontsize=12 )
-            ax.tick_params( "both", labelsize=12 )
-            ax.set_xlabel( r'z_CMB', fontsize=16 )
-            ax.set_ylabel( r'n Roman-discovered objects', fontsize=16 )
-            ax.set_title( f'{sim} ; FoM_stat = {surveys[sim]["muopt"][0]["FoM_stat"]:.1f}', fontsize=16 )
-
-            bio = io.BytesIO()
-            fig.savefig( bio, format='svg' )
-            pyplot.close( fig )
-
-            response = flask.make_response( bio.getvalue() )
-            # response.headers['Content-Type'] = 'image/png'
-            response.headers['Content-Type'] = 'image/svg+xml'
-
-            return response
+            cachekey, data, err = self.prepare( collection, sim, self.argstr_to_args( argstr ) )
+            if err is not None:
+                return err
+            return self.cachedplot( cachekey, lambda: self.render( collection, sim, data ),
+                                    self.plotformats[ data['format'] ] )
         except Exception as e:
             app.logger.exception( e )
             return flask.abort( 500 )
 
+
+    def render( self, collection, sim, data ):
+        """Return the svg, or an error response."""
+        survey = self.loadsim( collection, sim )
+        if survey is None:
+            app.logger.error( f"error, could not find survey {sim} in collection {collection}\n" )
+            return f'error, could not find survey {sim} in collection {collection}', 500
+
+        gentypes = []
+        gentypemap = survey['gentypemap']
+        if data['gentype'] == "__ALL__":
+            gentypes = list( gentypemap.keys() )
+        elif data['gentype'] == "__ALLBUTIA__":
+            gentypes = [ t for t in list( gentypemap.keys() ) if t != '10' ]
+        else:
+            # gentypemap keys are strings, not integers, and I'm kind of boggled by that,
+            #   but this is what happens when you work in a type-loosey-goosey language
+            gentype = str( data['gentype'] )
+            # nl = '\n'
+            # sys.stderr.write( f'gentypemap.keys() = '
+            #                   f'{nl.join( [f"{i} (type {type(i)})" for i in gentypemap.keys() ] )}\n' )
+            if gentype not in gentypemap.keys():
+                app.logger.error( f"Asked for unknown gentype {gentype}\n" )
+                return f"Asked for unknown gentype {gentype}", 500
+            gentypes = [ gentype ]
+
+        histdata = None
+        if data['whichhist'] == 'zhist':
+            histdata = survey['zhist']
+        elif data['whichhist'] == 'snrmaxzhist':
+            histdata = survey['snrmaxzhist']
+        elif data['whichhist'] == 'snrmax2zhist':
+            histdata = survey['snrmax2zhist']
+        elif data['whichhist'] == 'snrmax3zhist':
+            histdata = survey['snrmax3zhist']
+        else:
+            app.logger.error( f'Unknown snrmax {whichhist}, must be one of '
+                              f'(zhist,snrmaxzhist,snrmax2zhist,snrmax3zhist)\n' )
+            return f'Unknown snrmax {snrmax}', 500
+
+        tiers = []
+        if data['tier'] == '__ALL__':
+            tiers = []
+            for t in histdata['tier']:
+                if t not in tiers:
+                    tiers.append( t )
+        else:
+            if data['tier'] not in histdata['tier']:
+                return f'Unknown tier {data["tier"]}', 500
+            tiers = [ data['tier'] ]
+
+        if ( len(tiers) < 1 ) or ( len(gentypes) < 1 ):
+            return f'Ended up with {len(tiers)} tiers and {len(gentypes)}; must have at least 1 of both'
+
+        nbars = len( tiers ) * len( gentypes )
+
+        # TODO : types.  gentypemap, gentype, gentypes, blah.  int or str?
+
+        # dz = histdata['zCMB'][1] - histdata['zCMB'][0] # this is wrong
+        dz = 0.1 # TODO NOT HARDCODE
+        totwid = 0.90
+        onewid = totwid * dz / nbars
+        offset = 0.
+        histzcmb = numpy.array( histdata['zCMB'] )
+        histn = numpy.array( histdata['n'] )
+        histtier = numpy.array( histdata['tier'] )
+        histtype = numpy.array( histdata['gentype' ] )
+        series = []
+        for gentype in gentypes:
+            gentype = int(gentype)
+            for tier in tiers:
+                x = histzcmb[ ( histtier == tier ) & ( histtype == gentype ) ]
+                y = histn[ ( histtier == tier ) & ( histtype == gentype ) ]
+                series.append( { 'x': x + offset, 'y': y, 'label': f'{tier} {gentypemap[str(gentype)]} ({y.sum()})' } )
+                offset += totwid * dz / nbars
+
+        spec = { 'kind': 'bars',
+                 'width': int( data['width'] ),
+                 'height': int( data['height'] ),
+                 'series': series,
+                 'barwidth': onewid,
+                 'xlim': None,
+                 'xlabel': r'z_CMB',
+                 'ylabel': r'n Roman-discovered objects',
+                 'title': f'{sim} ; FoM_stat = {survey["muopt"][0]["FoM_stat"]:.1f}',
+                 'renderer': data['renderer'] }
+        return self.renderspec( spec, data )
+
 # ======================================================================
 
-class SpecHist(BaseView):
-    def dispatch_request( self, which, collection, sim, strategy, argstr=None ):
-        try:
-            data = { 'width': 600,
-                     'height': 500,
-                     'gentype': 10,
-                     'tier': "__ALL__",
-                     'zbin': None,
-                     'tbin': None,
-                     'magbin': None,
-                     'snrbin': None,
-                     'band': 'J',
-                     'tframe': 'obs'
-                    }
-            data.update( self.argstr_to_args( argstr ) )
-
-            if which not in [ 'mag', 'snr', 'z', 'rest_phase_z' ]:
-                return f'which must be one of mag, snr, z, or rest_phase_z', 500
-
-            if data['tframe'] == 'rest':
-                data['banddf'] = f"{data['band']}_restframe"
-            elif data['tframe'] == 'obs':
-                data['banddf'] = data['band']
-            else:
-                return f'tframe must be rest or obs', 500
-
-            surveys = json.loads( self.readjson( collection, 'surveys' ) )
-            if sim not in surveys.keys():
-                sys.stderr.write( f"error, could not find survey {sim} in collection {collection}\n" )
-                return f"error, could not find survey {sim} in collection {collection}", 500
-
-            survey = surveys[sim]
-            if ( 'spechists' not in surveys[sim] ) or ( len(surveys[sim]['spechists']) == 0 ):
-                return f"Survey doesn't have prism info.", 500
-            data['gentypemap'] = survey['gentypemap']
-
-            spechists = survey['spechists']
-
-            if ( strategy < 0 ) or ( strategy >= spechists['nspecstrategies'] ):
-                return f"There are {spechists['nspecstrategies']} spectrum stragies; {strategy} is out of range", 500
-
-            if data['tbin'] is None:
-                data['tbin'] = int( -spechists['tobsmin'] / spechists['deltat'] + 0.5 )
-            if data['snrbin'] is None:
-                data['snrbin'] = int( ( 10. - spechists['snirmin'] ) / spechists['deltasnr'] + 0.5 )
-            if data['zbin'] is None:
-                data['zbin'] = 5
-            if data['magbin'] is None:
-                data['magbin'] = 5
-
-            data['tbin'] = int( data['tbin'] )
-            data['t'] = spechists['tobsmin'] + data['tbin'] * spechists['deltat']
-            data['snrbin'] = int( data['snrbin'] )
-            data['snr'] = spechists['snrmin'] + data['snrbin'] * spechists['deltasnr']
-            if ( data['zbin'] == '__all__' ):
-                data['z'] = '(all)';
-            else:
-                data['zbin'] = int( data['zbin'] )
-                data['z'] = spechists['zmin'] + data['zbin'] * spechists['deltaz']
-            if ( data['magbin'] == '__all__' ):
-                data['mag'] = '(all)'
-            else:
-                data['magbin'] = int( data['magbin'] )
-                data['mag'] = spechists['mmin'] + data['magbin'] * spechists['deltam']
+class SpecHistCube:
+    """One table of spechists['spectrumhists'][strategy][tier][band] as a dense numpy array.
 
-            if data['tier'] == '__ALL__':
-                data['tier'] = list( spechists['spectrumhists'][strategy].keys() )
-            else:
-                data['tier'] = [ data['tier'] ]
+    The tables in the surveys json are lists of (GENTYPE, zbin, tbin,
+    magbin, snrbin, n) for the bins that have anything in them.  (For
+    the <band>_restframe tables, tbin is trestbin.)  This turns one of
+    them into an array with axes (gentype, zbin, tbin, magbin, snrbin).
+    Along the snr axis the counts are cumulative from the top down, so
+    cum[..., k] is the number of things with snrbin ≥ k (+offset).  The
+    histograms SpecHist plots are then slices and sums of this.
 
-            # This will be used in spechist_*
+    Bins along the z, t, mag, and snr axes start at self.offsets, which
+    can be negative.
 
-            data['deltaz'] = spechists['deltaz']
-            data['deltat'] = spechists['deltat']
-            data['deltasnr'] = spechists['deltasnr']
-            data['deltam'] = spechists['deltam']
+    """
 
-            # Gentype counting
-            gentypes = []
-            for tier in data['tier']:
-                df = pandas.DataFrame( spechists['spectrumhists'][strategy][tier][data['banddf']] )
-                if ( data['gentype'] == '__ALL__' ) or ( data['gentype'] == '__ALLBUTIA__' ):
-                    for gentype in df['GENTYPE'].unique():
-                        if gentype not in gentypes:
-                            if ( data['gentype'] == '__ALL__' ) or ( gentype != 10 ):
-                                gentypes.append( gentype )
-
-            if len(gentypes) == 0:
-                gentype = data['gentype']
-                if str(gentype) not in data['gentypemap'].keys():
-                    return f"Asked for unknown gentype {gentype}", 500
-                gentypes = [ gentype ]
-
-            if which == 'mag':
-                return self.spechist_mag( sim, survey, spechists['spectrumhists'][strategy], gentypes,
-                                          spechists['mmin'], spechists['mmax'], spechists['deltam'],
-                                          data, argstr )
-            elif which == "snr":
-                return self.spechist_snr( sim, survey, spechists['spectrumhists'][strategy], gentypes,
-                                          spechists['snrmin'], spechists['snrmax'], spechists['deltasnr'],
-                                          data, argstr )
-            elif which == "z":
-                return self.spechist_z( sim, survey, spechists['spectrumhists'][strategy], gentypes,
-                                        spechists['zmin'], spechists['zmax'], spechists['deltaz'],
-                                        data, argstr )
-            elif which == "rest_phase_z":
-                return self.heatmap_restphase_z( sim, survey, spechists['spectrumhists'][strategy], gentypes,
-                                                 spechists['zmin'], spechists['zmax'], spechists['deltaz'],
-                                                 spechists['tobsmin'], spechists['tobsmax'], spechists['deltat'],
-                                                 data, argstr )
-            else:
-                return "Error 27B/6", 500
+    axes = [ 'zbin', 'tbin', 'magbin', 'snrbin' ]
+
+    def __init__( self, table ):
+        tcol = 'trestbin' if 'trestbin' in table else 'tbin'
+        gentype = numpy.asarray( table['GENTYPE'], dtype=numpy.int64 )
+        cols = [ numpy.asarray( table[c], dtype=numpy.int64 ) for c in ( 'zbin', tcol, 'magbin', 'snrbin' ) ]
+        n = numpy.asarray( table['n'], dtype=numpy.int64 )
+
+        self.gentypes = numpy.unique( gentype )
+        if len( n ) == 0:
+            self.offsets = numpy.zeros( 4, dtype=numpy.int64 )
+            self.cum = numpy.zeros( ( 0, 0, 0, 0, 0 ), dtype=numpy.int32 )
+        else:
+            self.offsets = numpy.array( [ c.min() for c in cols ] )
+            shape = [ len(self.gentypes) ] + [ c.max() - c.min() + 1 for c in cols ]
+            counts = numpy.zeros( shape, dtype=numpy.int64 )
+            numpy.add.at( counts,
+                          ( numpy.searchsorted( self.gentypes, gentype ),
+                            *[ c - off for c, off in zip( cols, self.offsets ) ] ),
+                          n )
+            self.cum = numpy.ascontiguousarray( counts[ ..., ::-1 ].cumsum( axis=-1 )[ ..., ::-1 ],
+                                                dtype=numpy.int32 )
+
+    @property
+    def nbytes( self ):
+        return self.cum.nbytes
+
+    def _take( self, arr, arraxes, axis, binval ):
+        """Pick bin binval along axis out of arr (whose axes are named by arraxes); zeros if out of range."""
+        pos = arraxes.index( axis )
+        dex = binval - self.offsets[ self.axes.index( axis ) ]
+        if ( dex < 0 ) or ( dex >= arr.shape[pos] ):
+            return numpy.zeros( arr.shape[:pos] + arr.shape[pos+1:], dtype=arr.dtype )
+        return numpy.take( arr, dex, axis=pos )
+
+    def _snrcut( self, arr, snrbin ):
+        """Counts with snrbin ≥ snrbin, from cumulative arr (snr is the last axis)."""
+        dex = 0 if snrbin is None else max( 0, snrbin - self.offsets[3] )
+        if dex >= arr.shape[-1]:
+            return numpy.zeros( arr.shape[:-1], dtype=arr.dtype )
+        return arr[ ..., dex ]
+
+    def counts_along( self, axis, gentype, tbin=None, zbin=None, snrbin=None ):
+        """Histogram of one gentype along axis.
+
+        axis : one of 'zbin', 'magbin', 'snrbin'
+
+        tbin, zbin : int or None
+           Only count things in this t (or trest) bin / z bin.  None means all.
+
+        snrbin : int or None
+           Only count things with snrbin ≥ this.  Ignored for axis='snrbin'.
+
+        Returns bins, n, for the bins that have anything in them.
+
+        """
+        empty = numpy.array( [], dtype=numpy.int64 )
+        gdex = numpy.searchsorted( self.gentypes, int(gentype) )
+        if ( gdex >= len(self.gentypes) ) or ( self.gentypes[gdex] != int(gentype) ):
+            return empty, empty
+
+        arr = self.cum[ gdex ]
+        if axis == 'snrbin':
+            arr = arr - numpy.concatenate( [ arr[ ..., 1: ], numpy.zeros_like( arr[ ..., :1 ] ) ], axis=-1 )
+        else:
+            arr = self._snrcut( arr, snrbin )
+        arraxes = self.axes[ 0 : arr.ndim ]
+
+        for fixaxis, binval in ( ( 'tbin', tbin ), ( 'zbin', zbin ) ):
+            if binval is not None:
+                arr = self._take( arr, arraxes, fixaxis, binval )
+                arraxes = [ a for a in arraxes if a != fixaxis ]
+
+        pos = arraxes.index( axis )
+        n = arr.sum( axis=tuple( i for i in range( arr.ndim ) if i != pos ) )
+        bins = self.offsets[ self.axes.index( axis ) ] + numpy.arange( len(n) )
+        nonzero = n > 0
+        return bins[ nonzero ], n[ nonzero ]
+
+    def grid( self, gentypes, snrbin=None ):
+        """Counts summed over gentypes and magnitude, as a function of (zbin, tbin), for snrbin ≥ snrbin.
+
+        Returns zoff, toff, arr ; arr[i, j] is the count for zbin zoff+i, tbin toff+j.
+
+        """
+        arr = numpy.zeros( self.cum.shape[1:3], dtype=numpy.int64 )
+        for gentype in gentypes:
+            gdex = numpy.searchsorted( self.gentypes, int(gentype) )
+            if ( gdex < len(self.gentypes) ) and ( self.gentypes[gdex] == int(gentype) ):
+                arr += self._snrcut( self.cum[ gdex ], snrbin ).sum( axis=2 )
+        return self.offsets[0], self.offsets[1], arr
+
+
+# ======================================================================
+
+class SpecHist(BaseView):
+    def prepare( self, which, collection, sim, strategy, args ):
+        """Returns ( cachekey, data, error ); error is None or an error response."""
+        data = { 'width': 600,
+                 'height': 500,
+                 'gentype': 10,
+                 'tier': "__ALL__",
+                 'zbin': None,
+                 'tbin': None,
+                 'magbin': None,
+                 'snrbin': None,
+                 'band': 'J',
+                 'tframe': 'obs',
+                 'renderer': 'fast',
+                 'format': 'svg'
+                }
+        data.update( args )
+        if data['renderer'] not in plotrender.bar_renderers:
+            return None, data, ( f"renderer must be one of {', '.join( plotrender.bar_renderers )}", 500 )
+        if data['format'] not in self.plotformats:
+            return None, data, ( f"format must be one of {', '.join( self.plotformats )}", 500 )
+
+        if which not in [ 'mag', 'snr', 'z', 'rest_phase_z' ]:
+            return None, data, ( f'which must be one of mag, snr, z, or rest_phase_z', 500 )
+
+        if data['tframe'] == 'rest':
+            data['banddf'] = f"{data['band']}_restframe"
+        elif data['tframe'] == 'obs':
+            data['banddf'] = data['band']
+        else:
+            return None, data, ( f'tframe must be rest or obs', 500 )
+
+        cachekey = plotcache.key( 'spechist', which, collection, sim, strategy, self.canonical_args( data ),
+                                  self.simstamp( collection, sim ) )
+        return cachekey, data, None
+
+    def dispatch_request( self, which, collection, sim, strategy, argstr=None ):
+        try:
+            cachekey, data, err = self.prepare( which, collection, sim, strategy, self.argstr_to_args( argstr ) )
+            if err is not None:
+                return err
+            return self.cachedplot( cachekey, lambda: self.render( which, collection, sim, strategy, data, argstr ),
+                                    self.plotformats[ data['format'] ] )
 
         except Exception as ex:
             sys.stderr.write( f"Exception: {ex}\n" )
@@ -356,62 +1400,149 @@ class SpecHist(BaseView):
             return flask.abort( 500 )
 
 
-    def plothist( self, sim, dfs, minval, maxval, delta, binstr, gentypes, survey, data, extra_title="", x_title="",
+    def render( self, which, collection, sim, strategy, data, argstr ):
+        """Return the svg, or an error response."""
+        survey = self.loadsim( collection, sim )
+        if survey is None:
+            sys.stderr.write( f"error, could not find survey {sim} in collection {collection}\n" )
+            return f"error, could not find survey {sim} in collection {collection}", 500
+
+        if ( 'spechists' not in survey ) or ( len(survey['spechists']) == 0 ):
+            return f"Survey doesn't have prism info.", 500
+        data['gentypemap'] = survey['gentypemap']
+
+        spechists = survey['spechists']
+
+        if ( strategy < 0 ) or ( strategy >= spechists['nspecstrategies'] ):
+            return f"There are {spechists['nspecstrategies']} spectrum stragies; {strategy} is out of range", 500
+
+        if data['tbin'] is None:
+            data['tbin'] = int( -spechists['tobsmin'] / spechists['deltat'] + 0.5 )
+        if data['snrbin'] is None:
+            data['snrbin'] = int( ( 10. - spechists['snrmin'] ) / spechists['deltasnr'] + 0.5 )
+        if data['zbin'] is None:
+            data['zbin'] = 5
+        if data['magbin'] is None:
+            data['magbin'] = 5
+
+        data['tbin'] = int( data['tbin'] )
+        data['t'] = spechists['tobsmin'] + data['tbin'] * spechists['deltat']
+        data['snrbin'] = int( data['snrbin'] )
+        data['snr'] = spechists['snrmin'] + data['snrbin'] * spechists['deltasnr']
+        if ( data['zbin'] == '__all__' ):
+            data['z'] = '(all)';
+        else:
+            data['zbin'] = int( data['zbin'] )
+            data['z'] = spechists['zmin'] + data['zbin'] * spechists['deltaz']
+        if ( data['magbin'] == '__all__' ):
+            data['mag'] = '(all)'
+        else:
+            data['magbin'] = int( data['magbin'] )
+            data['mag'] = spechists['mmin'] + data['magbin'] * spechists['deltam']
+
+        if data['tier'] == '__ALL__':
+            data['tier'] = list( spechists['spectrumhists'][strategy].keys() )
+        else:
+            data['tier'] = [ data['tier'] ]
+
+        # This will be used in spechist_*
+
+        data['deltaz'] = spechists['deltaz']
+        data['deltat'] = spechists['deltat']
+        data['deltasnr'] = spechists['deltasnr']
+        data['deltam'] = spechists['deltam']
+
+        cubes = { tier: self.spechistcube( collection, sim, survey, strategy, tier, data['banddf'] )
+                  for tier in data['tier'] }
+
+        # Gentype counting
+        gentypes = []
+        for tier in data['tier']:
+            if ( data['gentype'] == '__ALL__' ) or ( data['gentype'] == '__ALLBUTIA__' ):
+                for gentype in cubes[tier].gentypes:
+                    if gentype not in gentypes:
+                        if ( data['gentype'] == '__ALL__' ) or ( gentype != 10 ):
+                            gentypes.append( gentype )
+
+        if len(gentypes) == 0:
+            gentype = data['gentype']
+            if str(gentype) not in data['gentypemap'].keys():
+                return f"Asked for unknown gentype {gentype}", 500
+            gentypes = [ gentype ]
+
+        if which == 'mag':
+            svg = self.spechist_mag( sim, survey, spechists['spectrumhists'][strategy], cubes, gentypes,
+                                     spechists['mmin'], spechists['mmax'], spechists['deltam'],
+                                     data, argstr )
+        elif which == "snr":
+            svg = self.spechist_snr( sim, survey, spechists['spectrumhists'][strategy], cubes, gentypes,
+                                     spechists['snrmin'], spechists['snrmax'], spechists['deltasnr'],
+                                     data, argstr )
+        elif which == "z":
+            svg = self.spechist_z( sim, survey, spechists['spectrumhists'][strategy], cubes, gentypes,
+                                   spechists['zmin'], spechists['zmax'], spechists['deltaz'],
+                                   data, argstr )
+        elif which == "rest_phase_z":
+            restcubes = { tier: self.spechistcube( collection, sim, survey, strategy, tier,
+                                                   f"{data['band']}_restframe" )
+                          for tier in data['tier'] }
+            svg = self.heatmap_restphase_z( sim, survey, spechists['spectrumhists'][strategy], restcubes,
+                                            gentypes,
+                                            spechists['zmin'], spechists['zmax'], spechists['deltaz'],
+                                            spechists['tobsmin'], spechists['tobsmax'], spechists['deltat'],
+                                            data, argstr )
+        else:
+            return "Error 27B/6", 500
+
+        return svg
+
+
+    def spechistcube( self, collection, sim, survey, strategy, tier, band ):
+        """Get the SpecHistCube for one table of a sim's spectrumhists, from cubecache if it's there."""
+        key = ( collection, sim, self.simstamp( collection, sim ), strategy, tier, band )
+        cube = cubecache.get( key )
+        if cube is None:
+            cube = SpecHistCube( survey['spechists']['spectrumhists'][strategy][tier][band] )
+            cubecache.put( key, cube, cube.nbytes )
+        return cube
+
+
+    def plothist( self, sim, hists, minval, maxval, delta, gentypes, survey, data, extra_title="", x_title="",
                   gtonmaxxtick=None ):
+        """Plot grouped bars.  hists is { tier: { gentype: ( bins, n ) } }; bin b is at minval + b * delta."""
         nbars = len( data['tier'] ) * len( gentypes )
-        dpi = 72
 
-        fig = pyplot.figure( figsize=(data['width']/dpi, data['height']/dpi), dpi=dpi, tight_layout=True )
-        ax = fig.add_subplot( 1, 1, 1 )
         totwid = 0.90
         onewid = totwid * delta / nbars
         offset = 0.
+        series = []
         for gentype in gentypes:
             gentype = int( gentype )
             for tier in data['tier']:
-                df = dfs[tier]
-                df = df[ df['GENTYPE'] == gentype ]
-                x = minval + df[binstr] * delta
-                y = df['n']
-                ax.bar( x + offset, height=y, width=onewid, align='edge',
-                        label=f'{tier} {data["gentypemap"][str(gentype)]}' )
+                bins, y = hists[tier][gentype]
+                x = minval + bins * delta
+                series.append( { 'x': x + offset, 'y': y, 'label': f'{tier} {data["gentypemap"][str(gentype)]}' } )
                 offset += totwid * delta / nbars
 
-        ax.legend( fontsize=12 )
-        ax.tick_params( "both", labelsize=12 )
-        ax.set_xlim( minval, maxval )
-        ax.set_xlabel( x_title, fontsize=16 )
-        ax.set_ylabel( r'N', fontsize=16 )
-        ax.set_title( f'{sim} ; FoM_stat = {survey["muopt"][0]["FoM_stat"]:.1f}\nband {data["band"]}{extra_title}',
-                      fontsize=16 )
-
-        if gtonmaxxtick is not None:
-            xticklabels = [ item.get_text() for item in ax.get_xticklabels() ]
-            for i in range(len(xticklabels)):
-                if float( xticklabels[i] ) == gtonmaxxtick:
-                    xticklabels[i] = f"≥{xticklabels[i]}"
-            ax.set_xticklabels( xticklabels )
-
-        bio = io.BytesIO()
-        fig.savefig( bio, format='svg' )
-        pyplot.close( fig )
-
-        response = flask.make_response( bio.getvalue() )
-        response.headers['Content-Type'] = 'image/svg+xml'
-
-        return response
-
-
-    def spechist_z( self, sim, survey, spechists, gentypes, zmin, zmax, dz, data, argstr ):
-        # Pandafication
-        dfs = {}
-        tbin = 'trestbin' if data['tframe'] == 'rest' else 'tbin'
+        spec = { 'kind': 'bars',
+                 'width': int( data['width'] ),
+                 'height': int( data['height'] ),
+                 'series': series,
+                 'barwidth': onewid,
+                 'xlim': ( minval, maxval ),
+                 'xlabel': x_title,
+                 'ylabel': r'N',
+                 'title': f'{sim} ; FoM_stat = {survey["muopt"][0]["FoM_stat"]:.1f}\nband {data["band"]}{extra_title}',
+                 'gtonmaxxtick': gtonmaxxtick,
+                 'renderer': data['renderer'] }
+        return self.renderspec( spec, data )
+
+
+    def spechist_z( self, sim, survey, spechists, cubes, gentypes, zmin, zmax, dz, data, argstr ):
+        hists = {}
         for tier in data['tier']:
-            df = pandas.DataFrame( spechists[tier][data['banddf']] )
-            df = df.loc[ ( df[tbin] == data['tbin'] ) & ( df['snrbin'] >= data['snrbin'] ),
-                         [ 'GENTYPE', 'zbin', 'snrbin', 'n' ] ]
-            df = df.groupby( [ 'GENTYPE', 'zbin' ] ).sum()[ 'n' ].reset_index()
-            dfs[tier] = df
+            hists[tier] = { int(g): cubes[tier].counts_along( 'zbin', g, tbin=data['tbin'], snrbin=data['snrbin'] )
+                            for g in gentypes }
 
         extra_title = ""
         for tier in spechists.keys():
@@ -419,20 +1550,16 @@ class SpecHist(BaseView):
         extra_title += f"\nt_{data['tframe']}=[{data['t']:.0f},{data['t']+data['deltat']:.0f}) d, "
         extra_title += f"S/N≥{data['snr']:.0f}"
 
-        return self.plothist( sim, dfs, zmin, zmax, dz, 'zbin', gentypes, survey, data,
+        return self.plothist( sim, hists, zmin, zmax, dz, gentypes, survey, data,
                               extra_title=extra_title, x_title="z (heliocentric)" )
 
 
-    def spechist_mag( self, sim, survey, spechists, gentypes, mmin, mmax, dm, data, argstr ):
-        dfs = {}
-        tbin = 'trestbin' if data['tframe'] == 'rest' else 'tbin'
+    def spechist_mag( self, sim, survey, spechists, cubes, gentypes, mmin, mmax, dm, data, argstr ):
+        zbin = None if data['zbin'] == '__all__' else data['zbin']
+        hists = {}
         for tier in data['tier']:
-            df = pandas.DataFrame( spechists[tier][data['banddf']] )
-            df = df.loc[ df[tbin] == data['tbin'], [ 'GENTYPE', 'magbin', 'zbin', 'n' ] ]
-            if data['zbin'] != '__all__':
-                df = df.loc[ df['zbin'] == data['zbin'], : ]
-            df = df.groupby( [ 'GENTYPE', 'magbin' ] ).sum()[ 'n' ].reset_index()
-            dfs[tier] = df
+            hists[tier] = { int(g): cubes[tier].counts_along( 'magbin', g, tbin=data['tbin'], zbin=zbin )
+                            for g in gentypes }
 
         extra_title = ""
         for tier in spechists.keys():
@@ -443,20 +1570,16 @@ class SpecHist(BaseView):
         else:
             extra_title += f", all z"
 
-        return self.plothist( sim, dfs, mmin, mmax, dm, 'magbin', gentypes, survey, data,
+        return self.plothist( sim, hists, mmin, mmax, dm, gentypes, survey, data,
                               extra_title=extra_title, x_title='observed magnitude' )
 
 
-    def spechist_snr( self, sim, survey, spechists, gentypes, snrmin, snrmax, dsnr, data, argstr ):
-        dfs = {}
-        tbin = 'trestbin' if data['tframe'] == 'rest' else 'tbin'
+    def spechist_snr( self, sim, survey, spechists, cubes, gentypes, snrmin, snrmax, dsnr, data, argstr ):
+        zbin = None if data['zbin'] == '__all__' else data['zbin']
+        hists = {}
         for tier in data['tier']:
-            df = pandas.DataFrame( spechists[tier][data['banddf']] )
-            df = df.loc[ df[tbin] == data['tbin'], [ 'GENTYPE', 'snrbin', 'zbin', 'n' ] ]
-            if data['zbin'] != '__all__':
-                df = df.loc[ df['zbin'] == data['zbin'], : ]
-            df = df.groupby( [ 'GENTYPE', 'snrbin' ] ).sum()[ 'n' ].reset_index()
-            dfs[tier] = df
+            hists[tier] = { int(g): cubes[tier].counts_along( 'snrbin', g, tbin=data['tbin'], zbin=zbin )
+                            for g in gentypes }
 
         extra_title = ""
         for tier in spechists.keys():
@@ -467,290 +1590,985 @@ class SpecHist(BaseView):
         else:
             extra_title += f", all z"
 
-        return self.plothist( sim, dfs, snrmin, snrmax+dsnr, dsnr, 'snrbin', gentypes, survey, data,
+        return self.plothist( sim, hists, snrmin, snrmax+dsnr, dsnr, gentypes, survey, data,
                               extra_title=extra_title, x_title=f'S/N integrated over {data["band"]}-band',
                               gtonmaxxtick=snrmax )
 
 
-    def heatmap_restphase_z( self, sim, survey, spechists, gentypes, zmin, zmax, dz, tmin, tmax, dt, data, argstr ):
-        masterdf = None
-        tbin = 'trestbin'
+    def heatmap_restphase_z( self, sim, survey, spechists, cubes, gentypes, zmin, zmax, dz, tmin, tmax, dt,
+                             data, argstr ):
         # In this case, we're not going to try to represent different tiers and gentypes, but
         #   just sum together all the included tiers and gentypes.
-        for tier in data['tier']:
-            df = pandas.DataFrame( spechists[tier][f"{data['band']}_restframe"] )
-            df = df.loc[ df['snrbin'] >= data['snrbin'], [ 'GENTYPE', 'zbin', tbin, 'n' ] ]
-            df = ( df.groupby( [ 'GENTYPE', 'zbin', tbin ] ).sum()[ 'n' ]
-                   .reset_index().set_index( ['zbin', tbin ] ) )
-            gtsumdf = None
-            for gentype in gentypes:
-                thisgtdf = df.loc[ df['GENTYPE'] == int(gentype), ['n'] ]
-                if gtsumdf is None:
-                    gtsumdf = thisgtdf
-                else:
-                    gtsumdf = gtsumdf.add( thisgtdf, fill_value=0 )
-            if masterdf is None:
-                masterdf = gtsumdf
-            else:
-                masterdf = masterdf.add( gtsumdf, fill_value=0 )
-
-        # Make sure that the index values are continuous, so that imshow will be meaningful
-        zbinvals = masterdf.index.get_level_values( level='zbin' ).values
-        zbinmin = zbinvals.min()
-        zbinmax = zbinvals.max()
-        tbinvals = masterdf.index.get_level_values( level=tbin ).values
-        tbinmin = tbinvals.min()
-        tbinmax = tbinvals.max()
-
-        zbinvals = []
-        for z in range( zbinmin, zbinmax+1 ):
-            zbinvals.extend( [z] * (tbinmax-tbinmin+1) )
-        tbinvals = list( range( tbinmin, tbinmax+1 ) ) * (zbinmax-zbinmin+1 )
-
-        template = pandas.DataFrame( { 'zbin': zbinvals, tbin: tbinvals, 'n': [0]*len(tbinvals)  } )
-        template.set_index( [ 'zbin', tbin ], inplace=True )
-        masterdf = masterdf.reindex_like( template )
-        masterdf[ masterdf.isna() ] = 0
-        grid = masterdf.unstack( level=tbin, fill_value=0 )
+        grids = [ cubes[tier].grid( gentypes, snrbin=data['snrbin'] ) for tier in data['tier'] ]
+        grids = [ g for g in grids if g[2].size > 0 ]
+        if len( grids ) == 0:
+            raise RuntimeError( "No spectra to make a heatmap from" )
+        zoff = min( g[0] for g in grids )
+        toff = min( g[1] for g in grids )
+        grid = numpy.zeros( ( max( g[0] + g[2].shape[0] for g in grids ) - zoff,
+                              max( g[1] + g[2].shape[1] for g in grids ) - toff ), dtype=numpy.int64 )
+        for gzoff, gtoff, arr in grids:
+            grid[ gzoff-zoff : gzoff-zoff+arr.shape[0], gtoff-toff : gtoff-toff+arr.shape[1] ] += arr
+
+        # Trim to the range of bins that have anything in them
+        zhave = numpy.where( grid.sum( axis=1 ) > 0 )[0]
+        thave = numpy.where( grid.sum( axis=0 ) > 0 )[0]
+        if ( len( zhave ) == 0 ) or ( len( thave ) == 0 ):
+            raise RuntimeError( "No spectra to make a heatmap from" )
+        grid = grid[ zhave[0]:zhave[-1]+1, thave[0]:thave[-1]+1 ]
+        zbinmin = zoff + zhave[0]
+        zbinmax = zoff + zhave[-1]
+        tbinmin = toff + thave[0]
+        tbinmax = toff + thave[-1]
 
         zlo = zmin + zbinmin * dz
         zhi = zmin + (zbinmax+1) * dz
         tlo = tmin + tbinmin * dt
         thi = tmin + (tbinmax+1) * dt
 
-        # OK, plot
+        spec = { 'kind': 'heatmap',
+                 'width': int( data['width'] ),
+                 'height': int( data['height'] ),
+                 'grid': grid,
+                 'extent': ( tlo, thi, zlo, zhi ),
+                 'xlabel': 't_rest rel. max (d)',
+                 'ylabel': 'z',
+                 'title': ( f'{sim} ; FoM_stat = {survey["muopt"][0]["FoM_stat"]:.1f}\n'
+                            f'band={data["band"]}; S/N≥{data["snr"]:.0f}' ) }
+        return self.renderspec( spec, data )
 
-        dpi = 72
-        fig = pyplot.figure( figsize=(data['width']/dpi, data['height']/dpi), dpi=dpi, tight_layout=True )
-        ax = fig.add_subplot( 1, 1, 1 )
-        img = ax.imshow( grid['n'].values,
-                         aspect='auto',
-                         origin='lower',
-                         extent=( tlo, thi, zlo, zhi ) )
-        ax.figure.colorbar( img, ax=ax )
 
-        ax.tick_params( "both", labelsize=12 )
-        ax.set_ylabel( 'z', fontsize=16 )
-        ax.set_xlabel( 't_rest rel. max (d)', fontsize=16 )
-        ax.set_title( f'{sim} ; FoM_stat = {survey["muopt"][0]["FoM_stat"]:.1f}\n'
-                      f'band={data["band"]}; S/N≥{data["snr"]:.0f}', fontsize=16 )
 
-        bio = io.BytesIO()
-        fig.savefig( bio, format='svg' )
-        pyplot.close( fig )
+# ======================================================================
+# Plots for many sims at once.
+#
+# Comparing sims across the (area, dt_visit, z_SNRMATCH) grid means one
+#   plot per sim.  This does them all in one request, rendering in
+#   parallel, and sends them back as one JSON bundle.
+
+class BatchHist(BaseView):
+    plots = { 'snzhist': SNZHist, 'spechist': SpecHist }
+    gridargs = [ 'ai', 'ti', 'zi' ]
+    # Most sims of one batch prepared (and rendered) at once
+    maxthreads = 8
+
+    def gridindex( self, sim, info ):
+        """The [ ai, ti, zi ] grid position of a sim."""
+        if 'gridindex' in info:
+            return info['gridindex']
+        # Collections ingested before gridindex was saved; fall back on
+        #   the sim name, which ends in A<ai>T<ti>Z<zi>
+        match = re.search( r'A(\d+)T(\d+)Z(\d+)$', sim )
+        if match is None:
+            return None
+        return [ int( match.group(i) ) for i in ( 1, 2, 3 ) ]
+
+    def dispatch_request( self, plot, collection, argstr=None ):
+        try:
+            if plot not in self.plots:
+                return f"plot must be one of {', '.join( self.plots )}", 500
+            args = self.argstr_to_args( argstr )
+            sims = args.pop( 'sims', None )
+            grid = { k: int( args.pop( k ) ) for k in self.gridargs if k in args }
+            which = args.pop( 'which', 'z' )
+            strategy = int( args.pop( 'strategy', 0 ) )
+
+            if ( self.datadir / f"{collection}_surveyindex.json" ).is_file():
+                index = self.loadjson( collection, 'surveyindex' )
+            else:
+                index = self.loadjson( collection, 'surveys' )
+            if sims is None:
+                sims = []
+                for sim, info in index.items():
+                    gi = self.gridindex( sim, info )
+                    if all( ( gi is not None ) and ( gi[ self.gridargs.index(k) ] == v ) for k, v in grid.items() ):
+                        sims.append( sim )
+            elif isinstance( sims, str ):
+                sims = [ sims ]
+
+            view = self.plots[ plot ]()
+
+            def one( sim ):
+                # One bad sim gets an error of its own, rather than failing the batch
+                try:
+                    if sim not in index:
+                        return { 'status': 'error', 'error': f'No sim {sim} in collection {collection}' }
+                    if plot == 'snzhist':
+                        cachekey, data, err = view.prepare( collection, sim, dict( args ) )
+                        render = lambda: view.render( collection, sim, data )
+                    else:
+                        cachekey, data, err = view.prepare( which, collection, sim, strategy, dict( args ) )
+                        render = lambda: view.render( which, collection, sim, strategy, data, argstr )
+                    if err is None:
+                        ent = view.cachedplotent( cachekey, render, self.plotformats[ data['format'] ] )
+                        err = ent if not isinstance( ent, dict ) else None
+                    if err is not None:
+                        return { 'status': 'error', 'error': err if isinstance( err, str ) else err[0] }
+                    if data['format'] == 'json':
+                        return { 'status': 'ok', 'content_type': ent['content_type'],
+                                 'plot': json.loads( ent['body'] ) }
+                    return { 'status': 'ok', 'content_type': ent['content_type'],
+                             'plot': ent['body'].decode( 'utf-8' ) }
+                except Exception as ex:
+                    app.logger.exception( ex )
+                    return { 'status': 'error', 'error': str(ex) }
+
+            # Each thread runs in a copy of this request's context, so it sees the same data
+            #   version (see datasnapshot).  (renderpool serializes matplotlib renders that
+            #   happen in this process, since pyplot isn't thread safe.)
+            nthreads = min( self.maxthreads, max( len(sims), 1 ) )
+            ctx = contextvars.copy_context()
+            with concurrent.futures.ThreadPoolExecutor( max_workers=nthreads ) as pool:
+                results = dict( zip( sims, pool.map( lambda sim: ctx.copy().run( one, sim ), sims ) ) )
+
+            body = json.dumps( { 'status': 'ok', 'plots': results } ).encode( 'utf-8' )
+            if flask.request.accept_encodings[ 'gzip' ]:
+                response = flask.make_response( gzip.compress( body, compresslevel=6 ) )
+                response.headers['Content-Encoding'] = 'gzip'
+            else:
+                response = flask.make_response( body )
+            response.headers['Content-Type'] = 'application/json'
+            response.headers['Vary'] = 'Accept-Encoding'
+            return response
 
-        response = flask.make_response( bio.getvalue() )
-        response.headers['Content-Type'] = 'image/svg+xml'
+        except Exception as ex:
+            app.logger.exception( ex )
+            return { 'status': 'error', 'error': str(ex) }
+
+# ======================================================================
+# Per-sim object index.
+#
+# Finding an object used to mean globbing the sim directory, re-reading
+#   the README and the DUMP, and opening HEAD files one at a time until
+#   one had something at the right redshift.  Instead, the first time a
+#   sim is needed, all of that is read once into numpy arrays with one
+#   entry per object, sorted by (gentype, z_CMB), so that finding
+#   objects is a binary search.  The arrays are saved as .npy files under
+#   cachedir (built in a temporary directory and renamed into place), so
+#   other processes and later restarts just memmap them.
+#
+# An index is tied to the mtime of the sim directory, so it gets rebuilt
+#   if files are added to or removed from it.
+
+class SimObjectIndex:
+    version = 2
+
+    # index array name : ( HEAD column, dtype )
+    headcolumns = { 'snid': ( 'SNID', numpy.int64 ),
+                    'gentype': ( 'SIM_GENTYPE', numpy.int32 ),
+                    'zcmb': ( 'SIM_REDSHIFT_CMB', numpy.float64 ),
+                    'zhel': ( 'SIM_REDSHIFT_HELIO', numpy.float64 ),
+                    'peakmjd': ( 'SIM_PEAKMJD', numpy.float64 ),
+                    'ptrobs_min': ( 'PTROBS_MIN', numpy.int64 ),
+                    'ptrobs_max': ( 'PTROBS_MAX', numpy.int64 ),
+                    'mwebv': ( 'SIM_MWEBV', numpy.float64 ),
+                    'av': ( 'SIM_AV', numpy.float64 ),
+                    'rv': ( 'SIM_RV', numpy.float64 ) }
+    # Also: 'tier' (int16, index into self.tiers, -1 if not in the DUMP file)
+    #       'fileid' (int32, index into self.headfiles)
+    #       'bysnid' (int64, the rows in SNID order), 'sortedsnid' (snid[bysnid])
+    arrays = list( headcolumns.keys() ) + [ 'tier', 'fileid', 'bysnid', 'sortedsnid' ]
+
+    def __init__( self, simdir, indexdir ):
+        self.simdir = pathlib.Path( simdir )
+        self.indexdir = pathlib.Path( indexdir )
+        with open( self.indexdir / 'meta.json' ) as ifp:
+            meta = json.load( ifp )
+        self.headfiles = meta['headfiles']
+        self.tiers = meta['tiers']
+        self.have_dump = meta['have_dump']
+        self.models = { int(k): v for k, v in meta['models'].items() }
+        for arr in self.arrays:
+            setattr( self, arr, numpy.load( self.indexdir / f'{arr}.npy', mmap_mode='r' ) )
+
+    def __len__( self ):
+        return len( self.snid )
+
+    @property
+    def nbytes( self ):
+        return sum( getattr( self, arr ).nbytes for arr in self.arrays )
+
+    @classmethod
+    def get( cls, simdir ):
+        """Return the index for the sim in simdir, loading or building it if necessary."""
+        simdir = pathlib.Path( simdir )
+        stamp = f'v{cls.version}-{simdir.stat().st_mtime_ns}'
+        key = ( 'objindex', str(simdir), stamp )
+        index = indexcache.get( key )
+        if index is None:
+            indexdir = cachedir / 'objindex' / simdir.name / stamp
+            if not ( indexdir / 'meta.json' ).is_file():
+                cls.build( simdir, indexdir )
+            index = cls( simdir, indexdir )
+            indexcache.put( key, index, index.nbytes )
+        return index
+
+    @staticmethod
+    def read_readme( simdir ):
+        """Return { gentype: model } from the sim's *.README file."""
+        g = [ i for i in simdir.glob( "*.README" ) ]
+        if len(g) == 0:
+            app.logger.error( f"Couldn't find a *.README file in {simdir}" )
+            raise RuntimeError( "Error parsing snana output data" )
+        if len(g) > 1:
+            app.logger.error( f"Found more than one *.README file in {simdir}" )
+            raise RuntimeError( "Error parsing snana output data" )
+
+        with open( g[0] ) as ifp:
+            blob = yaml.safe_load( ifp.read() )
+
+        models = {}
+        for key in blob['DOCUMENTATION'].keys():
+            if key[0:11] == "INPUT_KEYS_":
+                models[ int( blob['DOCUMENTATION'][key]['GENTYPE'] ) ] = key[11:]
+        return models
+
+    @classmethod
+    def build( cls, simdir, indexdir ):
+        app.logger.info( f"Building object index for {simdir}" )
+        models = cls.read_readme( simdir )
+
+        # TODO : assuming gzipped, fix that
+        headfiles = sorted( simdir.glob( "*_HEAD.FITS.gz" ) )
+        cols = { arr: [] for arr in list( cls.headcolumns.keys() ) + [ 'fileid' ] }
+        for fileid, headfile in enumerate( headfiles ):
+            with fitscache.open( headfile, memmap=True ) as f:
+                head = f[1].data
+                for arr, ( col, dtype ) in cls.headcolumns.items():
+                    cols[arr].append( numpy.asarray( head[col], dtype=dtype ) )
+                cols['fileid'].append( numpy.full( len(head), fileid, dtype=numpy.int32 ) )
+        cols = { arr: numpy.concatenate( v ) if len(v) > 0 else numpy.array( [] )
+                 for arr, v in cols.items() }
+
+        g = [ i for i in simdir.glob( "*DUMP*" ) ]
+        have_dump = ( len(g) == 1 )
+        tiers = []
+        cols['tier'] = numpy.full( len( cols['snid'] ), -1, dtype=numpy.int16 )
+        if have_dump:
+            dump = pandas.read_csv( g[0], sep='\s+', comment='#' )
+            tiers = sorted( dump['FIELD'].unique() )
+            tiercode = pandas.Series( numpy.searchsorted( tiers, dump['FIELD'].values ).astype( numpy.int16 ),
+                                      index=dump['CID'].values.astype( numpy.int64 ) )
+            tiercode = tiercode[ ~tiercode.index.duplicated() ]
+            cols['tier'] = tiercode.reindex( cols['snid'] ).fillna( -1 ).values.astype( numpy.int16 )
+
+        order = numpy.lexsort( ( cols['zcmb'], cols['gentype'] ) )
+        cols = { arr: v[order] for arr, v in cols.items() }
+        cols['bysnid'] = numpy.argsort( cols['snid'], kind='stable' ).astype( numpy.int64 )
+        cols['sortedsnid'] = cols['snid'][ cols['bysnid'] ]
+
+        indexdir.parent.mkdir( parents=True, exist_ok=True )
+        tmpdir = pathlib.Path( tempfile.mkdtemp( dir=indexdir.parent, prefix=f'.{indexdir.name}.' ) )
+        try:
+            for arr in cls.arrays:
+                numpy.save( tmpdir / f'{arr}.npy', cols[arr] )
+            with open( tmpdir / 'meta.json', 'w' ) as ofp:
+                json.dump( { 'headfiles': [ h.name for h in headfiles ],
+                             'tiers': [ str(t) for t in tiers ],
+                             'have_dump': have_dump,
+                             'models': { str(k): v for k, v in models.items() } },
+                           ofp )
+            os.rename( tmpdir, indexdir )
+        except OSError:
+            # Somebody else built it first
+            if not ( indexdir / 'meta.json' ).is_file():
+                raise
+        finally:
+            shutil.rmtree( tmpdir, ignore_errors=True )
+
+    def find( self, gentype, zlo, zhi, tier=None ):
+        """Return the rows of objects of gentype with zlo ≤ z_CMB ≤ zhi (in tier, if tier is not None)."""
+        lo = numpy.searchsorted( self.gentype, gentype, side='left' )
+        hi = numpy.searchsorted( self.gentype, gentype, side='right' )
+        zlodex = lo + numpy.searchsorted( self.zcmb[lo:hi], zlo, side='left' )
+        zhidex = lo + numpy.searchsorted( self.zcmb[lo:hi], zhi, side='right' )
+        rows = numpy.arange( zlodex, zhidex )
+        if tier is not None:
+            if tier not in self.tiers:
+                return rows[0:0]
+            rows = rows[ self.tier[zlodex:zhidex] == self.tiers.index( tier ) ]
+        return rows
+
+    def snidrows( self, snid ):
+        """Return the rows of objects with SNID snid (a binary search on sortedsnid)."""
+        lo = numpy.searchsorted( self.sortedsnid, snid, side='left' )
+        hi = numpy.searchsorted( self.sortedsnid, snid, side='right' )
+        return numpy.asarray( self.bysnid[lo:hi] )
+
+    def headfile( self, row ):
+        return self.simdir / self.headfiles[ self.fileid[row] ]
+
+    def objinfo( self, row ):
+        """The find_random_object return dictionary for the object in row."""
+        headfile = self.headfile( row )
+        return { 'headfile': headfile,
+                 'photfile': headfile.parent / headfile.name.replace( '_HEAD.FITS.gz', '_PHOT.FITS.gz' ),
+                 'snid': int( self.snid[row] ),
+                 'ptrobs_min': int( self.ptrobs_min[row] ) - 1,
+                 'ptrobs_max': int( self.ptrobs_max[row] ),
+                 'snz': float( self.zcmb[row] ),
+                 'mwebv': float( self.mwebv[row] ),
+                 'av': float( self.av[row] ),
+                 'rv': float( self.rv[row] ) }
 
-        return response
 
+# ======================================================================
+# Per-sim spectrum index.
+#
+# The same idea as SimObjectIndex, for the sim's _SPEC.FITS files: one
+#   entry per spectrum, sorted by the object-index row of the object it's
+#   a spectrum of, so that a spectrum search is a set of vectorized cuts
+#   on the object index plus cuts on the spectra.
+#
+# Each entry knows the spectrum's tier (via its object) and exposure
+#   time; spectrum strategy isn't stored, because that comes from the
+#   collection's tiers.json (strategy i of a tier is the spectra whose
+#   exposure time is the tier's texpose_prism[i]).
+
+class SimSpectrumIndex:
+    version = 1
+
+    # index array name : ( SPEC column, dtype )
+    speccolumns = { 'snid': ( 'SNID', numpy.int64 ),
+                    'mjd': ( 'MJD', numpy.float64 ),
+                    'texpose': ( 'Texpose', numpy.float32 ),
+                    'nbin_lam': ( 'NBIN_LAM', numpy.int32 ),
+                    'host_contam': ( 'SCALE_HOST_CONTAM', numpy.float32 ),
+                    'ptrspec_min': ( 'PTRSPEC_MIN', numpy.int64 ),
+                    'ptrspec_max': ( 'PTRSPEC_MAX', numpy.int64 ) }
+    # Also: 'objrow' (int64, row in the SimObjectIndex)
+    #       'dt_obs', 'dt_rest' (float64, MJD - SIM_PEAKMJD, and that / ( 1 + SIM_REDSHIFT_HELIO ) )
+    arrays = list( speccolumns.keys() ) + [ 'objrow', 'dt_obs', 'dt_rest' ]
+
+    def __init__( self, objindex, indexdir ):
+        self.objindex = objindex
+        self.indexdir = pathlib.Path( indexdir )
+        for arr in self.arrays:
+            setattr( self, arr, numpy.load( self.indexdir / f'{arr}.npy', mmap_mode='r' ) )
+
+    def __len__( self ):
+        return len( self.snid )
+
+    @property
+    def nbytes( self ):
+        return sum( getattr( self, arr ).nbytes for arr in self.arrays )
+
+    @classmethod
+    def get( cls, simdir ):
+        """Return the spectrum index for the sim in simdir, loading or building it if necessary."""
+        objindex = SimObjectIndex.get( simdir )
+        stamp = f'spec-v{cls.version}-{objindex.indexdir.name}'
+        key = ( 'specindex', str(objindex.simdir), stamp )
+        index = indexcache.get( key )
+        if index is None:
+            indexdir = objindex.indexdir.parent / stamp
+            if not ( indexdir / 'snid.npy' ).is_file():
+                cls.build( objindex, indexdir )
+            index = cls( objindex, indexdir )
+            indexcache.put( key, index, index.nbytes )
+        return index
+
+    @classmethod
+    def build( cls, objindex, indexdir ):
+        app.logger.info( f"Building spectrum index for {objindex.simdir}" )
+        cols = { arr: [] for arr in cls.speccolumns.keys() }
+        cols['objrow'] = []
+        for fileid, headname in enumerate( objindex.headfiles ):
+            specfile = objindex.simdir / headname.replace( '_HEAD.FITS.gz', '_SPEC.FITS' )
+            if not specfile.is_file():
+                continue
+            with fits.open( specfile, memmap=True ) as f:
+                spec = f[1].data
+                for arr, ( col, dtype ) in cls.speccolumns.items():
+                    cols[arr].append( numpy.asarray( spec[col], dtype=dtype ) )
+            # Match up spectra with objects from the corresponding HEAD file
+            filerows = numpy.nonzero( numpy.asarray( objindex.fileid ) == fileid )[0]
+            filesnids = numpy.asarray( objindex.snid )[ filerows ]
+            order = numpy.argsort( filesnids, kind='stable' )
+            pos = numpy.searchsorted( filesnids[order], cols['snid'][-1] )
+            pos[ pos >= len(order) ] = 0
+            objrow = filerows[ order[ pos ] ] if len(order) > 0 else numpy.zeros( len(pos), dtype=numpy.int64 )
+            if ( len(order) == 0 ) or numpy.any( objindex.snid[objrow] != cols['snid'][-1] ):
+                raise RuntimeError( f"{specfile.name} has spectra of objects that aren't in {headname}" )
+            cols['objrow'].append( objrow.astype( numpy.int64 ) )
+
+        cols = { arr: numpy.concatenate( v ) if len(v) > 0 else numpy.array( [] )
+                 for arr, v in cols.items() }
+        if len( cols['objrow'] ) == 0:
+            cols['objrow'] = cols['objrow'].astype( numpy.int64 )
+        cols['dt_obs'] = cols['mjd'] - numpy.asarray( objindex.peakmjd )[ cols['objrow'] ]
+        cols['dt_rest'] = cols['dt_obs'] / ( 1. + numpy.asarray( objindex.zhel )[ cols['objrow'] ] )
+
+        order = numpy.argsort( cols['objrow'], kind='stable' )
+
+        indexdir.parent.mkdir( parents=True, exist_ok=True )
+        tmpdir = pathlib.Path( tempfile.mkdtemp( dir=indexdir.parent, prefix=f'.{indexdir.name}.' ) )
+        try:
+            for arr in cls.arrays:
+                numpy.save( tmpdir / f'{arr}.npy', cols[arr][order] )
+            os.rename( tmpdir, indexdir )
+        except OSError:
+            if not ( indexdir / 'snid.npy' ).is_file():
+                raise
+        finally:
+            shutil.rmtree( tmpdir, ignore_errors=True )
+
+    def find( self, gentype, zlo, zhi, t, dt, tframe='rest', tier=None, texposes=None ):
+        """Return indexes of spectra matching all the cuts.
+
+        Objects must have the given gentype, zlo ≤ z_CMB ≤ zhi, and be in
+        tier (if not None).  Spectra must have t-dt ≤ dt_{tframe} ≤ t+dt,
+        and, if texposes is not None, their ( tier, texpose ) must be
+        in texposes, which is a list of ( tier, texpose ) tuples.
+
+        """
+        objrows = self.objindex.find( gentype, zlo, zhi, tier=tier )
+        if len(objrows) == 0:
+            return objrows
+        objmask = numpy.zeros( len(self.objindex), dtype=bool )
+        objmask[ objrows ] = True
+
+        specdt = self.dt_rest if tframe == 'rest' else self.dt_obs
+        mask = objmask[ self.objrow ] & ( specdt >= t - dt ) & ( specdt <= t + dt )
+        if texposes is not None:
+            stratmask = numpy.zeros( len(self), dtype=bool )
+            spectier = numpy.asarray( self.objindex.tier )[ self.objrow ]
+            for stier, texpose in texposes:
+                if stier not in self.objindex.tiers:
+                    continue
+                stratmask |= ( ( spectier == self.objindex.tiers.index( stier ) )
+                               & ( self.texpose == numpy.float32( texpose ) ) )
+            mask &= stratmask
+        return numpy.nonzero( mask )[0]
+
+    def objspectra( self, row ):
+        """Return the indexes of the spectra of the object in row of the object index."""
+        lo = numpy.searchsorted( self.objrow, row, side='left' )
+        hi = numpy.searchsorted( self.objrow, row, side='right' )
+        return numpy.arange( lo, hi )
+
+    def choose( self, specdexes, n=1, rng=None ):
+        """Pick up to n different random objects that have spectra in specdexes, then one of each's spectra there.
+
+        rng is a numpy.random.Generator.  Returns an array of indexes into
+        the spectrum index.
+
+        """
+        rng = numpy.random.default_rng() if rng is None else rng
+        # specdexes is sorted, and the index is sorted by objrow, so each object's spectra are together
+        objrows, starts, counts = numpy.unique( self.objrow[ specdexes ], return_index=True, return_counts=True )
+        which = rng.choice( len(objrows), size=min( n, len(objrows) ), replace=False )
+        return specdexes[ starts[which] + rng.integers( counts[which] ) ]
+
+    def specinfo( self, dex ):
+        """The find_random_object return dictionary for the spectrum at dex."""
+        row = int( self.objrow[dex] )
+        retval = self.objindex.objinfo( row )
+        retval.update( {
+            'specfile': retval['headfile'].parent / retval['headfile'].name.replace( '_HEAD.FITS.gz', '_SPEC.FITS' ),
+            'spec_texp': float( self.texpose[dex] ),
+            'specdt': float( self.dt_obs[dex] ),
+            'specdtrest': float( self.dt_rest[dex] ),
+            'specnbin_lam': float( self.nbin_lam[dex] ),
+            'spechost_contam': float( self.host_contam[dex] ),
+            'ptrspec_min': int( self.ptrspec_min[dex] ) - 1,
+            'ptrspec_max': int( self.ptrspec_max[dex] ),
+        } )
+        return retval
 
 
 # ======================================================================
+# Pools of pre-drawn random objects.
+#
+# If the ingest was run with --pool-size (see _write_pool in
+#   lib/parse_snana.py), {data dir}/{collection}_pools/{sim dir name}.npz has,
+#   for each ( gentype, z bin, tier ) of the sim, a random sample of
+#   objects with their light curves, and for each ( gentype, z bin, tier,
+#   spectrum exposure time ) a random sample of objects with spectra and
+#   those spectra.  The whole pool is read into memory once (it's kept
+#   in indexcache), so answering from the pool doesn't touch /snana_sim.
+#
+# Each pooled object stands for ( bin size / number drawn ) objects, so
+#   sampling from the pool is weighted by that.  If the pool doesn't have
+#   enough matching objects for a request, and some of the bins the
+#   request touches weren't small enough to be pooled entirely, the pool
+#   can't answer, and the caller falls back to searching the sim.
+
+class ObjectPool:
+    version = 1
+
+    def __init__( self, simdir, path ):
+        self.simdir = pathlib.Path( simdir )
+        with numpy.load( path ) as npz:
+            self.a = { k: npz[k] for k in npz.files }
+        if int( self.a['version'] ) != self.version:
+            raise ValueError( f"{path} is a version {self.a['version']} pool, expected {self.version}" )
+        self.zbinwidth = float( self.a['zbinwidth'] )
+        self.tiers = [ str(t) for t in self.a['tiers'] ]
+        self.headfiles = [ str(h) for h in self.a['headfiles'] ]
+
+    @property
+    def nbytes( self ):
+        return sum( v.nbytes for v in self.a.values() )
+
+    @staticmethod
+    def path( collection, simdir ):
+        return datasnapshot().root / f'{collection}_pools' / f'{pathlib.Path(simdir).name}.npz'
+
+    @classmethod
+    def get( cls, collection, simdir ):
+        """Return the pool for the sim in simdir, or None if the ingest didn't make one."""
+        path = cls.path( collection, simdir )
+        try:
+            st = path.stat()
+        except FileNotFoundError:
+            return None
+        key = ( 'objpool', str(path), st.st_mtime_ns, st.st_size )
+        pool = indexcache.get( key )
+        if pool is None:
+            pool = cls( simdir, path )
+            indexcache.put( key, pool, pool.nbytes )
+        return pool
+
+    def _cuts( self, prefix, gentype, zlo, zhi, tier ):
+        """Returns the entries with the right gentype and tier in the z bins zlo..zhi touch, and a z_CMB cut on those."""
+        a = self.a
+        zbins = ( numpy.floor( zlo / self.zbinwidth ), numpy.floor( zhi / self.zbinwidth ) )
+        mask = ( ( a[f'{prefix}_gentype'] == gentype )
+                 & ( a[f'{prefix}_zbin'] >= zbins[0] ) & ( a[f'{prefix}_zbin'] <= zbins[1] ) )
+        if tier is not None:
+            mask &= ( a[f'{prefix}_tier'] == self.tiers.index( tier ) )
+        zmask = ( a[f'{prefix}_zcmb'] >= zlo ) & ( a[f'{prefix}_zcmb'] <= zhi )
+        return mask, zmask
+
+    def _knows_tiers( self, *tiers ):
+        """Whether the pool knows all of tiers (None is any tier).
+
+        If it doesn't (e.g. the ingest couldn't read the DUMP file), the
+        pool can't tell which of its objects are in the tier, so it can't
+        answer.
+
+        """
+        return all( ( t is None ) or ( t in self.tiers ) for t in tiers )
+
+    def _draw( self, cands, weight, complete, n, rng ):
+        """Weighted draw of up to n of cands, or None if the pool can't answer."""
+        if ( len(cands) < n ) and ( not complete ):
+            return None
+        if len(cands) == 0:
+            return cands
+        return cands[ rng.choice( len(cands), size=min( n, len(cands) ), replace=False,
+                                  p=weight / weight.sum() ) ]
+
+    def _objinfo( self, prefix, i ):
+        a = self.a
+        return { 'snid': int( a[f'{prefix}_snid'][i] ),
+                 'snz': float( a[f'{prefix}_zcmb'][i] ),
+                 'mwebv': float( a[f'{prefix}_mwebv'][i] ),
+                 'av': float( a[f'{prefix}_av'][i] ),
+                 'rv': float( a[f'{prefix}_rv'][i] ) }
+
+    def ltcvs( self, gentype, zlo, zhi, tier=None, n=1, rng=None ):
+        """Return up to n random objects with light curves, as RandomLTCV sends them, or None.
+
+        None means the pool doesn't have enough to answer; search the sim.
+
+        """
+        if not self._knows_tiers( tier ):
+            return None
+        rng = numpy.random.default_rng() if rng is None else rng
+        a = self.a
+        mask, zmask = self._cuts( 'lc', gentype, zlo, zhi, tier )
+        cands = numpy.nonzero( mask & zmask )[0]
+        chosen = self._draw( cands, a['lc_weight'][cands], a['lc_complete'][mask].all(), n, rng )
+        if chosen is None:
+            return None
+
+        objs = []
+        for i in chosen:
+            obj = self._objinfo( 'lc', i )
+            sl = slice( a['lc_start'][i], a['lc_start'][i+1] )
+            band = a['obs_band'][sl]
+            obj['ltcv'] = {}
+            for b in numpy.unique( band ):
+                w = band == b
+                obj['ltcv'][str(b)] = { 'mjd': a['obs_mjd'][sl][w],
+                                        'flux': a['obs_flux'][sl][w],
+                                        'dflux': a['obs_dflux'][sl][w] }
+            obj['zp'] = 27.5
+            obj['tier'] = 'Any' if tier is None else tier
+            objs.append( obj )
+        return objs
+
+    def spectra( self, gentype, zlo, zhi, t, dt, tframe='rest', tier=None, texposes=None, n=1, rng=None ):
+        """Return up to n random spectra of different objects, as RandomSpectrum sends them, or None.
+
+        The cuts are the same as SimSpectrumIndex.find's.  None means the
+        pool doesn't have enough to answer; search the sim.
+
+        """
+        if not self._knows_tiers( tier, *( [] if texposes is None else [ stier for stier, texpose in texposes ] ) ):
+            return None
+        rng = numpy.random.default_rng() if rng is None else rng
+        a = self.a
+        mask, zmask = self._cuts( 'sp', gentype, zlo, zhi, tier )
+        if texposes is not None:
+            stratmask = numpy.zeros( len(mask), dtype=bool )
+            for stier, texpose in texposes:
+                stratmask |= ( ( a['sp_tier'] == self.tiers.index( stier ) )
+                               & ( a['sp_texpose'] == numpy.float32( texpose ) ) )
+            mask &= stratmask
+        specdt = a['sp_dt_rest'] if tframe == 'rest' else a['sp_dt_obs']
+        specdexes = numpy.nonzero( mask & zmask & ( specdt >= t - dt ) & ( specdt <= t + dt ) )[0]
+
+        # An object can be in the pool more than once (drawn for different exposure times);
+        #   its chance of being in the pool at all is 1 - Π( 1 - 1/weight ) over those draws.
+        objkeys, objdex = numpy.unique( numpy.stack( [ a['sp_fileid'][specdexes], a['sp_snid'][specdexes] ] ),
+                                        axis=1, return_inverse=True )
+        objdex = objdex.ravel()
+        order = numpy.argsort( objdex, kind='stable' )
+        specdexes = specdexes[order]
+        objdex = objdex[order]
+        _, draws = numpy.unique( numpy.stack( [ objdex, a['sp_obj'][specdexes] ] ), axis=1, return_index=True )
+        missed = numpy.ones( objkeys.shape[1] )
+        numpy.multiply.at( missed, objdex[draws], 1. - 1. / a['sp_weight'][ specdexes[draws] ] )
+
+        # Draw objects, then one of each drawn object's matching spectra
+        _, starts, counts = numpy.unique( objdex, return_index=True, return_counts=True )
+        which = self._draw( numpy.arange( len(starts) ), 1. / ( 1. - missed ),
+                            a['sp_complete'][mask].all(), n, rng )
+        if which is None:
+            return None
+
+        objs = []
+        for i in specdexes[ starts[which] + rng.integers( counts[which] ) ]:
+            obj = self._objinfo( 'sp', i )
+            headfile = self.simdir / self.headfiles[ a['sp_fileid'][i] ]
+            sl = slice( a['sp_start'][i], a['sp_start'][i+1] )
+            obj.update( {
+                'headfile': headfile,
+                'photfile': headfile.parent / headfile.name.replace( '_HEAD.FITS.gz', '_PHOT.FITS.gz' ),
+                'ptrobs_min': int( a['sp_ptrobs_min'][i] ) - 1,
+                'ptrobs_max': int( a['sp_ptrobs_max'][i] ),
+                'specfile': headfile.parent / headfile.name.replace( '_HEAD.FITS.gz', '_SPEC.FITS' ),
+                'spec_texp': float( a['sp_texpose'][i] ),
+                'specdt': float( a['sp_dt_obs'][i] ),
+                'specdtrest': float( a['sp_dt_rest'][i] ),
+                'specnbin_lam': float( a['sp_nbin_lam'][i] ),
+                'spechost_contam': float( a['sp_host_contam'][i] ),
+                'ptrspec_min': int( a['sp_ptrspec_min'][i] ) - 1,
+                'ptrspec_max': int( a['sp_ptrspec_max'][i] ),
+                'spectrum': { 'lammin': a['lam_min'][sl],
+                              'lammax': a['lam_max'][sl],
+                              'flam': a['lam_flam'][sl],
+                              'flamerr': a['lam_flamerr'][sl],
+                              'sim_flam': a['lam_sim_flam'][sl] },
+            } )
+            obj['tier'] = 'Any' if tier is None else tier
+            objs.append( obj )
+        return objs
 
-class RandomObject:
-    def find_random_object( self, collection, sim, gentype, z, dz, tier=None, specstrat=None, spect=0., specdt=1.,
-                            tframe='rest', need_spec=False ):
-        retval = {}
 
-        gentype = int(gentype)
-        z = float(z)
-        dz = float(dz)
-        specstrat = None if specstrat is None else int(specstrat)
+# ======================================================================
 
+class RandomObject:
+    # Most objects one request may ask for with n=
+    maxn = 100
+
+    def simdir( self, collection, sim ):
         # TODO : update this to when there is more than one collection sim dir
 
         # HACK ALERT : update this when collection names are more coherent
 
-        # app.logger.debug( f"gentype={gentype}, z={z}, dz={dz}" )
-
         simcomps = sim.strip().split()
         app.logger.debug( f"collection={collection}, sim={sim}" )
         app.logger.debug( f"collection={collection}, sim={sim}, simcomps[1]={simcomps[1]}" )
-        subdir = pathlib.Path( "/snana_sim" ) / f'ROMAN_{collection}_DATA-{simcomps[1]}'
-        g = [ i for i in subdir.glob( "*.README" ) ]
-        if len(g) == 0:
-            app.logger.error( f"Couldn't find a *.README file in {subdir}" )
-            raise RuntimeError( "Error parsing snana output data" )
-        if len(g) > 1:
-            app.logger.error( f"Found more than one *.README file in {subdir}" )
-            raise RuntimeError( "Error parsing snana output data" )
+        return pathlib.Path( "/snana_sim" ) / f'ROMAN_{collection}_DATA-{simcomps[1]}'
 
-        with open( g[0] ) as ifp:
-            blob = yaml.safe_load( ifp.read() )
+    def sampleargs( self, data ):
+        """Pull n and seed out of the request arguments in data.
 
-        model = None
-        for key in blob['DOCUMENTATION'].keys():
-            if key[0:11] == "INPUT_KEYS_":
-                if blob['DOCUMENTATION'][key]['GENTYPE'] == gentype:
-                    model = key[11:]
-                    app.logger.debug( f"Found gentype {gentype} as model {model}" )
+        Returns n, seed; n is None if the request wants the single-object
+        response, seed is None if it wants an unreproducible sample.
 
-        if model is None:
-            app.logger.error( f"Couldn't find model for gentype {gentype}" )
-            raise RuntimeError( "Couldn't find snana files for type" )
+        """
+        n = None if data.get( 'n' ) is None else int( data['n'] )
+        seed = None if data.get( 'seed' ) is None else int( data['seed'] )
+        if ( n is not None ) and ( ( n < 1 ) or ( n > self.maxn ) ):
+            raise ValueError( f"n must be between 1 and {self.maxn}" )
+        if ( seed is not None ) and ( seed < 0 ):
+            raise ValueError( "seed must be non-negative" )
+        return n, seed
 
-        # If tier is not None, then we have to read the DUMP file
-        if tier is not None:
-            g = [ i for i in subdir.glob( f"*DUMP*" ) ]
-            if len(g) != 1:
-                raise RuntimeError( "There are {len(g)} DUMP files, expected exactly 1." )
-            dump = pandas.read_csv( g[0], sep='\s+', comment='#' )
-            dump.set_index( 'CID', inplace=True )
+    def find_random_object( self, collection, sim, gentype, z, dz, tier=None, specstrat=None, spect=0., specdt=1.,
+                            tframe='rest', need_spec=False ):
+        objs = self.find_random_objects( collection, sim, gentype, z, dz, tier=tier, specstrat=specstrat,
+                                         spect=spect, specdt=specdt, tframe=tframe, need_spec=need_spec )
+        return objs[0] if len(objs) > 0 else {}
 
-        # If need_spec is True then we need to read the cache of spectrum CIDs
-        if need_spec:
-            app.logger.debug( f"sim={sim}" )
-            spectiercids = json.loads( self.readjson( collection, 'spectiercids' ) )
-            spectiercids = spectiercids[ sim ]
+    def find_random_objects( self, collection, sim, gentype, z, dz, tier=None, specstrat=None, spect=0., specdt=1.,
+                             tframe='rest', need_spec=False, n=1, rng=None ):
+        """Return a list of up to n different random objects (or spectra of different objects).
 
-        # TODO : assuming gzipped, fix that
-        g = [ i for i in subdir.glob( f"ROMAN_{model}-*_HEAD.FITS.gz" ) ]
-        random.shuffle( g )
+        rng is a numpy.random.Generator; pass one made with a seed to get
+        the same objects back every time (for as long as the sim doesn't
+        change).  The list is empty if nothing matches.
 
-        if need_spec and (specstrat is not None):
-            instrat = set()
-            if tier is not None:
-                tierstosearch = [ tier ]
-            else:
-                tierstosearch = list( spectiercids.keys() )
-            app.logger.debug( f"tierstosearch={tierstosearch}, specstrat={specstrat}" )
-            for searchtier in tierstosearch:
-                # I hope these cids are integers...
-                instrat = instrat.union( set( spectiercids[searchtier][specstrat] ) )
-            instrat = numpy.array( list(instrat), dtype=numpy.int64 )
-            app.logger.debug( f"instrat = {instrat}" )
-
-        found = False
-        for headfile in g:
-            app.logger.debug( f"Searching file {headfile}" )
-            photfile = headfile.parent / headfile.name.replace( '_HEAD.FITS.gz', '_PHOT.FITS.gz' )
-            specfile = headfile.parent / headfile.name.replace( '_HEAD.FITS.gz', '_SPEC.FITS' )
-            tab = astropy.table.Table.read( headfile )
-            tab['SNID'] = tab['SNID'].astype( numpy.int64 )
-
-            spechead = None
-            if need_spec:
-                specfname = headfile.name.replace( "_HEAD.FITS.gz", "_SPEC.FITS" )
-                app.logger.debug( f"Reading spectrum file {specfname}" )
-                with fits.open( headfile.parent / specfname, memmap=True ) as sf:
-                    spechead = astropy.table.Table( sf[1].data )
-                    spechead['SNID'] = spechead['SNID'].astype( numpy.int64 )
-                app.logger.debug( f"spectiercids.keys()={spectiercids.keys()}" )
-                if specstrat is not None:
-                    tab = tab[ [ i in instrat for i in tab['SNID'] ] ]
-                    app.logger.debug( f"After cutting, len(tab) = {len(tab)}" )
-            rightz = tab[ ( tab['SIM_REDSHIFT_CMB'] >= z - dz ) & ( tab['SIM_REDSHIFT_CMB'] <= z + dz ) ]
-            app.logger.debug( f"len(rightz)={len(rightz)}" )
-            if len(rightz) == 0:
-                continue
+        """
+        rng = numpy.random.default_rng() if rng is None else rng
+        gentype = int(gentype)
+        z = float(z)
+        dz = float(dz)
+        specstrat = None if specstrat is None else int(specstrat)
 
-            dexen = list( range( 0, len(rightz) ) )
-            random.shuffle( dexen )
-            for dex in dexen:
-                if rightz[dex]['SIM_GENTYPE'] != gentype:
-                    app.logger.error( f"gentype mismatch error" )
-                    raise RuntimeError( "Gentype from HEAD file didn't match expected" )
+        # app.logger.debug( f"gentype={gentype}, z={z}, dz={dz}" )
 
-                if tier is not None:
-                    # Make sure the SN is from the right tier
-                    if dump.loc[ rightz[dex]['SNID'], 'FIELD' ] != tier:
-                        continue
+        subdir = self.simdir( collection, sim )
 
-                if not need_spec:
-                    found = True
-                    break
-                else:
-                    objspecs = spechead[ spechead['SNID'] == rightz[dex]['SNID'] ]
-                    if len( objspecs ) > 0:
-                        dts = objspecs['MJD'] - rightz[dex]['SIM_PEAKMJD']
-                        if tframe == "rest":
-                            dts /= ( 1. + rightz[dex]['SIM_REDSHIFT_HELIO'] )
-                        gooddts = numpy.where( ( dts <= spect + specdt ) & ( dts >= ( spect - specdt ) ) )[0]
-                        if len( gooddts ) > 0:
-                            random.shuffle( gooddts )
-                            spechead = objspecs[ gooddts[0] ]
-                            found = True
-                            break
-
-
-            if found:
-                retval = {
-                    'headfile': headfile,
-                    'photfile': photfile,
-                    'tier': 'Any' if tier is None else tier,
-                    'snid': int( rightz[dex]['SNID'] ),
-                    'ptrobs_min': int( rightz[dex]['PTROBS_MIN'] ) - 1,
-                    'ptrobs_max': int( rightz[dex]['PTROBS_MAX'] ),
-                    'snz': float( rightz[dex]['SIM_REDSHIFT_CMB'] ),
-                    'mwebv': float( rightz[dex]['SIM_MWEBV'] ),
-                    'av': float( rightz[dex]['SIM_AV'] ),
-                    'rv': float( rightz[dex]['SIM_RV'] ),
-                }
+        texposes = self.spectexposes( collection, tier, specstrat ) if need_spec else None
 
-                if need_spec:
-                    retval.update( {
-                        'specfile': specfile,
-                        'specstrat': 'Any' if specstrat is None else specstrat,
-                        'spec_texp': float( spechead['Texpose'] ),
-                        'specdt': float(spechead['MJD'] - rightz[dex]['SIM_PEAKMJD']),
-                        'specdtrest': float( ( spechead['MJD'] - rightz[dex]['SIM_PEAKMJD'] ) /
-                                             ( 1. + rightz[dex]['SIM_REDSHIFT_HELIO'] ) ),
-                        'specnbin_lam': float( spechead['NBIN_LAM'] ),
-                        'spechost_contam': float( spechead['SCALE_HOST_CONTAM'] ),
-                        'ptrspec_min': int( spechead['PTRSPEC_MIN'] ) - 1,
-                        'ptrspec_max': int( spechead['PTRSPEC_MAX'] ),
-                    } )
+        pool = ObjectPool.get( collection, subdir )
+        if pool is not None:
+            if need_spec:
+                objs = pool.spectra( gentype, z - dz, z + dz, spect, specdt, tframe=tframe, tier=tier,
+                                     texposes=texposes, n=n, rng=rng )
+            else:
+                objs = pool.ltcvs( gentype, z - dz, z + dz, tier=tier, n=n, rng=rng )
+            if objs is not None:
+                for obj in objs:
+                    if need_spec:
+                        obj['specstrat'] = 'Any' if specstrat is None else specstrat
+                return objs
+            app.logger.debug( f"Pool for {subdir.name} can't answer, searching the sim" )
+
+        index = SimObjectIndex.get( subdir )
+        if gentype not in index.models:
+            app.logger.error( f"Couldn't find model for gentype {gentype}" )
+            raise RuntimeError( "Couldn't find snana files for type" )
+        if ( tier is not None ) and ( not index.have_dump ):
+            raise RuntimeError( "There isn't exactly one DUMP file." )
+
+        if not need_spec:
+            rows = index.find( gentype, z - dz, z + dz, tier=tier )
+            objs = [ index.objinfo( row )
+                     for row in rows[ rng.choice( len(rows), size=min( n, len(rows) ), replace=False ) ] ]
+            for obj in objs:
+                obj['tier'] = 'Any' if tier is None else tier
+            return objs
+
+        specindex = SimSpectrumIndex.get( subdir )
+        specdexes = specindex.find( gentype, z - dz, z + dz, spect, specdt, tframe=tframe,
+                                    tier=tier, texposes=texposes )
+        if len(specdexes) == 0:
+            return []
+        objs = [ specindex.specinfo( dex ) for dex in specindex.choose( specdexes, n=n, rng=rng ) ]
+        for obj in objs:
+            obj['tier'] = 'Any' if tier is None else tier
+            obj['specstrat'] = 'Any' if specstrat is None else specstrat
+        return objs
+
+    def spectexposes( self, collection, tier, specstrat ):
+        """The ( tier, texpose ) pairs that make up spectrum strategy specstrat (None if specstrat is None)."""
+        if specstrat is None:
+            return None
+        # Spectrum strategy i of a tier is the spectra with that tier's texpose_prism[i]
+        texposes = [ ( ent['name'], ent['texpose_prism'][specstrat] )
+                     for ent in self.loadjson( collection, 'tiers' )
+                     if ( ( tier is None ) or ( ent['name'] == tier ) )
+                     and ( specstrat < len( ent['texpose_prism'] ) ) ]
+        app.logger.debug( f"specstrat={specstrat}, texposes={texposes}" )
+        return texposes
+
+    @staticmethod
+    def bandltcvs( photdata ):
+        """Split rows of a PHOT file into { band: { 'mjd': ..., 'flux': ..., 'dflux': ... } }."""
+        ltcv = {}
+        for band in numpy.unique( photdata['BAND'] ):
+            banddata = photdata[ photdata['BAND'] == band ]
+            ltcv[str(band)] = { 'mjd': banddata['MJD'].astype( numpy.float64 ),
+                                'flux': banddata['FLUXCAL'].astype( numpy.float32 ),
+                                'dflux': banddata['FLUXCALERR'].astype( numpy.float32 ) }
+        return ltcv
+
+    @staticmethod
+    def specarrays( rows ):
+        """The 'spectrum' dictionary for rows of the second HDU of a SPEC file."""
+        return { 'lammin': rows['LAMMIN'].astype( numpy.float32 ),
+                 'lammax': rows['LAMMAX'].astype( numpy.float32 ),
+                 'flam': ( rows['FLAM'] * 1e20 ).astype( numpy.float32 ),
+                 'flamerr': ( rows['FLAMERR'] * 1e20 ).astype( numpy.float32 ),
+                 'sim_flam': ( rows['SIM_FLAM'] * 1e20 ).astype( numpy.float32 ) }
+
+    @staticmethod
+    def maxpointsarg( data ):
+        """Pull maxpoints (None, or an int ≥ 2) out of the request arguments in data."""
+        if data.get( 'maxpoints' ) is None:
+            return None
+        maxpoints = int( data['maxpoints'] )
+        if maxpoints < 2:
+            raise ValueError( "maxpoints must be at least 2" )
+        return maxpoints
+
+    @staticmethod
+    def rebinspectrum( spectrum, maxpoints ):
+        """Return a spectrum dictionary with at most maxpoints wavelength bins.
+
+        Groups of adjacent bins are combined into one: F_λ is the
+        bin-width-weighted mean, and its uncertainty is propagated from
+        the uncertainties of the bins that went in.
+
+        """
+        nbins = len( spectrum['lammin'] )
+        if ( maxpoints is None ) or ( nbins <= maxpoints ):
+            return spectrum
+        starts = numpy.arange( 0, nbins, -( -nbins // maxpoints ) )
+        ends = numpy.append( starts[1:], nbins ) - 1
+        width = spectrum['lammax'].astype( numpy.float64 ) - spectrum['lammin']
+        sumwidth = numpy.add.reduceat( width, starts )
+        mean = lambda v: numpy.add.reduceat( width * v, starts ) / sumwidth
+        return { 'lammin': spectrum['lammin'][starts],
+                 'lammax': spectrum['lammax'][ends],
+                 'flam': mean( spectrum['flam'] ).astype( numpy.float32 ),
+                 'flamerr': ( numpy.sqrt( numpy.add.reduceat( ( width * spectrum['flamerr'] )**2, starts ) )
+                              / sumwidth ).astype( numpy.float32 ),
+                 'sim_flam': mean( spectrum['sim_flam'] ).astype( numpy.float32 ) }
+
+    @staticmethod
+    def decimateltcv( ltcv, maxpoints ):
+        """Return a light curve dictionary with at most maxpoints points in each band.
+
+        Each band's points are split into maxpoints/2 runs of consecutive
+        points, and only the points with the lowest and highest flux of
+        each run are kept, so peaks and dips survive.  Kept points are
+        real observations, with their own uncertainties.
+
+        """
+        if maxpoints is None:
+            return ltcv
+        decimated = {}
+        for band, pts in ltcv.items():
+            npts = len( pts['flux'] )
+            if npts <= maxpoints:
+                decimated[band] = pts
+                continue
+            runlen = -( -npts // ( maxpoints // 2 ) )
+            nruns = -( -npts // runlen )
+            flux = numpy.full( nruns * runlen, numpy.nan )
+            flux[:npts] = pts['flux']
+            flux = flux.reshape( nruns, runlen )
+            first = numpy.arange( nruns ) * runlen
+            keep = numpy.unique( numpy.concatenate( [ first + numpy.nanargmin( flux, axis=1 ),
+                                                      first + numpy.nanargmax( flux, axis=1 ) ] ) )
+            decimated[band] = { k: v[keep] for k, v in pts.items() }
+        return decimated
+
+    def downsample( self, objs, maxpoints ):
+        """Apply rebinspectrum and decimateltcv to the objects in objs (replacing, not modifying, their arrays)."""
+        if maxpoints is None:
+            return
+        for obj in objs:
+            if 'ltcv' in obj:
+                obj['ltcv'] = self.decimateltcv( obj['ltcv'], maxpoints )
+            if 'spectrum' in obj:
+                obj['spectrum'] = self.rebinspectrum( obj['spectrum'], maxpoints )
+            for spec in obj.get( 'spectra', [] ):
+                spec['spectrum'] = self.rebinspectrum( spec['spectrum'], maxpoints )
+
+    @staticmethod
+    def byfile( objs, field ):
+        """Group objs by obj[field], so each file only needs to be opened once."""
+        groups = {}
+        for obj in objs:
+            groups.setdefault( obj[field], [] ).append( obj )
+        return groups.items()
+
+    @staticmethod
+    def sample( objs, n, seed ):
+        """The response: the object itself if n wasn't given, otherwise a list of them."""
+        if n is None:
+            retval = objs[0]
+            retval['status'] = 'ok'
+        else:
+            retval = { 'status': 'ok', 'n': len(objs), 'objects': objs }
+        if seed is not None:
+            retval['seed'] = seed
+        return retval
 
-            if found:
-                break
+    def sendsample( self, which, collection, sim, args, n, seed, build ):
+        """Send the object(s) build() returns; args is a dict of the search parameters.
 
-        return retval
+        If there's a seed, the response is always the same, so it's kept
+        in plotcache (keyed on the mtimes of the sim directory and of its
+        pool, so it goes away when either changes).
 
+        """
+        if seed is None:
+            return self.sendobject( build() )
+        subdir = self.simdir( collection, sim )
+        poolpath = ObjectPool.path( collection, subdir )
+        poolstamp = poolpath.stat().st_mtime_ns if poolpath.is_file() else None
+        cachekey = plotcache.key( which, str(subdir), subdir.stat().st_mtime_ns, poolstamp,
+                                  self.canonical_args( args ), n, seed )
+        return self.sendcachedobject( cachekey, build )
 
 
 # ======================================================================
 
 class RandomLTCV(BaseView, RandomObject):
-    def dispatch_request( self, collection, sim, gentype, z, dz, tier=None ):
+    def dispatch_request( self, collection, sim, gentype, z, dz, tier=None, argstr=None ):
+        # The optional tier comes before any /key=value arguments
+        if ( tier is not None ) and ( '=' in tier ):
+            argstr = tier if argstr is None else f'{tier}/{argstr}'
+            tier = None
+        data = { 'tier': tier, 'n': None, 'seed': None, 'maxpoints': None }
+        data.update( self.argstr_to_args( argstr ) )
+
         try:
             gentype = int(gentype)
             z = float(z)
             dz = float(dz)
+            tier = data['tier']
+            n, seed = self.sampleargs( data )
+            maxpoints = self.maxpointsarg( data )
 
-            retval = self.find_random_object( collection, sim, gentype, z, dz, tier=tier )
-            if len( retval ) == 0:
-                raise RuntimeError( f"Failed to find an object of type {gentype} at z {z}±{dz}"
-                                    f"in {'any tier' if tier is None else f'tier {tier}'}" )
-
-            retval['status'] = 'ok'
-            retval['ltcv'] = {}
-            retval['zp'] = 27.5       # Standard SNANA zeropoint
-
-            app.logger.error( f"Opening photfile {retval['photfile'].name}" )
-            with fits.open( retval['photfile'] ) as f:
-                photdata = f[1].data[ retval['ptrobs_min'] : retval['ptrobs_max'] ]
+            def build():
+                return self.ltcvs( collection, sim, gentype, z, dz, tier, n, seed, maxpoints )
 
-            app.logger.error( f"photdata columns: {photdata.columns}" )
-
-            for band in numpy.unique( photdata['BAND'] ):
-                banddata = photdata[ photdata['BAND'] == band ]
-                retval['ltcv'][band] = { 'mjd': [ float(i) for i in banddata['MJD'] ],
-                                         'flux': [ float(i) for i in banddata['FLUXCAL'] ],
-                                         'dflux': [ float(i) for i in banddata['FLUXCALERR'] ] }
+            args = { 'gentype': gentype, 'z': z, 'dz': dz, 'tier': tier, 'maxpoints': maxpoints }
+            return self.sendsample( 'randomltcv', collection, sim, args, n, seed, build )
+        except Exception as ex:
+            app.logger.exception( ex )
+            return { 'status': 'error', 'error': str(ex) }
 
-            # Clean up some fields from retval
-            fields = [ 'headfile', 'photfile', 'ptrobs_min', 'ptrobs_max' ]
+    def ltcvs( self, collection, sim, gentype, z, dz, tier, n, seed, maxpoints=None ):
+        rng = numpy.random.default_rng( seed )
+        objs = self.find_random_objects( collection, sim, gentype, z, dz, tier=tier,
+                                         n=1 if n is None else n, rng=rng )
+        if len( objs ) == 0:
+            raise RuntimeError( f"Failed to find an object of type {gentype} at z {z}±{dz}"
+                                f"in {'any tier' if tier is None else f'tier {tier}'}" )
+
+        # Objects from the pool come with their light curves
+        for photfile, fileobjs in self.byfile( [ o for o in objs if 'ltcv' not in o ], 'photfile' ):
+            app.logger.error( f"Opening photfile {photfile.name}" )
+            with fitscache.open( photfile, memmap=True ) as f:
+                for obj in fileobjs:
+                    photdata = f[1].data[ obj['ptrobs_min'] : obj['ptrobs_max'] ]
+                    obj['ltcv'] = self.bandltcvs( photdata )
+                    obj['zp'] = 27.5       # Standard SNANA zeropoint
+
+        self.downsample( objs, maxpoints )
+
+        # Clean up some fields from the objects
+        fields = [ 'headfile', 'photfile', 'ptrobs_min', 'ptrobs_max' ]
+        for obj in objs:
             for field in fields:
                 try:
-                    del retval[ field ]
+                    del obj[ field ]
                 except KeyError as ex:
                     pass
 
-            return retval
-        except Exception as ex:
-            app.logger.exception( ex )
-            return { 'status': 'error', 'error': str(ex) }
+        return self.sample( objs, n, seed )
 
 # ======================================================================
 
@@ -758,7 +2576,10 @@ class RandomSpectrum(BaseView, RandomObject):
     def dispatch_request( self, collection, sim, gentype, z, dz, t, dt, argstr=None ):
         data = { 'tframe': 'rest',
                  'tier': None,
-                 'specstrat': None }
+                 'specstrat': None,
+                 'n': None,
+                 'seed': None,
+                 'maxpoints': None }
         data.update( self.argstr_to_args( argstr ) )
 
         try:
@@ -767,53 +2588,311 @@ class RandomSpectrum(BaseView, RandomObject):
             dz = float(dz)
             t = float(t)
             dt = float(dt)
-            isrest = False
-            if data['tframe'] == 'rest':
-                isrest = True
-            elif data['tframe'] != 'obs':
+            if data['tframe'] not in ( 'rest', 'obs' ):
                 return f"Unknown tframe {data['tframe']}", 500
+            n, seed = self.sampleargs( data )
+            maxpoints = self.maxpointsarg( data )
 
-            retval = self.find_random_object( collection, sim, gentype, z, dz,
-                                              tier=data['tier'], specstrat=data['specstrat'],
-                                              spect=t, specdt=dt, tframe=data['tframe'], need_spec=True )
-            if len( retval ) == 0:
-                tierstr = 'any tier' if data['tier'] is None else f'tier {data["tier"]}'
-                specstratstr = ( 'any spectrum strategy' if data['specstrat'] is None
-                                 else f'spectrum strategy {data["specstrat"]}' )
-                raise RuntimeError( f"Failed to find a spectrum of type {gentype} at z {z}±{dz} "
-                                    f"and t_{data['tframe']} {t}±{dt} "
-                                    f"for {tierstr} and {specstratstr}" )
-
-            retval['status'] = 'ok'
+            def build():
+                return self.spectra( collection, sim, gentype, z, dz, t, dt, data, n, seed, maxpoints )
 
-            with fits.open( retval['specfile'], memmap=True ) as f:
-                rows = f[2].data[ retval['ptrspec_min'] : retval['ptrspec_max'] ]
-                retval['spectrum'] = {
-                    'lammin': [ float(i) for i in rows['LAMMIN'] ],
-                    'lammax': [ float(i) for i in rows['LAMMAX'] ],
-                    'flam': [ float(i) for i in rows['FLAM']*1e20 ],
-                    'flamerr': [ float(i) for i in rows['FLAMERR']*1e20 ],
-                    'sim_flam': [ float(i) for i in rows['SIM_FLAM']*1e20 ],
-                }
-                # app.logger.debug( f"rows['LAMMIN']={rows['LAMMIN']} ; lammin={retval['spectrum']['lammin']}" )
+            args = { 'gentype': gentype, 'z': z, 'dz': dz, 't': t, 'dt': dt, 'tframe': data['tframe'],
+                     'tier': data['tier'], 'specstrat': data['specstrat'], 'maxpoints': maxpoints }
+            return self.sendsample( 'randomspectrum', collection, sim, args, n, seed, build )
+        except Exception as ex:
+            app.logger.exception( ex )
+            return { 'status': 'error', 'error': str(ex) }
 
-            # Clean up some fields from retval
-            fields = [ 'headfile', 'photfile', 'ptrobs_min', 'ptrobs_max', 'specfile', 'ptrspec_min', 'ptrspec_max' ]
+    def spectra( self, collection, sim, gentype, z, dz, t, dt, data, n, seed, maxpoints=None ):
+        rng = numpy.random.default_rng( seed )
+        objs = self.find_random_objects( collection, sim, gentype, z, dz,
+                                         tier=data['tier'], specstrat=data['specstrat'],
+                                         spect=t, specdt=dt, tframe=data['tframe'], need_spec=True,
+                                         n=1 if n is None else n, rng=rng )
+        if len( objs ) == 0:
+            tierstr = 'any tier' if data['tier'] is None else f'tier {data["tier"]}'
+            specstratstr = ( 'any spectrum strategy' if data['specstrat'] is None
+                             else f'spectrum strategy {data["specstrat"]}' )
+            raise RuntimeError( f"Failed to find a spectrum of type {gentype} at z {z}±{dz} "
+                                f"and t_{data['tframe']} {t}±{dt} "
+                                f"for {tierstr} and {specstratstr}" )
+
+        # Objects from the pool come with their spectra
+        for specfile, fileobjs in self.byfile( [ o for o in objs if 'spectrum' not in o ], 'specfile' ):
+            with fits.open( specfile, memmap=True ) as f:
+                for obj in fileobjs:
+                    obj['spectrum'] = self.specarrays( f[2].data[ obj['ptrspec_min'] : obj['ptrspec_max'] ] )
+
+        self.downsample( objs, maxpoints )
+
+        # Clean up some fields from the objects
+        fields = [ 'headfile', 'photfile', 'ptrobs_min', 'ptrobs_max', 'specfile', 'ptrspec_min', 'ptrspec_max' ]
+        for obj in objs:
             for field in fields:
                 # ****
-                if isinstance( retval[field], pathlib.Path ):
-                    retval[field] = str( retval[field] )
+                if isinstance( obj[field], pathlib.Path ):
+                    obj[field] = str( obj[field] )
                 # ****
             #     try:
-            #         del retval[ field ]
+            #         del obj[ field ]
             #     except KeyError as ex:
             #         pass
 
-            return retval
+        return self.sample( objs, n, seed )
+
+
+# ======================================================================
+
+class ObjectData(BaseView, RandomObject):
+    """Everything about one object, looked up by SNID: HEAD info, light curve, and spectra.
+
+    Objects are found with a binary search in the sim's SimObjectIndex,
+    and their spectra with one in its SimSpectrumIndex, so a lookup reads
+    only the object's own rows of the PHOT and SPEC files.  Responses are
+    cached in plotcache, keyed on the sim directory's mtime.
+
+    """
+    def dispatch_request( self, collection, sim, snid, argstr=None ):
+        data = { 'maxpoints': None }
+        data.update( self.argstr_to_args( argstr ) )
+
+        try:
+            maxpoints = self.maxpointsarg( data )
+            subdir = self.simdir( collection, sim )
+            cachekey = plotcache.key( 'object', str(subdir), subdir.stat().st_mtime_ns, snid, maxpoints )
+            return self.sendcachedobject( cachekey, lambda: self.build( subdir, snid, maxpoints ) )
+        except Exception as ex:
+            app.logger.exception( ex )
+            return { 'status': 'error', 'error': str(ex) }
+
+    def build( self, subdir, snid, maxpoints=None ):
+        index = SimObjectIndex.get( subdir )
+        rows = index.snidrows( snid )
+        if len(rows) == 0:
+            raise RuntimeError( f"No object with SNID {snid} in {subdir.name}" )
+        if len(rows) > 1:
+            app.logger.warning( f"{len(rows)} objects with SNID {snid} in {subdir.name}, using the first" )
+        row = int( rows[0] )
+
+        info = index.objinfo( row )
+        tier = int( index.tier[row] )
+        gentype = int( index.gentype[row] )
+        retval = { 'status': 'ok',
+                   'snid': info['snid'],
+                   'gentype': gentype,
+                   'model': index.models.get( gentype ),
+                   'tier': index.tiers[tier] if tier >= 0 else None,
+                   'snz': info['snz'],
+                   'zhel': float( index.zhel[row] ),
+                   'peakmjd': float( index.peakmjd[row] ),
+                   'mwebv': info['mwebv'],
+                   'av': info['av'],
+                   'rv': info['rv'],
+                   'headfile': info['headfile'].name,
+                   'zp': 27.5 }
+
+        with fitscache.open( info['photfile'], memmap=True ) as f:
+            retval['ltcv'] = self.bandltcvs( f[1].data[ info['ptrobs_min'] : info['ptrobs_max'] ] )
+
+        retval['spectra'] = []
+        specindex = SimSpectrumIndex.get( subdir )
+        specdexes = specindex.objspectra( row )
+        if len(specdexes) > 0:
+            with fits.open( specindex.specinfo( int( specdexes[0] ) )['specfile'], memmap=True ) as f:
+                for dex in specdexes:
+                    spec = specindex.specinfo( int(dex) )
+                    retval['spectra'].append( {
+                        'mjd': float( specindex.mjd[dex] ),
+                        'spec_texp': spec['spec_texp'],
+                        'specdt': spec['specdt'],
+                        'specdtrest': spec['specdtrest'],
+                        'specnbin_lam': spec['specnbin_lam'],
+                        'spechost_contam': spec['spechost_contam'],
+                        'spectrum': self.specarrays( f[2].data[ spec['ptrspec_min'] : spec['ptrspec_max'] ] )
+                    } )
+
+        self.downsample( [ retval ], maxpoints )
+        return retval
+
+# ======================================================================
+# Stacked spectra.
+#
+# Every spectrum in a sim that matches the cuts (the same ones
+#   /randomspectrum uses) is read, interpolated onto a common rest- or
+#   observer-frame wavelength grid, and the mean, median, scatter, and
+#   number of spectra at each wavelength are sent back.  Everything after
+#   the spectrum index search is done on all of the spectra at once: the
+#   rows of all the spectra in a SPEC file are gathered with one fancy
+#   index into the memory-mapped table, and the interpolation finds
+#   where every wavelength of every spectrum falls on the grid with one
+#   searchsorted, and turns that into interpolation indexes with a
+#   bincount and a cumsum.
+
+class SpecStack(BaseView, RandomObject):
+    # Most spectra that go into one stack; more than this are randomly (but reproducibly) subsampled
+    maxspec = 5000
+    # Most points in the wavelength grid; about the resolution of a plot
+    maxnlam = 2000
+    # Spectra interpolated at once; bounds interpolate's temporaries to a few MB each
+    blockspec = 256
+
+    def dispatch_request( self, collection, sim, gentype, z, dz, t, dt, argstr=None ):
+        data = { 'tframe': 'rest',
+                 'tier': None,
+                 'specstrat': None,
+                 'lamframe': 'rest',
+                 'lammin': None,
+                 'lammax': None,
+                 'nlam': 300,
+                 'norm': 'median' }
+        data.update( self.argstr_to_args( argstr ) )
+
+        try:
+            args = { 'gentype': int(gentype), 'z': float(z), 'dz': float(dz), 't': float(t), 'dt': float(dt),
+                     'tframe': data['tframe'], 'tier': data['tier'],
+                     'specstrat': None if data['specstrat'] is None else int( data['specstrat'] ),
+                     'lamframe': data['lamframe'],
+                     'lammin': None if data['lammin'] is None else float( data['lammin'] ),
+                     'lammax': None if data['lammax'] is None else float( data['lammax'] ),
+                     'nlam': int( data['nlam'] ),
+                     'norm': data['norm'] }
+            for arg, allowed in [ ( 'tframe', ( 'rest', 'obs' ) ), ( 'lamframe', ( 'rest', 'obs' ) ),
+                                  ( 'norm', ( 'median', 'none' ) ) ]:
+                if args[arg] not in allowed:
+                    return f"{arg} must be one of {allowed}", 500
+            if ( args['nlam'] < 2 ) or ( args['nlam'] > self.maxnlam ):
+                return f"nlam must be between 2 and {self.maxnlam}", 500
+
+            subdir = self.simdir( collection, sim )
+            cachekey = plotcache.key( 'specstack', str(subdir), subdir.stat().st_mtime_ns,
+                                      self.canonical_args( args ) )
+            return self.sendcachedobject( cachekey, lambda: self.stack( collection, subdir, **args ) )
         except Exception as ex:
             app.logger.exception( ex )
             return { 'status': 'error', 'error': str(ex) }
 
+    @staticmethod
+    def segments( lo, hi ):
+        """Return the concatenation of arange( lo[i], hi[i] ) for all i, and the i each element came from."""
+        lens = hi - lo
+        seg = numpy.repeat( numpy.arange( len(lo) ), lens )
+        rows = numpy.arange( lens.sum() ) - numpy.repeat( numpy.cumsum( lens ) - lens - lo, lens )
+        return rows, seg
+
+    @classmethod
+    def interpolate( cls, x, y, seg, nseg, grid ):
+        """Linearly interpolate each segment of y(x) onto grid.
+
+        x and y are the concatenation of nseg segments, seg says which
+        segment each element is in, and x increases within each segment.
+        Returns an ( nseg, len(grid) ) float32 array, NaN where grid is
+        outside a segment's x range.  The segments are done cls.blockspec
+        at a time, so the float64 temporaries don't scale with nseg.
+
+        """
+        fluxes = numpy.full( ( nseg, len(grid) ), numpy.nan, dtype=numpy.float32 )
+        counts = numpy.bincount( seg, minlength=nseg )
+        starts = numpy.concatenate( [ [ 0 ], numpy.cumsum( counts ) ] )
+        for s0 in range( 0, nseg, cls.blockspec ):
+            s1 = min( s0 + cls.blockspec, nseg )
+            sl = slice( starts[s0], starts[s1] )
+            fluxes[ s0:s1 ] = cls.interpolateblock( x[sl], y[sl], seg[sl] - s0, s1 - s0, grid )
+        return fluxes
+
+    @staticmethod
+    def interpolateblock( x, y, seg, nseg, grid ):
+        """interpolate for one block of segments; returns a float64 ( nseg, len(grid) ) array."""
+        ngrid = len(grid)
+        if len(x) == 0:
+            return numpy.full( ( nseg, ngrid ), numpy.nan )
+        counts = numpy.bincount( seg, minlength=nseg )
+        first = ( numpy.cumsum( counts ) - counts )[ :, numpy.newaxis ]
+        # nle[s, j] is the number of x in segment s that are ≤ grid[j], so
+        #   first[s] + nle[s, j] - 1 is the index of the last of those
+        gbin = numpy.searchsorted( grid, x, side='left' )
+        nle = numpy.bincount( seg * ( ngrid + 1 ) + gbin, minlength=nseg * ( ngrid + 1 ) )
+        nle = numpy.cumsum( nle.reshape( nseg, ngrid + 1 ), axis=1 )[ :, :ngrid ]
+        lo = numpy.clip( first + nle - 1, 0, len(x) - 1 )
+        # A grid point right on a segment's last x is still in the segment
+        ondata = ( x[lo] == grid )
+        valid = ( nle > 0 ) & ( ( nle < counts[ :, numpy.newaxis ] ) | ondata )
+        hi = numpy.where( ondata, lo, numpy.clip( lo + 1, 0, len(x) - 1 ) )
+        dx = x[hi] - x[lo]
+        frac = numpy.divide( grid - x[lo], dx, out=numpy.zeros( dx.shape ), where=( dx != 0 ) )
+        vals = y[lo] + frac * ( y[hi] - y[lo] )
+        vals[ ~valid ] = numpy.nan
+        return vals
+
+    def stack( self, collection, subdir, gentype, z, dz, t, dt, tframe, tier, specstrat, lamframe,
+               lammin, lammax, nlam, norm ):
+        specindex = SimSpectrumIndex.get( subdir )
+        objindex = specindex.objindex
+        specdexes = specindex.find( gentype, z - dz, z + dz, t, dt, tframe=tframe, tier=tier,
+                                    texposes=self.spectexposes( collection, tier, specstrat ) )
+        nfound = len( specdexes )
+        if nfound > self.maxspec:
+            specdexes = numpy.sort( numpy.random.default_rng( 0 ).choice( specdexes, self.maxspec, replace=False ) )
+        if len( specdexes ) == 0:
+            raise RuntimeError( f"No spectra of type {gentype} at z {z}±{dz} and t_{tframe} {t}±{dt}" )
+
+        objrows = numpy.asarray( specindex.objrow )[ specdexes ]
+        fileids = numpy.asarray( objindex.fileid )[ objrows ]
+        lo = numpy.asarray( specindex.ptrspec_min )[ specdexes ] - 1
+        hi = numpy.asarray( specindex.ptrspec_max )[ specdexes ]
+
+        # Read all the rows of all the spectra, a SPEC file at a time, in specdexes order
+        order = numpy.argsort( fileids, kind='stable' )
+        lam = []
+        flam = []
+        seg = []
+        for fileid in numpy.unique( fileids ):
+            these = order[ fileids[order] == fileid ]
+            specfile = objindex.simdir / objindex.headfiles[fileid].replace( '_HEAD.FITS.gz', '_SPEC.FITS' )
+            rows, rowseg = self.segments( lo[these], hi[these] )
+            with fits.open( specfile, memmap=True ) as f:
+                tab = f[2].data
+                lam.append( ( numpy.asarray( tab['LAMMIN'][rows], dtype=numpy.float64 )
+                              + numpy.asarray( tab['LAMMAX'][rows], dtype=numpy.float64 ) ) / 2. )
+                flam.append( numpy.asarray( tab['FLAM'][rows], dtype=numpy.float64 ) * 1e20 )
+            seg.append( these[ rowseg ] )
+        lam = numpy.concatenate( lam )
+        flam = numpy.concatenate( flam )
+        seg = numpy.concatenate( seg )
+        # interpolate wants each segment's elements together, in segment order
+        segorder = numpy.argsort( seg, kind='stable' )
+        lam = lam[segorder]
+        flam = flam[segorder]
+        seg = seg[segorder]
+
+        if lamframe == 'rest':
+            lam /= ( 1. + numpy.asarray( objindex.zhel )[ objrows ] )[ seg ]
+        grid = numpy.linspace( lam.min() if lammin is None else lammin,
+                               lam.max() if lammax is None else lammax, nlam )
+        fluxes = self.interpolate( lam, flam, seg, len( specdexes ), grid )
+        if norm == 'median':
+            with numpy.errstate( invalid='ignore' ), warnings.catch_warnings():
+                warnings.simplefilter( 'ignore', RuntimeWarning )
+                scale = numpy.nanmedian( fluxes, axis=1 )
+            scale[ ~( scale > 0 ) ] = numpy.nan
+            fluxes /= scale[ :, numpy.newaxis ]
+
+        n = numpy.sum( ~numpy.isnan( fluxes ), axis=0 ).astype( numpy.int32 )
+        with warnings.catch_warnings():
+            # All-NaN columns (no spectrum covers that wavelength) are expected, and come out NaN
+            warnings.simplefilter( 'ignore', RuntimeWarning )
+            retval = { 'status': 'ok',
+                       'nfound': nfound,
+                       'nspec': len( specdexes ),
+                       'lamframe': lamframe,
+                       'norm': norm,
+                       'lam': grid,
+                       'mean': numpy.nanmean( fluxes, axis=0 ),
+                       'median': numpy.nanmedian( fluxes, axis=0 ),
+                       'scatter': numpy.nanstd( fluxes, axis=0 ),
+                       'n': n }
+        return retval
+
+
 # ======================================================================
 
 app = flask.Flask( __name__, instance_relative_config=True )
@@ -831,33 +2910,67 @@ rules = {
     "/analysisinfo/<string:collection>": AnalysisInfo,
     "/tiers/<string:collection>": Tiers,
     "/surveys/<string:collection>": Surveys,
+    "/surveyindex/<string:collection>": SurveyIndex,
+    "/simdata/<string:collection>/<string:sim>": SimData,
     "/summarydata/<string:collection>": SummaryData,
     "/snzhist/<string:collection>/<string:sim>": SNZHist,
     "/snzhist/<string:collection>/<string:sim>/<path:argstr>": SNZHist,
     "/spechist/<string:which>/<string:collection>/<string:sim>/<int:strategy>": SpecHist,
     "/spechist/<string:which>/<string:collection>/<string:sim>/<int:strategy>/<path:argstr>": SpecHist,
+    "/batchhist/<string:plot>/<string:collection>": BatchHist,
+    "/batchhist/<string:plot>/<string:collection>/<path:argstr>": BatchHist,
     "/randomltcv/<string:collection>/<string:sim>/<int:gentype>/<string:z>/<string:dz>": RandomLTCV,
     "/randomltcv/<string:collection>/<string:sim>/<int:gentype>/<string:z>/<string:dz>/<string:tier>": RandomLTCV,
+    ( "/randomltcv/<string:collection>/<string:sim>/<int:gentype>/<string:z>/<string:dz>/<string:tier>"
+      "/<path:argstr>" ): RandomLTCV,
     ( "/randomspectrum/<string:collection>/<string:sim>/<int:gentype>/<string:z>/<string:dz>"
       "/<string:t>/<string:dt>/<path:argstr>" ): RandomSpectrum,
+    ( "/specstack/<string:collection>/<string:sim>/<int:gentype>/<string:z>/<string:dz>"
+      "/<string:t>/<string:dt>" ): SpecStack,
+    ( "/specstack/<string:collection>/<string:sim>/<int:gentype>/<string:z>/<string:dz>"
+      "/<string:t>/<string:dt>/<path:argstr>" ): SpecStack,
+    "/object/<string:collection>/<string:sim>/<int:snid>": ObjectData,
+    "/object/<string:collection>/<string:sim>/<int:snid>/<path:argstr>": ObjectData,
 }
 
 # Dysfunctionality alert: flask routing doesn't interpret "0" or "5" as
 # a float.  (It thinks it's an int and an int only.)
 
-lastname = None
+names = set()
 for url, cls in rules.items():
     match = re.search( "^/([^/]+)", url )
     if match is None:
         raise ValueError( f"Bad url {url}" )
     name = match.group(1)
-    if name == lastname:
+    while name in names:
         # Kind of a hack so that flask doesn't get pissy about repeated names
         name += "x"
-    lastname = name
+    names.add( name )
     app.add_url_rule( url, view_func=cls.as_view(name), methods=["GET","POST"], strict_slashes=False )
 
+# A data directory symlink with an absolute target usually points outside
+#   of what's mounted in the container; say so now rather than with every
+#   request failing.
+if not dataversion.current().root.is_dir():
+    app.logger.error( f"Data directory {dataversion.datadir} resolves to {dataversion.current().root}, which "
+                      f"doesn't exist.  If it's a symlink, its target must be relative (the name of a "
+                      f"directory next to it)." )
+
 # ****
 # for rule in app.url_map.iter_rules():
 #     app.logger.debug( f"Found rule {rule}" )
 # ****
+
+# ======================================================================
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser( description="Maintenance tasks for the SNANA summary webserver",
+                                      formatter_class=argparse.ArgumentDefaultsHelpFormatter )
+    parser.add_argument( '--prewarm-fits', nargs='+', default=[], metavar='SIMDIR',
+                         help=( "Make decompressed copies in SNANA_SUMMARY_FITS_CACHE_DIR of the "
+                                "gzipped FITS files in these sim directories" ) )
+    args = parser.parse_args()
+
+    app.logger.setLevel( logging.INFO )
+    if len( args.prewarm_fits ) > 0:
+        fitscache.prewarm( args.prewarm_fits )